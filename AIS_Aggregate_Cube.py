@@ -0,0 +1,260 @@
+## Aggregate cube of crossing counts, kept up to date by the filtering job
+
+# The rankings and the histograms used to rebuild their numbers from every bridge's raw crossings each time
+# they ran, and divided by a hard-coded number of days. This file keeps a small table of crossing counts by
+# bridge, year, month, ship length, and vessel type instead. The filtering job adds each day's counts to it as
+# the day is written, and the number of days comes from the run manifest, so the plots only read the table.
+
+
+
+##########################
+### Importing Packages ###
+##########################
+
+import os
+import json
+
+import pandas as pd
+import numpy as np
+
+
+
+
+###################
+### Cube Layout ###
+###################
+
+'''
+The cube is one csv file kept next to the run manifest, with one row per
+
+    Source        the daily file the crossings came from, EX: AIS_2020_01_01 (or AIS_2020_01_01_midnight)
+    Bridge        the structure that was crossed
+    Year, Month   when it was crossed (the first broadcast of a pair, or the crossing time of an event)
+    LengthFrom    the length bin of the ship, LengthFrom <= Length < LengthTo, in meters
+    LengthTo          Both are blank for ships without a length
+    VesselGroup   the group of the ship's VesselType (see cube_type_groups)
+    Trips         the number of crossings
+
+Lengths are whole meters, so "longer than 180 m" is the same as "at least 181 m". The bins are cut on both sides
+of every cutoff (EX: 180 and 181), so the rankings (Length > cutoff) and the histograms (cutoff <= Length <=
+next cutoff) both add up whole bins, and come out exactly the same as counting the raw crossings.
+
+Keeping the Source of every row means a day that is filtered again replaces its old counts instead of adding
+to them. Reading the cube adds the days together, leaving one row per bridge, month, length bin, and vessel
+group, however many days there are.
+'''
+
+# The cutoffs the plots use, in meters
+    # The rankings count ships longer than 180, 215, 250, 275, and 300 m
+    # The histograms use the bins 150-180, 180-215, 215-250, 250-275, 275-300, and above 300 m
+cube_length_cutoffs = [150, 180, 215, 250, 275, 300]
+
+# Dictionary of the form Group Name: (low, high) range of VesselType codes, low <= code < high
+    # Every other vessel type is "Other", and ships without a vessel type are "Unknown"
+    # Vessel Type codes are based on the following: https://coast.noaa.gov/data/marinecadastre/ais/VesselTypeCodes2018.pdf
+cube_type_groups = {"Passenger": (60, 70),
+                    "Cargo": (70, 80),
+                    "Tanker": (80, 90)}
+
+cube_file_name = 'aggregate_cube.csv'
+
+cube_columns = ["Source", "Bridge", "Year", "Month", "LengthFrom", "LengthTo", "VesselGroup", "Trips"]
+
+
+def length_edges(cutoffs=cube_length_cutoffs):
+    # Bin edges on both sides of every cutoff, starting from 0 and ending with no upper limit
+    return sorted({0} | set(cutoffs) | {c + 1 for c in cutoffs}) + [np.inf]
+
+
+def vessel_group(vessel_type, type_groups=cube_type_groups):
+    # The group name of every ship, from its VesselType
+    vessel_type = pd.to_numeric(vessel_type, errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    groups = np.where(np.isnan(vessel_type), "Unknown", "Other").astype(object)
+
+    for name, (low, high) in type_groups.items():
+        groups[(low <= vessel_type) & (vessel_type < high)] = name
+
+    return groups
+
+
+
+
+##########################
+### Counting Crossings ###
+##########################
+
+def cube_counts(frame, bridge, source, events=False, cutoffs=cube_length_cutoffs, type_groups=cube_type_groups):
+    """
+    Parameters
+    ----------
+    frame : Data frame of crossing points (pairs) or crossing events for one bridge, from one daily file
+
+    bridge : name of the bridge that was crossed
+
+    source : name of the daily file the crossings came from
+
+    events : If True, frame holds one row per crossing instead of two
+
+    Returns
+    -------
+    Data frame of the frame's crossing counts, with the cube_columns
+    """
+
+    # Every pair of rows is one crossing, the first row says when and which ship
+    crossings = frame if events else frame.iloc[0::2]
+
+    times = pd.to_datetime(crossings["CrossingTime" if events else "BaseDateTime"], errors="coerce")
+    length = pd.to_numeric(crossings["Length"], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+
+    edges = np.asarray(length_edges(cutoffs), dtype=np.float64)
+    bins = np.searchsorted(edges, length, side="right") - 1
+    known = ~np.isnan(length)
+
+    keys = pd.DataFrame({"Year": times.dt.year.to_numpy(),
+                         "Month": times.dt.month.to_numpy(),
+                         "LengthFrom": np.where(known, edges[np.clip(bins, 0, edges.size - 2)], np.nan),
+                         "LengthTo": np.where(known, edges[np.clip(bins + 1, 1, edges.size - 1)], np.nan),
+                         "VesselGroup": vessel_group(crossings["VesselType"], type_groups)})
+
+    # Crossings with a time that can't be read can't be put in a month
+    keys = keys.loc[keys["Year"].notna()]
+
+    counts = keys.groupby(["Year", "Month", "LengthFrom", "LengthTo", "VesselGroup"], dropna=False).size().reset_index(name="Trips")
+    counts.insert(0, "Bridge", bridge)
+    counts.insert(0, "Source", source)
+
+    counts["Year"] = counts["Year"].astype(int)
+    counts["Month"] = counts["Month"].astype(int)
+
+    return counts[cube_columns]
+
+
+def update_cube(path, held, held_sources, events=False, sources=None):
+    """
+    Parameters
+    ----------
+    path : the cube's csv file
+
+    held, held_sources : Dictionaries of the form Bridge: List of Data Frames / List of their daily file names
+        The same rows the writer is about to write (see checkpoint in the filtering script)
+
+    events : If True, the frames are crossing events instead of pairs
+
+    sources : every daily file being written, including the ones without any crossings now
+        A day filtered again that no longer crosses anything still has its old counts dropped
+
+    Returns
+    -------
+    None. The counts of the held rows are added to the cube, replacing any older counts from the same days
+    """
+
+    counts = [cube_counts(frame, bridge, source, events)
+              for bridge in held for frame, source in zip(held[bridge], held_sources[bridge]) if len(frame)]
+
+    # Every day whose old counts are replaced, whether or not it has new ones
+    sources = set(sources or []) | {source for bridge in held_sources for source in held_sources[bridge]}
+
+    counts = pd.concat(counts, ignore_index=True) if counts else pd.DataFrame(columns=cube_columns)
+
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        if len(counts):
+            counts.to_csv(path, index=False)
+        return
+
+    # Only the Source column is read to see if any of these days are already in the cube
+    written = set(pd.read_csv(path, usecols=["Source"])["Source"])
+
+    if written.isdisjoint(sources):
+        if len(counts):
+            counts.to_csv(path, index=False, mode="a", header=False)
+        return
+
+    # A day was filtered again, so its old counts are dropped before the new ones are added
+        # Written to a temporary file first, then swapped into place so a crash never leaves half a cube
+    cube = pd.read_csv(path)
+    cube = cube.loc[~cube["Source"].isin(sources)]
+    if len(counts):
+        cube = pd.concat([cube, counts], ignore_index=True)
+    cube.to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+
+
+
+#######################
+### Reading It Back ###
+#######################
+
+def load_cube(path):
+    """
+    Returns
+    -------
+    Data frame of the cube, with every day added together
+        The same columns as the file, without Source
+    """
+
+    cube = pd.read_csv(path)
+
+    # Blank lengths still make their own group, so ships without a length are counted
+    keys = ["Bridge", "Year", "Month", "LengthFrom", "LengthTo", "VesselGroup"]
+    return cube.groupby(keys, dropna=False)["Trips"].sum().reset_index()
+
+
+def cube_trips(cube, by=("Bridge",), longer_than=None, at_least=None, at_most=None, groups=None):
+    """
+    Parameters
+    ----------
+    cube : Data frame from load_cube
+
+    by : the columns to count by, EX: ("Bridge", "Year")
+
+    longer_than : only count ships longer than this, in meters
+
+    at_least, at_most : only count ships with at_least <= Length <= at_most, in meters
+
+    groups : only count these vessel groups, EX: ["Cargo", "Tanker"]. Every group by default
+
+    Returns
+    -------
+    Series of the number of trips, indexed by the by columns
+        Groups without any trips are left out
+    """
+
+    keep = np.ones(len(cube), dtype=bool)
+
+    # Lengths are whole meters, so these are the same as LengthFrom <= Length < LengthTo
+    low = None if longer_than is None else longer_than + 1
+    low = at_least if low is None else (low if at_least is None else max(low, at_least))
+    high = None if at_most is None else at_most + 1
+
+    for bound in [b for b in (low, high) if b is not None]:
+        # A bound inside a bin can't be counted from the cube
+        if ((cube["LengthFrom"] < bound) & (bound < cube["LengthTo"])).any():
+            raise ValueError(f"{bound} m is not the edge of a length bin, add it to cube_length_cutoffs and rebuild the cube")
+
+    if low is not None:
+        keep &= (cube["LengthFrom"] >= low).to_numpy()
+    if high is not None:
+        keep &= (cube["LengthTo"] <= high).to_numpy()
+    if groups is not None:
+        keep &= cube["VesselGroup"].isin(groups).to_numpy()
+
+    return cube.loc[keep].groupby(list(by))["Trips"].sum()
+
+
+def days_filtered(manifest_path):
+    """
+    Returns
+    -------
+    The number of daily files the run manifest at manifest_path has marked done
+        Midnights stitched between days aren't days of their own, so they aren't counted
+    """
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    return sum(1 for url, entry in manifest["files"].items() if entry["state"] == "done" and not url.endswith('#midnight'))
@@ -0,0 +1,155 @@
+## Columnar archive of the raw daily AIS files
+
+# Changing min_boat_length, a bridge's boundary, or the jump thresholds used to mean downloading and parsing
+# every daily csv again, which took about a day. This file stores each day once as a compact Parquet file that
+# is already cut down to class A boats and already sorted by boat and time, so the filters can be run again
+# from the archive in minutes.
+
+
+
+##########################
+### Importing Packages ###
+##########################
+
+import os
+
+import pandas as pd
+import numpy as np
+
+# Parquet support comes from pyarrow, which is only needed if the archive is actually used
+    # pip install pyarrow
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+
+
+######################
+### Archive Layout ###
+######################
+
+'''
+Every daily file becomes one file in the archive folder:
+
+    {archive folder}/{daily file}.parquet            EX: AIS_2020_01_01.parquet
+
+Compared to the csv inside NOAA's zip, each archived day:
+    - Only holds class A broadcasts. Class B broadcasts are never used by the filters
+    - Is sorted by MMSI, then by time, so the filters don't have to sort it again
+    - Stores the time as a timestamp instead of text
+    - Stores MMSI, names, IMO numbers, and call signs once per distinct value (dictionary encoding)
+    - Stores each integer column in the smallest integer type that holds that day's values
+
+Coordinates, speeds, and courses stay 64 bit floats, so the crossings found from the archive are exactly the
+crossings found from the original csv.
+'''
+
+# Columns read back as categories, since each value repeats on many rows
+archive_categories = ["MMSI", "VesselName", "IMO", "CallSign", "TransceiverClass"]
+
+# The text format NOAA uses for BaseDateTime
+    # Used to turn archived timestamps back into the same text the csv files had
+noaa_time_format = "%Y-%m-%dT%H:%M:%S"
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("The AIS archive needs pyarrow. Install it with: pip install pyarrow")
+
+
+def smallest_integer(values):
+    """
+    Parameters
+    ----------
+    values : nullable integer Series
+
+    Returns
+    -------
+    The same values as the smallest nullable integer type (Int8, Int16, Int32, or Int64) that holds all of them
+    """
+
+    present = values.dropna()
+
+    if present.empty:
+        return values.astype("Int8")
+
+    low = int(present.min())
+    high = int(present.max())
+
+    for dtype, info in (("Int8", np.iinfo(np.int8)), ("Int16", np.iinfo(np.int16)), ("Int32", np.iinfo(np.int32))):
+        if info.min <= low and high <= info.max:
+            return values.astype(dtype)
+
+    return values.astype("Int64")
+
+
+def write_archive(frame, path):
+    """
+    Parameters
+    ----------
+    frame : Data frame of a day's class A broadcasts, already sorted by MMSI and time
+
+    path : where to write the archived day
+
+    Returns
+    -------
+    None. The file is written to a hidden temporary file first, then swapped into place
+    """
+
+    require_pyarrow()
+
+    frame = frame.copy()
+    frame["BaseDateTime"] = pd.to_datetime(frame["BaseDateTime"], format=noaa_time_format, errors="coerce")
+
+    for column in frame.columns:
+        if isinstance(frame[column].dtype, pd.CategoricalDtype):
+            # Categories like transceiver class B were dropped along with their rows
+            frame[column] = frame[column].cat.remove_unused_categories()
+        elif column in archive_categories:
+            frame[column] = frame[column].astype("category")
+        elif pd.api.types.is_integer_dtype(frame[column].dtype):
+            frame[column] = smallest_integer(frame[column])
+
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+
+    folder, name = os.path.split(path)
+    os.makedirs(folder or ".", exist_ok=True)
+
+    # A crash never leaves half a day in the archive
+    temporary = os.path.join(folder, "." + name + ".tmp")
+    pq.write_table(table, temporary, compression="zstd")
+    os.replace(temporary, path)
+
+    return
+
+
+def read_archive(path, columns=None):
+    """
+    Parameters
+    ----------
+    path : path of an archived day
+
+    columns : list of the columns to read, or None for every column
+
+    Returns
+    -------
+    Data frame of the day's class A broadcasts, sorted by MMSI and time
+        Integer columns are nullable pandas integers, and the columns in archive_categories are categories
+    """
+
+    require_pyarrow()
+
+    table = pq.read_table(path, columns=columns, read_dictionary=[c for c in archive_categories if columns is None or c in columns])
+
+    # Keep missing integers as <NA> rather than turning the whole column into floats
+    integer_types = {pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype(), pa.int32(): pd.Int32Dtype(), pa.int64(): pd.Int64Dtype()}
+
+    return table.to_pandas(types_mapper=integer_types.get)
+
+
+def is_archived(file):
+    # Archived days are always paths ending in .parquet, while csv inputs may be paths or open files
+    return isinstance(file, (str, os.PathLike)) and os.fspath(file).endswith(".parquet")
@@ -0,0 +1,525 @@
+## Synthetic AIS days and a benchmark of the filtering pipeline
+
+# The only measurement of the filtering used to be the "approximately 27 hours" noted at the bottom of the
+# filtering script. This file makes synthetic daily files in the same format as NOAA's, with boats crossing the
+# real bridges and ports, and times filter_bridges, filter_ports, and the filter and write pipeline on them. Each
+# run reports rows and segments per second, peak memory, and whether the output matches another version of the
+# filtering script (the baseline commit by default), so a change can be shown to be faster without changing results.
+
+
+
+##########################
+### Importing Packages ###
+##########################
+
+import os
+import re
+import sys
+import json
+import time
+import queue
+import shutil
+import inspect
+import subprocess
+import importlib.util
+import multiprocessing as mlt
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+
+import pandas as pd
+import numpy as np
+
+# The same measurements the scheduler makes of each file
+from AIS_Scheduler import resident_memory, peak_memory
+
+# The same compiled boundaries the filtering script uses
+import AIS_Boundary_Geometry
+
+
+
+
+######################
+### Synthetic Days ###
+######################
+
+'''
+A synthetic day is made of boat tracks. Each boat broadcasts every few seconds while moving in a straight line
+at a steady speed, with a little GPS noise added. Some tracks are aimed straight through the middle of a bridge
+or a port, some are near a structure without crossing it, and the rest are somewhere else entirely, so the
+prefilter, the spatial index, and the exact test all have work to do. The boats get a mix of lengths, vessel
+types, statuses, and transceiver classes, so the vessel mask drops some of them like it would a real day.
+
+Everything comes from one random seed, so the same settings always make exactly the same file.
+'''
+
+# Folder holding Corrected_Bridge_Boundaries.xlsx and Port_Boundaries.xlsx, this repository by default
+geometry_folder = AIS_Boundary_Geometry.geometry_folder
+
+# The columns of a NOAA daily file, in order
+noaa_columns = ["MMSI", "BaseDateTime", "LAT", "LON", "SOG", "COG", "Heading", "VesselName", "IMO", "CallSign",
+                "VesselType", "Status", "Length", "Width", "Draft", "Cargo", "TransceiverClass"]
+
+# The day that is benchmarked
+    # vessels : the number of boats
+    # broadcasts : the most broadcasts a boat makes, fewer if its track runs past midnight
+    # broadcast_seconds : the average time between a boat's broadcasts
+    # crossing_fraction, port_fraction : the fraction of boats aimed through a bridge, or through a port
+    # near_fraction : the fraction of boats close to a structure without crossing it
+    # repeat_fraction : the fraction of broadcasts sent twice, like the repeats in NOAA's files
+    # A real day has about 15,000 to 20,000 boats and 7 to 9 million broadcasts
+synthetic_day_settings = {"date": "2020-01-01",
+                          "vessels": 2000,
+                          "broadcasts": 500,
+                          "broadcast_seconds": 60,
+                          "crossing_fraction": 0.1,
+                          "port_fraction": 0.05,
+                          "near_fraction": 0.25,
+                          "repeat_fraction": 0.01,
+                          "seed": 0}
+
+
+def load_geometry(folder=geometry_folder):
+    """
+    Returns
+    -------
+    bridges, ports : Dictionaries of the form Structure: Array of Points, from the compiled boundaries of folder
+        The same boundaries the filtering script uses, and every port boundary ends where it started
+    """
+
+    geometry = AIS_Boundary_Geometry.load_geometry(folder)
+    bridges = AIS_Boundary_Geometry.boundary_set(geometry, "bridges")
+    ports = AIS_Boundary_Geometry.boundary_set(geometry, "ports")
+
+    return {k: v for k, v in bridges.items() if len(v) >= 2}, {k: v for k, v in ports.items() if len(v) >= 4}
+
+
+def synthetic_day(bridges, ports, date="2020-01-01", vessels=2000, broadcasts=500, broadcast_seconds=60, crossing_fraction=0.1,
+                  port_fraction=0.05, near_fraction=0.25, repeat_fraction=0.01, seed=0):
+    """
+    Parameters
+    ----------
+    bridges, ports : Dictionaries of the form Structure: Array of Points, from load_geometry
+
+    date : the day the broadcasts are from
+
+    The rest are described in synthetic_day_settings
+
+    Returns
+    -------
+    Data frame of the day's broadcasts, with NOAA's columns, in time order like NOAA's files
+    """
+
+    rng = np.random.default_rng(seed)
+
+    bridge_points = list(bridges.values())
+    port_points = list(ports.values())
+
+    # What kind of track each boat makes
+    kind = rng.choice(["bridge", "port", "near", "far"], size=vessels,
+                      p=[crossing_fraction, port_fraction, near_fraction, 1 - crossing_fraction - port_fraction - near_fraction])
+
+    # Every boat's speed in degrees of latitude per second (a nautical mile is a minute of latitude) and direction
+    knots = rng.uniform(6, 22, vessels)
+    heading = rng.uniform(0, 2 * np.pi, vessels)
+
+    # The point each track passes through
+    center = np.empty((vessels, 2))
+    for i in range(vessels):
+        if kind[i] == "bridge":
+            line = bridge_points[rng.integers(len(bridge_points))]
+            center[i] = (line[0] + line[-1]) / 2
+
+            # Straight across the bridge, in one direction or the other
+            along = line[-1] - line[0]
+            heading[i] = np.arctan2(-along[1], along[0]) + np.pi * rng.integers(2)
+        elif kind[i] == "port":
+            center[i] = port_points[rng.integers(len(port_points))].mean(axis=0)
+        elif kind[i] == "near":
+            # Close enough to a bridge to reach its part of the spatial index, but going past it
+            line = bridge_points[rng.integers(len(bridge_points))]
+            center[i] = (line[0] + line[-1]) / 2 + rng.choice([-1, 1], 2) * rng.uniform(0.05, 0.5, 2)
+        else:
+            # Anywhere off the coasts of the lower 48
+            center[i] = (rng.uniform(-125, -66), rng.uniform(24, 49))
+
+    # Each boat's broadcasts, a random time apart, passing through its center somewhere in the middle of the track
+    count = rng.integers(max(broadcasts // 4, 1), broadcasts + 1, vessels)
+    boat = np.repeat(np.arange(vessels), count)
+    gaps = rng.uniform(0.5, 1.5, boat.size) * broadcast_seconds
+    first = np.concatenate(([0], np.cumsum(count)[:-1]))
+    elapsed = np.cumsum(gaps) - np.repeat(np.cumsum(gaps)[first] - gaps[first], count)
+    start = rng.uniform(-0.25, 1, vessels) * 86400
+    seconds = np.floor(start[boat] + elapsed).astype(np.int64)
+    middle = start + np.maximum.reduceat(elapsed, first) / 2
+
+    # Straight lines at a steady speed, shrinking longitude by the latitude
+    travel = (seconds - middle[boat]) * knots[boat] / 3600 / 60
+    lat = center[boat, 1] + travel * np.cos(heading[boat]) + rng.normal(0, 1e-4, boat.size)
+    lon = center[boat, 0] + travel * np.sin(heading[boat]) / np.cos(np.radians(center[boat, 1])) + rng.normal(0, 1e-4, boat.size)
+
+    # Only the broadcasts made on the day are in its file
+    today = (seconds >= 0) & (seconds < 86400)
+
+    # Some broadcasts are sent twice
+    repeat = today & (rng.random(boat.size) < repeat_fraction)
+    rows = np.sort(np.concatenate((np.flatnonzero(today), np.flatnonzero(repeat))))
+    boat, seconds, lat, lon = boat[rows], seconds[rows], lat[rows], lon[rows]
+
+    # Every boat's details, chosen so that some of them fail the vessel mask
+    length = rng.choice([0, 30, 80, 120, 160, 200, 250, 300, 340], vessels).astype(float)
+    length[length == 0] = np.nan
+    vessel_type = rng.choice([30, 31, 52, 60, 70, 71, 80, 84, 1019], vessels)
+    status = rng.choice([0, 0, 0, 0, 1, 3, 5, 8], vessels)
+    transceiver = rng.choice(["A", "A", "A", "B"], vessels)
+    mmsi = np.array([str(m) for m in 366000000 + rng.choice(1000000, vessels, replace=False)])
+
+    # Times are written as text once per second of the day, rather than once per broadcast
+    clock = pd.date_range(date, periods=86400, freq="s").strftime("%Y-%m-%dT%H:%M:%S").to_numpy()
+
+    frame = pd.DataFrame({"MMSI": mmsi[boat],
+                          "BaseDateTime": clock[seconds],
+                          "LAT": np.round(lat, 5),
+                          "LON": np.round(lon, 5),
+                          "SOG": np.round(knots[boat] + rng.normal(0, 0.3, boat.size), 1),
+                          "COG": np.round(np.degrees(heading[boat]) % 360, 1),
+                          "Heading": np.round(np.degrees(heading[boat]) % 360).astype(int),
+                          "VesselName": np.char.add("SYNTHETIC ", boat.astype(str)),
+                          "IMO": np.char.add("IMO", (9000000 + boat).astype(str)),
+                          "CallSign": np.char.add("SYN", boat.astype(str)),
+                          "VesselType": vessel_type[boat],
+                          "Status": status[boat],
+                          "Length": pd.array(length[boat], dtype="Int64"),
+                          "Width": pd.array(np.round(length[boat] / 6), dtype="Int64"),
+                          "Draft": np.round(length[boat] / 25, 1),
+                          "Cargo": vessel_type[boat],
+                          "TransceiverClass": transceiver[boat]}, columns=noaa_columns)
+
+    # NOAA's files are in time order, which the streaming reads rely on
+    return frame.iloc[np.argsort(seconds, kind="stable")].reset_index(drop=True)
+
+
+def write_day_zip(frame, folder, date="2020-01-01"):
+    """
+    Returns
+    -------
+    Path of the zip, named like NOAA's (EX: AIS_2020_01_01.zip) and holding AIS_2020_01_01.csv
+        The zip's timestamp is fixed, so the same frame always makes the same bytes
+    """
+
+    name = "AIS_" + date.replace("-", "_")
+    path = os.path.join(folder, name + ".zip")
+    os.makedirs(folder, exist_ok=True)
+
+    member = ZipInfo(name + ".csv", date_time=(2020, 1, 1, 0, 0, 0))
+    member.compress_type = ZIP_DEFLATED
+
+    with ZipFile(path + ".tmp", "w") as z:
+        z.writestr(member, frame.to_csv(index=False))
+
+    os.replace(path + ".tmp", path)
+
+    return path
+
+
+
+
+#########################
+### Timing the Stages ###
+#########################
+
+'''
+Each stage is timed in a process of its own, so its peak memory belongs to that stage alone. The filtering
+script is loaded into that process before the clock starts, so reading the boundaries isn't timed.
+
+    bridges_memory    filter_bridges reading the whole zip at once
+    bridges_stream    filter_bridges streaming the zip in chunks, the way the job runs
+    ports             filter_ports reading the whole zip at once
+    pipeline          filter_bridges streaming the zip, then write_batch writing every bridge's csv file
+
+Rows per second counts every broadcast in the file. Segments per second counts every pair of consecutive
+broadcasts from the same boat in the file, before any mask, so the numbers from two versions of the script
+can be compared directly.
+
+The output of every stage is compared with the same stage run by the reference version of the script. Rows are
+compared in any order, since a faster method can find the same crossings in a different order.
+
+By default the reference is the baseline, the first commit of the repository. The baseline's filter_bridges puts
+each bridge's rows on a queue in its global queues dictionary instead of returning them, and it can't stream a
+file, so both bridge stages read it whole. Its filter_ports writes straight to a fixed folder, so the ports stage has
+nothing to compare with it. It also reads its spreadsheets from GitHub, so its copy is pointed at the same
+spreadsheets in geometry_folder as filtering_script, and the comparison runs offline with the same boundaries.
+
+While there is a reference, filtering_script runs with comparison_settings, which turn off what the reference
+doesn't do (EX: track cleaning), and it's timed with the same settings. They're saved with the results.
+'''
+
+# WARNING!!!
+# Adjust this to a scratch folder. The synthetic zips and the benchmark results are saved here
+# WARNING!!!
+
+bench_folder = '/home/{your jhed}/scr4_mshiel10/{your usename}/Benchmark/'
+
+# The version of the filtering script being measured
+filtering_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Advanced_AIS_Filtering_via_Intersections.py')
+
+# The version it's compared with: "baseline" for the first commit, or a git revision of the same file (EX: "HEAD~3")
+    # Or a path to another copy of the script, or None to skip the comparison
+    # A reference that's the same as filtering_script is refused, since matching itself proves nothing
+reference_version = "baseline"
+
+# Settings of the filtering script that are changed while it's compared with the reference
+    # Track cleaning drops repeated broadcasts (and the synthetic repeats differ in SOG), which the reference keeps
+comparison_settings = {"use_track_cleaning": False}
+
+# The stages to time
+bench_stages = ["bridges_memory", "bridges_stream", "ports", "pipeline"]
+
+# Each stage is run this many times, and the fastest time is kept
+bench_repeats = 3
+
+# Scripts are only loaded once per process
+loaded_scripts = {}
+
+
+def load_filtering(path):
+    # The filtering script at path, imported as a module without running its __main__ block
+    if path not in loaded_scripts:
+        spec = importlib.util.spec_from_file_location("filtering_" + str(len(loaded_scripts)), path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        loaded_scripts[path] = module
+
+    return loaded_scripts[path]
+
+
+def local_sheets(text, folder=geometry_folder):
+    # Older versions read the spreadsheets from GitHub at import. They're pointed at the same spreadsheets as
+        # filtering_script instead, so the reference runs offline and with the same boundaries
+    sheets = {"Bridge_Boundaries.xlsx": AIS_Boundary_Geometry.geometry_sources["bridges"][0],
+              "Port_Boundaries.xlsx": AIS_Boundary_Geometry.geometry_sources["ports"][0]}
+
+    def local(match):
+        name = match.group(1).decode()
+        return repr(os.path.join(folder, sheets.get(name, name))).encode()
+
+    return re.sub(rb'"https://raw\.githubusercontent\.com/[^"]*/([^"/]+\.xlsx)"', local, text)
+
+
+def reference_script(version=reference_version, folder=bench_folder):
+    """
+    Returns
+    -------
+    Path to the reference copy of the filtering script, or None if there isn't one
+        A git revision is saved to folder, so it can be loaded like any other file
+
+    Raises
+    ------
+    ValueError if the reference is the same as filtering_script, since the comparison would always pass
+    """
+
+    if version is None:
+        return version
+
+    if os.path.exists(version):
+        path = version
+    else:
+        repository = os.path.dirname(os.path.abspath(filtering_script))
+        name = os.path.basename(filtering_script)
+
+        # The first commit, from before any of the changes being measured
+        if version == "baseline":
+            version = subprocess.run(["git", "rev-list", "--max-parents=0", "HEAD"], cwd=repository, capture_output=True, check=True,
+                                     text=True).stdout.split()[-1]
+
+        text = local_sheets(subprocess.run(["git", "show", f"{version}:{name}"], cwd=repository, capture_output=True, check=True).stdout)
+
+        path = os.path.join(folder, "reference_" + re.sub(r"\W", "_", version) + ".py")
+        with open(path, "wb") as f:
+            f.write(text)
+
+    # Line endings are left out, since git can check a file out with different ones than it stores
+    with open(path, "rb") as f, open(filtering_script, "rb") as g:
+        if f.read().replace(b"\r\n", b"\n") == g.read().replace(b"\r\n", b"\n"):
+            raise ValueError(f"The reference {version} is the same as {filtering_script}, so the output would always match."
+                             " Compare with an older revision (EX: \"baseline\") or another copy of the script")
+
+    return path
+
+
+def bridge_crossings(module, member, chunksize=None):
+    # filter_bridges' output from any version of the script, as a Dictionary of the form Bridge: Data Frame
+    if "chunksize" in inspect.signature(module.filter_bridges).parameters:
+        return module.filter_bridges(member, chunksize=chunksize)
+
+    # The baseline puts each bridge's rows on its queue, and can only read the whole file
+    module.queues = {bridge: queue.Queue() for bridge in module.bridge_lines}
+    results = module.filter_bridges(member)
+    if results is not None:
+        return results
+
+    # It also hands over an empty frame for every bridge nothing crossed, which the later versions leave out
+    results = {bridge: rows.get() for bridge, rows in module.queues.items() if not rows.empty()}
+    return {bridge: frame for bridge, frame in results.items() if len(frame)}
+
+
+def run_stage(module, stage, zip_path, folder):
+    # Runs one stage on the zip, returning its output as a Dictionary of Data Frames
+        # None if this version of the script can't run the stage without writing outside folder
+    with ZipFile(zip_path) as z:
+        member = z.open(os.path.basename(zip_path)[:-4] + ".csv")
+
+        if stage == "bridges_memory":
+            return bridge_crossings(module, member)
+        if stage == "bridges_stream":
+            return bridge_crossings(module, member, chunksize=getattr(module, "stream_chunksize", None))
+        if stage == "ports":
+            # The baseline's filter_ports (the one without default boundaries) writes every port to a fixed folder
+            if inspect.signature(module.filter_ports).parameters["boundaries"].default is inspect.Parameter.empty:
+                return None
+            return module.filter_ports(member)
+
+        if stage == "pipeline":
+            results = bridge_crossings(module, member, chunksize=getattr(module, "stream_chunksize", None))
+
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder)
+            for bridge, frame in results.items():
+                if hasattr(module, "write_batch"):
+                    module.write_batch(folder, bridge, [frame], [os.path.basename(zip_path)[:-4]])
+                else:
+                    # What the baseline's writer does with a bridge's rows
+                    frame.to_csv(os.path.join(folder, bridge + ' Data.csv'), index=False, mode="a")
+
+            # What was written is read back, so the files themselves are compared
+            return {name: pd.read_csv(os.path.join(folder, name), dtype=str) for name in sorted(os.listdir(folder))}
+
+    raise ValueError(f"Unknown stage {stage}, pick from {bench_stages}")
+
+
+def timed_stage(task):
+    """
+    Runs in a fresh worker process: task is (script, stage, zip path, output folder, settings)
+        settings is a Dictionary of the form Setting: Value, set in the script before the stage runs
+
+    Returns
+    -------
+    seconds : how long the stage took
+
+    peak : the most bytes of memory the process used at once
+
+    grown : how many bytes the process grew by while running the stage
+
+    output : the stage's output, from run_stage
+    """
+
+    script, stage, zip_path, folder, settings = task
+    module = load_filtering(script)
+
+    for name, value in settings.items():
+        setattr(module, name, value)
+
+    start = resident_memory()
+    began = time.perf_counter()
+    output = run_stage(module, stage, zip_path, folder)
+    seconds = time.perf_counter() - began
+
+    return seconds, peak_memory(), max(peak_memory() - start, 0), output
+
+
+def measure(script, stage, zip_path, folder, repeats=bench_repeats, settings=None):
+    # The fastest time, the highest peak memory, and the output of a stage over several runs
+    runs = []
+    for _ in range(repeats):
+        # Every run gets a fresh process, so no run starts with memory left over from the last one
+        with mlt.Pool(1) as pool:
+            runs.append(pool.apply(timed_stage, ((script, stage, zip_path, folder, settings or {}),)))
+
+    return {"seconds": min(r[0] for r in runs), "peak": max(r[1] for r in runs), "grown": max(r[2] for r in runs)}, runs[-1][3]
+
+
+def same_output(a, b):
+    """
+    Returns
+    -------
+    True if both Dictionaries of Data Frames have the same structures, and the same rows for each in any order
+    """
+
+    if a.keys() != b.keys():
+        return False
+
+    def rows(frame):
+        lines = frame.to_csv(index=False).splitlines()
+        return lines[:1] + sorted(lines[1:])
+
+    return all(rows(a[name]) == rows(b[name]) for name in a)
+
+
+
+
+###########################
+### Running a Benchmark ###
+###########################
+
+def benchmark(settings=synthetic_day_settings, stages=bench_stages, folder=bench_folder, reference=reference_version, repeats=bench_repeats):
+    """
+    Returns
+    -------
+    Dictionary of the form Stage: Measurements, also saved to benchmark_results.json in folder
+        rows_per_second, segments_per_second, peak_mb, grown_mb : for the filtering script being measured
+        reference_seconds, speedup, same_output : compared with the reference, if there is one
+    """
+
+    os.makedirs(folder, exist_ok=True)
+
+    bridges, ports = load_geometry()
+    frame = synthetic_day(bridges, ports, **settings)
+    zip_path = write_day_zip(frame, folder, settings["date"])
+
+    rows = len(frame)
+    segments = rows - frame["MMSI"].nunique()
+    del frame
+
+    reference = reference_script(reference, folder)
+
+    # The script is measured the way it's compared, so the speedup is for the same work
+    changed = comparison_settings if reference is not None else {}
+
+    print(f"Synthetic day: {rows} broadcasts, {segments} segments, {os.path.getsize(zip_path) / 1e6:.1f} MB zipped", flush=True)
+
+    report = {}
+    for stage in stages:
+        stats, output = measure(filtering_script, stage, zip_path, os.path.join(folder, "output", ""), repeats, changed)
+
+        result = {"seconds": round(stats["seconds"], 3),
+                  "rows_per_second": round(rows / stats["seconds"]),
+                  "segments_per_second": round(segments / stats["seconds"]),
+                  "peak_mb": round(stats["peak"] / 1e6, 1),
+                  "grown_mb": round(stats["grown"] / 1e6, 1),
+                  "crossings": int(sum(len(f) for f in output.values()))}
+
+        if reference is not None:
+            reference_stats, reference_output = measure(reference, stage, zip_path, os.path.join(folder, "reference_output", ""), repeats)
+
+            # A stage the reference can't run is left out of the comparison, rather than counted as a match
+            if reference_output is not None:
+                result["reference_seconds"] = round(reference_stats["seconds"], 3)
+                result["speedup"] = round(reference_stats["seconds"] / stats["seconds"], 2)
+                result["same_output"] = same_output(output, reference_output)
+
+        report[stage] = result
+        print(stage, result, flush=True)
+
+    # Written to a temporary file first, then swapped into place so a crash never leaves half a file
+    with open(os.path.join(folder, "benchmark_results.json.tmp"), "w") as f:
+        json.dump({"settings": settings, "rows": rows, "segments": segments, "reference": reference, "changed": changed, "stages": report}, f, indent=1)
+    os.replace(os.path.join(folder, "benchmark_results.json.tmp"), os.path.join(folder, "benchmark_results.json"))
+
+    return report
+
+
+if __name__ == "__main__":
+    report = benchmark()
+
+    # A change that doesn't give the same crossings isn't a speedup, however fast it is
+    if any(stage.get("same_output") is False for stage in report.values()):
+        print("The output does NOT match the reference version", flush=True)
+        sys.exit(1)
@@ -0,0 +1,298 @@
+## Compiled boundary geometry, built from the spreadsheets in this repository
+
+# The filtering script used to read Port_Boundaries.xlsx and Bridge_Boundaries.xlsx from GitHub every time it was
+# imported, and so did every worker process that imported it again. This file reads the spreadsheets in this
+# repository once, and packs every structure's points into a single file of contiguous arrays. Every process then
+# maps that file into memory instead of parsing Excel, so starting a worker needs no network access, and every
+# worker on a node shares the same copy of the points.
+
+
+
+##########################
+### Importing Packages ###
+##########################
+
+import os
+import re
+import json
+import hashlib
+
+import pandas as pd
+import numpy as np
+
+
+
+
+##########################
+### Reading the Sheets ###
+##########################
+
+# Folder holding the spreadsheets, and the compiled file next to them
+geometry_folder = os.path.dirname(os.path.abspath(__file__))
+
+# Dictionary of the form Set Name: (Spreadsheet, Kind of Structure)
+    # Corrected_Bridge_Boundaries.xlsx is the checked copy of the bridges, and is used for all of the bridges
+    # Spreadsheets that aren't in the folder are left out
+geometry_sources = {"bridges": ("Corrected_Bridge_Boundaries.xlsx", "bridge"),
+                    "river_bridges": ("River_Bridge_Boundaries.xlsx", "bridge"),
+                    "ports": ("Port_Boundaries.xlsx", "port")}
+
+
+def boundary_points(row):
+    # Turn one spreadsheet row of x, y, x, y, ... into an array of points
+        # Rows can have different numbers of points, so blank cells at the end of a row are dropped
+    points = np.asarray(row, dtype=np.float64).reshape(-1, 2)
+    return points[~np.isnan(points).any(axis=1)]
+
+
+def close_ring(points):
+    # A port boundary has to end where it started, otherwise its last edge would be missing
+    if len(points) and not np.array_equal(points[0], points[-1]):
+        points = np.vstack([points, points[:1]])
+    return points
+
+
+def is_bridge_column(column):
+    # START_X, START_Y, any VERTEX_1_X, VERTEX_1_Y, ... in between, then END_X, END_Y
+    return re.fullmatch(r"(START|END|VERTEX_\d+)_[XY]", str(column)) is not None
+
+
+def bridge_column_order(column):
+    # The points of a bridge go from START, through its vertices in order, to END
+    point = column.rsplit('_', 1)[0]
+    if point == "START":
+        return (0, 0, column)
+    if point == "END":
+        return (2, 0, column)
+    return (1, int(point.split('_')[1]), column)
+
+
+def read_boundaries(path, kind):
+    """
+    Parameters
+    ----------
+    path : the spreadsheet to read
+
+    kind : "bridge" for a sheet of STRUCTURE_NAME, START_X, START_Y, (VERTEX_1_X, ...), END_X, END_Y
+        "port" for a sheet of a name, then a longitude and latitude column for every vertex
+
+    Returns
+    -------
+    Dictionary of the form Structure: Array of Points Defining the Structure
+        Each port boundary ends where it started
+    """
+
+    if kind == "bridge":
+        # Each bridge is defined by two or more points
+            # Bridges with a curve can list the points along it as VERTEX_1_X, VERTEX_1_Y, VERTEX_2_X, ... columns
+        data = pd.read_excel(path, header=0, index_col=0, usecols=lambda column: column == "STRUCTURE_NAME" or is_bridge_column(column))
+        data = data[sorted(data.columns, key=bridge_column_order)].apply(pd.to_numeric, errors="coerce")
+    else:
+        # A port can have as many vertices as it needs, the sheet just needs a longitude and latitude column for each
+        data = pd.read_excel(path, header=0, index_col=0)
+
+    rows = data.transpose().to_dict('list')
+
+    if kind == "bridge":
+        return {name: boundary_points(rows[name]) for name in rows}
+    return {name: close_ring(boundary_points(rows[name])) for name in rows}
+
+
+
+
+#############################
+### The Compiled Geometry ###
+#############################
+
+'''
+The compiled file (boundary_geometry.bin) holds every set of structures in geometry_sources:
+
+    8 bytes        AISGEOM and a zero byte, to recognize the file
+    8 bytes        the length of the header
+    header         json: the format version, the checksum of every spreadsheet it was built from, and for every
+                   set, its structure names and where its arrays are in the file
+    arrays         for every set, each one starting on a 64 byte boundary
+                       points   (number of points, 2) float64 of x, y for every point of every structure, in order
+                       starts   (number of structures + 1) int64, structure i is points[starts[i]:starts[i+1]]
+                       ids      (number of structures) int64, a number for each structure, unique across every set
+
+The file is rebuilt whenever a spreadsheet's checksum (or the format version) no longer matches the header, so
+editing a spreadsheet is all it takes to change the boundaries. If the spreadsheets aren't there at all, the file
+is used as it is, so it can be copied to a cluster on its own.
+
+Loading maps the file with np.memmap, and every array is a read only view into it, so nothing is copied. Pages
+of a mapped file are shared by every process that maps it, so however many workers a node runs (and whether they
+are forked or spawned), the points are only in memory once.
+'''
+
+geometry_file_name = 'boundary_geometry.bin'
+
+# Change this whenever the layout of the file changes, so older files are rebuilt
+geometry_version = 1
+
+geometry_magic = b"AISGEOM\0"
+geometry_alignment = 64
+
+# Dictionary of the form Path: Loaded Geometry, so each process only maps a file once
+loaded_geometry = {}
+
+
+def file_sha256(path):
+    # The SHA-256 of a spreadsheet
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def source_checksums(folder=geometry_folder):
+    # Dictionary of the form Set Name: Checksum of its spreadsheet, for every spreadsheet in folder
+    return {name: file_sha256(os.path.join(folder, sheet)) for name, (sheet, _) in geometry_sources.items()
+            if os.path.exists(os.path.join(folder, sheet))}
+
+
+def compile_geometry(folder=geometry_folder, path=None):
+    """
+    Parameters
+    ----------
+    folder : folder holding the spreadsheets
+
+    path : where to write the compiled file, next to the spreadsheets by default
+
+    Returns
+    -------
+    path, once every spreadsheet in folder is packed into it
+    """
+
+    path = os.path.join(folder, geometry_file_name) if path is None else path
+
+    header = {"version": geometry_version, "sources": source_checksums(folder), "sets": {}}
+    arrays = []
+    size = 0
+    next_id = 0
+
+    for name, (sheet, kind) in geometry_sources.items():
+        if name not in header["sources"]:
+            continue
+
+        boundaries = read_boundaries(os.path.join(folder, sheet), kind)
+        names = list(boundaries)
+
+        counts = [len(boundaries[structure]) for structure in names]
+        points = np.concatenate([boundaries[structure] for structure in names]) if names else np.empty((0, 2))
+
+        packed = {"points": np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 2),
+                  "starts": np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+                  "ids": np.arange(next_id, next_id + len(names), dtype=np.int64)}
+        next_id += len(names)
+
+        header["sets"][name] = {"kind": kind, "names": names, "arrays": {}}
+        for key, array in packed.items():
+            # Each array starts on a boundary, counted from the end of the header
+            size += -size % geometry_alignment
+            header["sets"][name]["arrays"][key] = {"offset": size, "shape": list(array.shape), "dtype": array.dtype.str}
+            arrays.append((size, array))
+            size += array.nbytes
+
+    encoded = json.dumps(header).encode("utf-8")
+    data_start = len(geometry_magic) + 8 + len(encoded)
+    data_start += -data_start % geometry_alignment
+
+    # Written to a temporary file first, then swapped into place so a crash (or another process compiling at the
+        # same time) never leaves half a file
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(geometry_magic)
+        f.write(len(encoded).to_bytes(8, "little"))
+        f.write(encoded)
+
+        for offset, array in arrays:
+            f.seek(data_start + offset)
+            f.write(array.tobytes())
+
+        # The file always ends at the end of its last array, even when that array is empty
+        f.truncate(data_start + size)
+
+    os.replace(temporary, path)
+
+    return path
+
+
+def read_header(path):
+    # The header of a compiled file, and where its arrays start, or None if it isn't a compiled file
+    with open(path, "rb") as f:
+        if f.read(len(geometry_magic)) != geometry_magic:
+            return None, None
+
+        length = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(length).decode("utf-8"))
+
+    data_start = len(geometry_magic) + 8 + length
+    return header, data_start + (-data_start % geometry_alignment)
+
+
+def load_geometry(folder=geometry_folder, path=None):
+    """
+    Parameters
+    ----------
+    folder : folder holding the spreadsheets
+
+    path : the compiled file, next to the spreadsheets by default
+
+    Returns
+    -------
+    Dictionary of the form Set Name: Dictionary holding
+        kind : "bridge" or "port"
+        names : list of structure names
+        points, starts, ids : read only arrays mapped from the file (see The Compiled Geometry)
+        The file is compiled first if it is missing or was built from different spreadsheets
+    """
+
+    path = os.path.join(folder, geometry_file_name) if path is None else path
+
+    if path in loaded_geometry:
+        return loaded_geometry[path]
+
+    sources = source_checksums(folder)
+    header, data_start = read_header(path) if os.path.exists(path) else (None, None)
+
+    # Only rebuilt when there are spreadsheets to build it from
+    if sources and (header is None or header["version"] != geometry_version or header["sources"] != sources):
+        compile_geometry(folder, path)
+        header, data_start = read_header(path)
+
+    if header is None:
+        raise FileNotFoundError(f"No compiled boundaries at {path}, and none of the spreadsheets in {folder} to build them from")
+
+    mapped = np.memmap(path, dtype=np.uint8, mode="r")
+
+    geometry = {}
+    for name, layout in header["sets"].items():
+        geometry[name] = {"kind": layout["kind"], "names": layout["names"]}
+
+        for key, array in layout["arrays"].items():
+            # A view into the mapped file, not a copy
+            geometry[name][key] = np.ndarray(array["shape"], dtype=np.dtype(array["dtype"]), buffer=mapped, offset=data_start + array["offset"])
+
+    loaded_geometry[path] = geometry
+
+    return geometry
+
+
+def boundary_set(geometry, name):
+    """
+    Returns
+    -------
+    Dictionary of the form Structure: Array of Points Defining the Structure, for one set of the geometry
+        Like bridge_lines and port_boxes, but every array is a view into the mapped file
+    """
+
+    structures = geometry[name]
+    points, starts = structures["points"], structures["starts"]
+
+    return {structure: points[starts[i]:starts[i + 1]] for i, structure in enumerate(structures["names"])}
+
+
+if __name__ == "__main__":
+    # Rebuild the compiled file by hand, EX: to copy it somewhere without the spreadsheets
+    print(f"Compiled {compile_geometry()}")
+    for name, structures in load_geometry().items():
+        print(f"    {name}: {len(structures['names'])} structures, {len(structures['points'])} points")
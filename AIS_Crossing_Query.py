@@ -0,0 +1,530 @@
+## Quick queries over the filtered crossings, by structure, time, and ship
+
+# Answering a question like "how many ships over 250 m passed the Francis Scott Key Bridge in Q3 2021" used to
+# mean pointing one of the plotting scripts at a folder and reading the bridge's whole csv file again. This file
+# builds an index of every structure's crossings once: one small array per column, sorted by time, saved next to
+# the crossings. A query maps those arrays into memory, finds the rows of its time window with a binary search,
+# and only tests (and reads) those rows, so a count or a typed data frame comes back in milliseconds.
+
+
+
+##########################
+### Importing Packages ###
+##########################
+
+import os
+import sys
+import json
+import hashlib
+from urllib.parse import quote, unquote
+
+import pandas as pd
+import numpy as np
+
+# The same vessel groups the aggregate cube counts by
+from AIS_Aggregate_Cube import cube_type_groups
+
+# The text format of the times in the csv files
+from AIS_Archive import noaa_time_format
+
+# Package for reading the columnar crossing store
+from AIS_Crossing_Store import read_crossings
+
+
+
+
+####################
+### Index Layout ###
+####################
+
+'''
+The index of an output folder is kept in {output folder}/_Query Index/, with a folder per structure:
+
+    {index folder}/{structure}/index.json        which build is current, and what it was built from
+    {index folder}/{structure}/{build}/Time.npy  when each crossing happened, sorted, as datetime64[s]
+    {index folder}/{structure}/{build}/*.npy     every other column in index_columns, in the same order
+
+Structure names are URL-quoted in the folder names, like in the crossing store. Each row is one crossing (or one
+port visit). A pair of broadcasts is one row, with the time and ship of the first broadcast, the same way the
+rankings and the aggregate cube count them.
+
+index.json holds the size and time every source file was last changed. A structure is only built again when one
+of them changed, so keeping the index up to date after a new month of data only reads the files that grew. Each
+build goes in a new folder and index.json is swapped to point at it last, so a query that is reading the old
+build while the new one is written never sees half of each.
+
+Numbers are stored as floats, with NaN where the csv had a blank, and a filter never matches a blank value. Rows
+whose time can't be read can't be put in a time window, so they are left out of the index.
+'''
+
+# Starts with an underscore, so reading the crossing store skips it when the index is kept inside the store
+index_folder_name = '_Query Index'
+
+# The files a structure's records are read from, and what each one holds
+    # " Data.csv" : pairs of broadcasts, " Events.csv" : crossing events, " Visits.csv" : port visits
+    # An output folder holds one kind of record, the same way the filtering writes them
+index_sources = {" Data.csv": "pairs", " Events.csv": "events", " Visits.csv": "visits"}
+
+# The column each kind of record is sorted by
+index_time_columns = {"pairs": "BaseDateTime", "events": "CrossingTime", "visits": "EnterTime"}
+
+# Dictionary of the form Column: Type it is stored as, for every column kept in the index
+    # Columns a kind of record doesn't have (EX: Direction for pairs) are left out of its index
+    # An MMSI that can't be read is stored as -1
+index_columns = {"MMSI": np.int64,
+                 "LAT": np.float64,
+                 "LON": np.float64,
+                 "SOG": np.float32,
+                 "COG": np.float32,
+                 "Direction": np.float32,
+                 "VesselName": str,
+                 "VesselType": np.float32,
+                 "Length": np.float32,
+                 "Width": np.float32,
+                 "Draft": np.float32,
+                 "Cargo": np.float32,
+                 "DwellHours": np.float32,
+                 "Broadcasts": np.float32}
+
+# Dictionary of the form Path to index.json: (Time it was last changed, Its Opened Build), so each build is only mapped once
+opened_indexes = {}
+
+
+def default_index_folder(output_folder):
+    return os.path.join(output_folder, index_folder_name)
+
+
+def structure_folder(index_folder, structure):
+    return os.path.join(index_folder, quote(str(structure), safe=" "))
+
+
+def source_key(paths):
+    # A key that changes whenever any of the files at paths change, from their sizes and the times they were last changed
+    hasher = hashlib.sha256()
+
+    for path in sorted(paths):
+        stat = os.stat(path)
+        hasher.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode("utf-8"))
+
+    return hasher.hexdigest()[:16]
+
+
+
+
+##########################
+### Building the Index ###
+##########################
+
+def index_sources_of(output_folder, store=False):
+    """
+    Parameters
+    ----------
+    output_folder : folder of csv files written by the filtering, or the columnar crossing store
+
+    store : If True, output_folder is the crossing store
+
+    Returns
+    -------
+    Dictionary of the form Structure: (Kind of Record, List of Files its records are read from)
+        The kind of the store's records is worked out once they are read
+    """
+
+    sources = {}
+
+    if store:
+        # Every file under each structure's bridge= folder of the store
+        for name in sorted(os.listdir(output_folder)):
+            if name.startswith("bridge="):
+                folder = os.path.join(output_folder, name)
+                files = [os.path.join(root, f) for root, _, names in os.walk(folder) for f in names if f.endswith(".parquet")]
+                sources[unquote(name[len("bridge="):])] = (None, files)
+        return sources
+
+    for name in sorted(os.listdir(output_folder)):
+        for suffix, kind in index_sources.items():
+            if name.endswith(suffix):
+                sources[name[:-len(suffix)]] = (kind, [os.path.join(output_folder, name)])
+
+    return sources
+
+
+def read_records(files, kind, structure=None, store_folder=None):
+    """
+    Returns
+    -------
+    kind, and a Data frame of the structure's records, one row per crossing (or port visit)
+        Repeated header rows from older csv files are dropped before the pairs are split up
+    """
+
+    if store_folder is not None:
+        frame = read_crossings(store_folder, bridges=[structure])
+        kind = "events" if "CrossingTime" in frame.columns else "pairs"
+    else:
+        # Everything is read as text, so a header row in the middle of the data can be found and dropped
+        wanted = set(index_columns) | set(index_time_columns.values())
+        frame = pd.read_csv(files[0], usecols=lambda column: column in wanted, dtype=str)
+        frame = frame.loc[frame[index_time_columns[kind]] != index_time_columns[kind]]
+
+    # The first row of every pair says when and which ship
+    if kind == "pairs":
+        frame = frame.iloc[0::2]
+
+    return kind, frame.reset_index(drop=True)
+
+
+def index_arrays(frame, kind):
+    """
+    Returns
+    -------
+    Dictionary of the form Column: Array, with Time and every column in index_columns the frame has, sorted by Time
+    """
+
+    time = pd.to_datetime(frame[index_time_columns[kind]], format=noaa_time_format, errors="coerce")
+    known = time.notna().to_numpy()
+
+    # A stable sort keeps crossings at the same second in the order they were written
+    order = np.flatnonzero(known)[np.argsort(time.to_numpy()[known], kind="stable")]
+
+    arrays = {"Time": time.to_numpy().astype("datetime64[s]")[order]}
+
+    for column, dtype in index_columns.items():
+        if column not in frame.columns:
+            continue
+
+        values = frame[column].iloc[order]
+
+        if dtype is str:
+            arrays[column] = values.fillna("").astype(str).to_numpy(dtype=str)
+        elif dtype is np.int64:
+            arrays[column] = pd.to_numeric(values, errors="coerce").fillna(-1).to_numpy(dtype=np.int64)
+        else:
+            arrays[column] = pd.to_numeric(values, errors="coerce").to_numpy(dtype=dtype, na_value=np.nan)
+
+    return arrays
+
+
+def build_structure(index_folder, structure, kind, files, store_folder=None):
+    """
+    Returns
+    -------
+    The structure's new index.json. Its arrays are saved in a new build folder first, and the old builds are
+        only removed once index.json points at the new one
+    """
+
+    folder = structure_folder(index_folder, structure)
+    key = source_key(files)
+
+    kind, frame = read_records(files, kind, structure, store_folder)
+    arrays = index_arrays(frame, kind)
+
+    # Each build gets its own folder, named after what it was built from
+    build = f"{key}-{os.getpid()}"
+    os.makedirs(os.path.join(folder, build), exist_ok=True)
+    for column, array in arrays.items():
+        np.save(os.path.join(folder, build, column + ".npy"), array)
+
+    entry = {"structure": structure, "kind": kind, "key": key, "build": build, "rows": int(arrays["Time"].size),
+             "columns": list(arrays)}
+
+    # Written to a temporary file first, then swapped into place so a query always finds a whole build
+    path = os.path.join(folder, "index.json")
+    with open(path + '.tmp', 'w') as f:
+        json.dump(entry, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+    # Older builds are only removed once nothing points at them
+        # A query that already mapped one keeps reading it, since a removed file stays readable while it is mapped
+    for name in os.listdir(folder):
+        if name != build and os.path.isdir(os.path.join(folder, name)):
+            for f in os.listdir(os.path.join(folder, name)):
+                os.remove(os.path.join(folder, name, f))
+            os.rmdir(os.path.join(folder, name))
+
+    return entry
+
+
+def build_index(output_folder, index_folder=None, store=False):
+    """
+    Parameters
+    ----------
+    output_folder : folder of csv files written by the filtering (data_folder, or port_folder), or the crossing store
+
+    index_folder : where to keep the index, {output folder}/_Query Index/ by default
+
+    store : If True, output_folder is the columnar crossing store
+
+    Returns
+    -------
+    List of the structures that were indexed again. Structures whose files haven't changed are skipped
+    """
+
+    index_folder = default_index_folder(output_folder) if index_folder is None else index_folder
+
+    rebuilt = []
+
+    for structure, (kind, files) in index_sources_of(output_folder, store).items():
+        if not files:
+            continue
+
+        path = os.path.join(structure_folder(index_folder, structure), "index.json")
+        if os.path.exists(path) and read_entry(path)["key"] == source_key(files):
+            continue
+
+        build_structure(index_folder, structure, kind, files, store_folder=output_folder if store else None)
+        rebuilt.append(structure)
+
+    return rebuilt
+
+
+
+
+##########################
+### Querying the Index ###
+##########################
+
+'''
+Every query takes the same filters, and a crossing is kept only if it passes all of them:
+
+    structures            list of bridges (or ports), every structure in the index by default
+    start, end            start <= Time < end, anything pd.Timestamp can read, EX: "2021-07-01"
+    longer_than           Length > longer_than, the same as the rankings
+    at_least, at_most     at_least <= Length <= at_most, the same as the histograms
+    width, draft          (low, high) with low <= value <= high, either side can be None
+    groups                list of vessel groups from cube_type_groups, or "Other" and "Unknown"
+    mmsi                  list of MMSIs
+
+The time window is found with a binary search of the sorted times, so only the rows inside it are ever read from
+the mapped arrays, and every other filter is tested on those rows alone.
+'''
+
+
+def read_entry(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def open_structure(index_folder, structure):
+    """
+    Returns
+    -------
+    Dictionary of the structure's index.json as "entry" and its build folder as "folder", or None if the structure
+        isn't in the index. Each column is mapped into it the first time it is used (see index_column)
+    """
+
+    folder = structure_folder(index_folder, structure)
+    path = os.path.join(folder, "index.json")
+
+    try:
+        changed = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    if path in opened_indexes and opened_indexes[path][0] == changed:
+        return opened_indexes[path][1]
+
+    entry = read_entry(path)
+    arrays = {"entry": entry, "folder": os.path.join(folder, entry["build"])}
+
+    opened_indexes[path] = (changed, arrays)
+
+    return arrays
+
+
+def index_column(arrays, column):
+    # A read only array mapped from one column of the structure's build, or None if the build doesn't have the column
+        # Only the columns a query uses are ever mapped
+    if column not in arrays and column in arrays["entry"]["columns"]:
+        arrays[column] = np.load(os.path.join(arrays["folder"], column + ".npy"), mmap_mode="r")
+    return arrays.get(column)
+
+
+def indexed_structures(index_folder):
+    # Every structure with a finished build in the index
+    return sorted(read_entry(os.path.join(index_folder, name, "index.json"))["structure"] for name in os.listdir(index_folder)
+                  if os.path.exists(os.path.join(index_folder, name, "index.json")))
+
+
+def to_seconds(moment):
+    # Any time pd.Timestamp can read, as datetime64[s] to search the index with
+    return None if moment is None else np.datetime64(pd.Timestamp(moment).tz_localize(None), "s")
+
+
+def in_range(values, low=None, high=None):
+    # low <= values <= high, with either side left open when it is None
+    keep = np.ones(values.size, dtype=bool)
+    if low is not None:
+        keep &= values >= low
+    if high is not None:
+        keep &= values <= high
+    return keep
+
+
+def group_mask(vessel_type, groups, type_groups=cube_type_groups):
+    # True for every ship in one of the groups, which are named the same way as in the aggregate cube
+    unknown = np.isnan(vessel_type)
+    named = np.zeros(vessel_type.size, dtype=bool)
+    keep = np.zeros(vessel_type.size, dtype=bool)
+
+    for name, (low, high) in type_groups.items():
+        inside = (low <= vessel_type) & (vessel_type < high)
+        named |= inside
+        if name in groups:
+            keep |= inside
+
+    if "Unknown" in groups:
+        keep |= unknown
+    if "Other" in groups:
+        keep |= ~unknown & ~named
+
+    return keep
+
+
+def select_rows(arrays, start=None, end=None, longer_than=None, at_least=None, at_most=None, width=None, draft=None, groups=None, mmsi=None):
+    """
+    Parameters
+    ----------
+    arrays : one structure's index, from open_structure
+
+    The rest are the filters described above
+
+    Returns
+    -------
+    first, last : the rows of the time window, index_column(arrays, column)[first:last]
+
+    keep : Array of bools saying which of those rows pass every other filter, or None if they all do
+    """
+
+    times = index_column(arrays, "Time")
+
+    # Binary search for the window, so none of the rows outside it are touched
+    first = 0 if start is None else int(np.searchsorted(times, to_seconds(start), side="left"))
+    last = times.size if end is None else int(np.searchsorted(times, to_seconds(end), side="left"))
+    last = max(first, last)
+
+    keep = None
+
+    def add(condition):
+        nonlocal keep
+        keep = condition if keep is None else (keep & condition)
+
+    def window(column):
+        # The rows of the window, all blank if the build doesn't have the column
+        values = index_column(arrays, column)
+        return np.full(last - first, np.nan, dtype=np.float32) if values is None else values[first:last]
+
+    if longer_than is not None:
+        add(window("Length") > longer_than)
+    if at_least is not None or at_most is not None:
+        add(in_range(window("Length"), at_least, at_most))
+
+    for column, bounds in [("Width", width), ("Draft", draft)]:
+        if bounds is not None:
+            add(in_range(window(column), *bounds))
+
+    if groups is not None:
+        add(group_mask(window("VesselType"), groups))
+    if mmsi is not None:
+        add(np.isin(window("MMSI"), np.asarray(list(mmsi), dtype=np.int64)))
+
+    return first, last, keep
+
+
+def count_crossings(index_folder, structures=None, by=("Structure",), **filters):
+    """
+    Parameters
+    ----------
+    index_folder : the index, from build_index
+
+    structures : list of the structures to count, every structure in the index by default
+
+    by : the columns to count by, any of "Structure", "Year", and "Month"
+
+    filters : any of the other filters described above, EX: longer_than=250, start="2021-07-01", end="2021-10-01"
+
+    Returns
+    -------
+    Series of the number of crossings (or port visits), indexed by the by columns
+        Counted by structure alone, every structure is in the Series, even without any crossings
+    """
+
+    structures = indexed_structures(index_folder) if structures is None else list(structures)
+    by = list(by)
+
+    counts = {}
+    times = []
+
+    for structure in structures:
+        arrays = open_structure(index_folder, structure)
+        if arrays is None:
+            counts[structure] = 0
+            continue
+
+        first, last, keep = select_rows(arrays, **filters)
+        counts[structure] = (last - first) if keep is None else int(np.count_nonzero(keep))
+
+        # Only the times of the kept rows are needed to count by year or month
+        if by != ["Structure"]:
+            window = index_column(arrays, "Time")[first:last]
+            times.append((structure, window if keep is None else window[keep]))
+
+    if by == ["Structure"]:
+        return pd.Series(counts, name="Trips", dtype=np.int64).rename_axis("Structure")
+
+    frame = pd.DataFrame({"Structure": np.repeat([s for s, _ in times], [t.size for _, t in times]),
+                          "Time": np.concatenate([t for _, t in times]) if times else np.empty(0, dtype="datetime64[s]")})
+    frame["Year"] = frame["Time"].dt.year
+    frame["Month"] = frame["Time"].dt.month
+
+    return frame.groupby(by).size().rename("Trips")
+
+
+def query_crossings(index_folder, structures=None, columns=None, **filters):
+    """
+    Parameters
+    ----------
+    index_folder : the index, from build_index
+
+    structures : list of the structures to read, every structure in the index by default
+
+    columns : list of the columns to return, every indexed column by default. Time is always returned
+
+    filters : any of the other filters described above
+
+    Returns
+    -------
+    Data frame of the matching crossings (or port visits), with a Structure column, in time order for each structure
+        Every column keeps the type it has in the index
+    """
+
+    structures = indexed_structures(index_folder) if structures is None else list(structures)
+
+    frames = []
+
+    for structure in structures:
+        arrays = open_structure(index_folder, structure)
+        if arrays is None:
+            continue
+
+        first, last, keep = select_rows(arrays, **filters)
+        rows = slice(first, last) if keep is None else first + np.flatnonzero(keep)
+
+        kept = ["Time"] + [c for c in (arrays["entry"]["columns"] if columns is None else columns) if c != "Time" and c in arrays["entry"]["columns"]]
+
+        # Copied out of the mapped arrays, so the frame stays valid after the index is rebuilt
+        frame = pd.DataFrame({column: np.array(index_column(arrays, column)[rows]) for column in kept})
+        frame.insert(0, "Structure", structure)
+        frames.append(frame)
+
+    if not frames:
+        return pd.DataFrame(columns=["Structure", "Time"] + ([] if columns is None else [c for c in columns if c != "Time"]))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+if __name__ == "__main__":
+    # EX: python AIS_Crossing_Query.py {output folder} [store]
+    output_folder = sys.argv[1]
+    rebuilt = build_index(output_folder, store=len(sys.argv) > 2 and sys.argv[2] == "store")
+
+    print(f"Indexed {len(rebuilt)} structures again, the rest haven't changed")
+    print(count_crossings(default_index_folder(output_folder)).sort_values(ascending=False).head(25).to_string())
@@ -0,0 +1,329 @@
+## Columnar store for filtered crossings
+
+# The filtering script used to append every bridge's crossings to "<bridge> Data.csv". Every value in those
+# files is text, so each analysis script had to re-parse everything (and throw out repeated header rows) just
+# to count a few columns. This file writes the same crossings as typed Parquet files instead, partitioned by
+# bridge and by year/month, so a script can read just the columns and partitions it needs.
+
+
+
+##########################
+### Importing Packages ###
+##########################
+
+import os
+import re
+from urllib.parse import quote
+
+import pandas as pd
+import numpy as np
+
+# Parquet support comes from pyarrow, which is only needed if the store is actually used
+    # pip install pyarrow
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+
+
+####################
+### Store Layout ###
+####################
+
+'''
+Every file in the store holds one structure's crossings from one daily AIS file:
+
+    {store folder}/bridge={structure}/year={YYYY}/month={M}/{daily file}.parquet
+
+This is the "hive" layout, so the folder names become the columns bridge, year, and month when the store is
+read, and a filter on any of them skips whole folders without opening a single file. Structure names are
+URL-quoted in the folder names, so names with odd characters are still safe.
+
+Since each file is named after the daily file it came from, filtering the same day again replaces its files
+instead of adding a second copy of its crossings. A day filtered again (EX: after the boundaries change) can have
+crossings in different structures or months than before, so every file it wrote before is removed first, even
+where it has no crossings anymore (see remove_sources).
+
+Crossings are stored either as pairs of rows, the AIS broadcast before and after the crossing next to each
+other, or as crossing events with one row per crossing (see crossing_events in the filtering script). Pairs and
+events have different columns, so keep them in separate stores. The same goes for a parameter sweep, whose
+crossings have an extra SweepMask column.
+'''
+
+# The type of every column
+    # Integer columns are nullable, and use 32 bits so an occasional garbage value still fits
+if pa is not None:
+    crossing_schema = pa.schema([("MMSI", pa.string()),
+                                 ("BaseDateTime", pa.timestamp("s")),
+                                 ("LAT", pa.float64()),
+                                 ("LON", pa.float64()),
+                                 ("SOG", pa.float64()),
+                                 ("COG", pa.float64()),
+                                 ("Heading", pa.int32()),
+                                 ("VesselName", pa.string()),
+                                 ("IMO", pa.string()),
+                                 ("CallSign", pa.string()),
+                                 ("VesselType", pa.int32()),
+                                 ("Status", pa.int32()),
+                                 ("Length", pa.int32()),
+                                 ("Width", pa.int32()),
+                                 ("Draft", pa.float64()),
+                                 ("Cargo", pa.int32()),
+                                 ("TransceiverClass", pa.string())])
+
+    # The type of every column of a crossing event
+    event_schema = pa.schema([("MMSI", pa.string()),
+                              ("CrossingTime", pa.timestamp("s")),
+                              ("LAT", pa.float64()),
+                              ("LON", pa.float64()),
+                              ("Direction", pa.int8()),
+                              ("SOG", pa.float64()),
+                              ("COG", pa.float64()),
+                              ("VesselName", pa.string()),
+                              ("IMO", pa.string()),
+                              ("CallSign", pa.string()),
+                              ("VesselType", pa.int32()),
+                              ("Status", pa.int32()),
+                              ("Length", pa.int32()),
+                              ("Width", pa.int32()),
+                              ("Draft", pa.float64()),
+                              ("Cargo", pa.int32()),
+                              ("TransceiverClass", pa.string())])
+
+    # Crossings from a parameter sweep also have the bits of every variant they pass (see sweep_tags)
+    sweep_field = pa.field("SweepMask", pa.int64())
+
+    store_partitioning = ds.partitioning(pa.schema([("bridge", pa.string()), ("year", pa.int32()), ("month", pa.int32())]), flavor="hive")
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("The crossing store needs pyarrow. Install it with: pip install pyarrow")
+
+
+def partition_folder(store_folder, structure, year, month):
+    return os.path.join(store_folder, "bridge=" + quote(str(structure), safe=" "), f"year={year}", f"month={month}")
+
+
+def source_partitions(source):
+    """
+    Returns
+    -------
+    Set of the (year, month) partitions a daily file can have crossings in, or None if its name has no date
+        A day's crossings are all on that day, except a stitched midnight's, which can start the day before
+    """
+
+    found = re.search(r"(\d{4})_(\d{2})_(\d{2})", source)
+    if found is None:
+        return None
+
+    day = pd.Timestamp(f"{found.group(1)}-{found.group(2)}-{found.group(3)}")
+    return {(d.year, d.month) for d in (day, day - pd.Timedelta(days=1))}
+
+
+def remove_sources(store_folder, sources, structures=None):
+    """
+    Parameters
+    ----------
+    store_folder : folder holding the store
+
+    sources : names of the daily files whose files should be removed, EX: ["AIS_2020_01_01"]
+
+    structures : the structures to remove them from, every structure in the store by default
+
+    Returns
+    -------
+    The number of files removed
+        Only the partitions each day can have crossings in are looked at, so the whole store is never walked
+    """
+
+    if not os.path.isdir(store_folder):
+        return 0
+
+    if structures is None:
+        folders = [os.path.join(store_folder, name) for name in os.listdir(store_folder) if name.startswith("bridge=")]
+    else:
+        folders = [os.path.join(store_folder, "bridge=" + quote(str(structure), safe=" ")) for structure in structures]
+
+    removed = 0
+
+    for source in sources:
+        partitions = source_partitions(source)
+
+        for folder in folders:
+            if partitions is None:
+                # Without a date in the name, every partition of the structure has to be looked at
+                paths = [os.path.join(root, source + ".parquet") for root, _, names in os.walk(folder) if source + ".parquet" in names]
+            else:
+                paths = [os.path.join(folder, f"year={y}", f"month={m}", source + ".parquet") for y, m in partitions]
+
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+                    removed += 1
+
+    return removed
+
+
+def is_events(frame):
+    # Crossing events have a single crossing time instead of the time of each broadcast
+    return "CrossingTime" in frame.columns
+
+
+def to_table(frame):
+    """
+    Parameters
+    ----------
+    frame : Data frame of crossing points or crossing events, in the column order written by the filtering script
+
+    Returns
+    -------
+    pyarrow Table with every column converted to its type in crossing_schema (or event_schema)
+        Plus SweepMask, if the frame has one
+    """
+
+    require_pyarrow()
+
+    frame = frame.copy()
+
+    # Older files spell the transceiver column TranscieverClass
+    if "TranscieverClass" in frame.columns and "TransceiverClass" not in frame.columns:
+        frame = frame.rename(columns={"TranscieverClass": "TransceiverClass"})
+
+    schema = event_schema if is_events(frame) else crossing_schema
+    time_column = "CrossingTime" if is_events(frame) else "BaseDateTime"
+
+    if "SweepMask" in frame.columns:
+        schema = schema.append(sweep_field)
+
+    frame[time_column] = pd.to_datetime(frame[time_column])
+
+    columns = {}
+    for field in schema:
+        values = frame[field.name] if field.name in frame.columns else pd.Series([None] * len(frame), dtype=object)
+
+        if pa.types.is_integer(field.type):
+            values = pd.to_numeric(values, errors="coerce").astype("Int64")
+        elif pa.types.is_floating(field.type):
+            values = pd.to_numeric(values, errors="coerce").astype("float64")
+        elif pa.types.is_string(field.type):
+            values = values.astype(object).where(values.notna(), None)
+
+        columns[field.name] = pa.array(values, type=field.type, from_pandas=True)
+
+    return pa.table(columns, schema=schema)
+
+
+def write_crossings(store_folder, structure, frame, source):
+    """
+    Parameters
+    ----------
+    store_folder : folder holding the store
+
+    structure : name of the bridge (or port) that was crossed
+
+    frame : Data frame of crossing points, with the two points of each crossing next to each other
+        Or a Data frame of crossing events, with one row per crossing
+
+    source : name of the daily file the crossings came from, EX: AIS_2020_01_01
+
+    Returns
+    -------
+    None. One Parquet file is written (or overwritten) in each year/month partition the crossings fall in
+        Any other file source wrote for this structure before is removed, even if frame is empty
+    """
+
+    require_pyarrow()
+
+    # A partition the day no longer has crossings in would otherwise keep its old ones
+    remove_sources(store_folder, [source], structures=[structure])
+
+    if frame.empty:
+        return
+
+    table = to_table(frame)
+
+    if is_events(frame):
+        # Each event goes in the partition of its crossing time
+        first = pd.to_datetime(frame["CrossingTime"]).reset_index(drop=True)
+    else:
+        # Both points of a crossing go in the partition of the first point, so a pair is never split up
+        times = pd.to_datetime(frame["BaseDateTime"]).reset_index(drop=True)
+        first = times.iloc[0::2].repeat(2).reset_index(drop=True).iloc[:len(times)]
+
+    year = first.dt.year.to_numpy()
+    month = first.dt.month.to_numpy()
+
+    for y, m in sorted(set(zip(year.tolist(), month.tolist()))):
+        rows = np.flatnonzero((year == y) & (month == m))
+
+        folder = partition_folder(store_folder, structure, y, m)
+        os.makedirs(folder, exist_ok=True)
+
+        # Write to a hidden temporary file and swap it into place, so a crash never leaves half a file in the store
+        path = os.path.join(folder, source + ".parquet")
+        temporary = os.path.join(folder, "." + source + ".parquet.tmp")
+        pq.write_table(table.take(rows), temporary)
+        os.replace(temporary, path)
+
+    return
+
+
+def store_dataset(store_folder):
+    """
+    Returns
+    -------
+    pyarrow Dataset over every file in the store, with bridge, year, and month as columns
+    """
+
+    require_pyarrow()
+
+    return ds.dataset(store_folder, format="parquet", partitioning=store_partitioning,
+                      exclude_invalid_files=True, ignore_prefixes=[".", "_"])
+
+
+def read_crossings(store_folder, columns=None, bridges=None, years=None, months=None, longer_than=None, where=None):
+    """
+    Parameters
+    ----------
+    store_folder : folder holding the store
+
+    columns : list of the columns to read, or None for every column
+        Only these columns are ever read from disk. bridge, year, and month come from the folder names for free
+
+    bridges, years, months : lists of the partitions to read, or None for all of them
+        Partitions that don't match are skipped without being opened
+
+    longer_than : only read crossings by ships longer than this (meters)
+
+    where : any other pyarrow expression to filter on, EX: ds.field("VesselType") == 70
+
+    Returns
+    -------
+    Data frame of the matching crossings
+    """
+
+    require_pyarrow()
+
+    expression = None
+
+    def add(condition):
+        nonlocal expression
+        expression = condition if expression is None else (expression & condition)
+
+    if bridges is not None:
+        add(ds.field("bridge").isin(list(bridges)))
+    if years is not None:
+        add(ds.field("year").isin([int(y) for y in years]))
+    if months is not None:
+        add(ds.field("month").isin([int(m) for m in months]))
+    if longer_than is not None:
+        add(ds.field("Length") > longer_than)
+    if where is not None:
+        add(where)
+
+    return store_dataset(store_folder).to_table(columns=columns, filter=expression).to_pandas()
@@ -0,0 +1,677 @@
+## Download cache for the NOAA daily AIS zip files
+
+# Every run of Advanced_AIS_Filtering_via_Intersections.py used to download every file again, even when only
+# the filtering changed. This file keeps one copy of each zip on scratch disk so later runs read it from there.
+
+
+
+##########################
+### Importing Packages ###
+##########################
+
+import os
+import json
+import time
+import random
+import hashlib
+import zipfile
+import threading
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+
+# Packages for interfacing with internet
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+
+
+
+###########################
+### How the Cache Works ###
+###########################
+
+'''
+The cache is content addressed. Each finished zip is stored once under the SHA-256 of its bytes:
+
+    {cache folder}/objects/{sha256}.zip
+
+Each URL gets a small record that points at the object it downloaded to, along with the size and checksum:
+
+    {cache folder}/urls/{sha1 of the url}.json
+
+A download that is interrupted leaves its bytes behind in:
+
+    {cache folder}/partial/{sha1 of the url}.part
+
+The next attempt asks the server for only the missing bytes (an HTTP Range request) and appends them, rather
+than starting over. Once the size matches what the server reported, the checksum is computed, the file is moved
+into objects/, and the record is written. The move and the record are both atomic, so a half written zip is
+never mistaken for a finished one.
+
+When the server doesn't report a size, the size can't say whether the download finished. The file is then only
+kept once it opens as a zip and every member passes its CRC check, since a cut off zip loses the directory at
+its end.
+'''
+
+# Bytes read from the network (and from disk while hashing) at a time
+download_chunk_size = 8 * 1024 * 1024
+
+# Seconds to wait on a stalled connection before giving up
+download_timeout = 600
+
+
+def url_key(url):
+    """
+    Returns
+    -------
+    The name used for a URL's record and partial download
+    """
+
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
+def file_sha256(path):
+    """
+    Returns
+    -------
+    The SHA-256 of a file on disk, read in chunks so the whole file is never held in memory
+    """
+
+    hasher = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(download_chunk_size), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def cache_record(url, cache_folder):
+    """
+    Returns
+    -------
+    The record of a URL's cached download as a dictionary, or None if the URL has never finished downloading
+    """
+
+    path = os.path.join(cache_folder, "urls", url_key(url) + ".json")
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def zip_complete(path):
+    """
+    Returns
+    -------
+    True if the file opens as a zip and every member's CRC checks out
+    """
+
+    try:
+        with zipfile.ZipFile(path) as z:
+            return z.testzip() is None
+    except (zipfile.BadZipFile, EOFError, OSError):
+        return False
+
+
+def write_record(url, cache_folder, record):
+    # Write to a temporary file first, then swap it into place so a crash never leaves half a record
+    folder = os.path.join(cache_folder, "urls")
+    os.makedirs(folder, exist_ok=True)
+
+    path = os.path.join(folder, url_key(url) + ".json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(record, f)
+
+    os.replace(path + ".tmp", path)
+
+
+def download_to_cache(url, cache_folder):
+    """
+    Parameters
+    ----------
+    url : link to the file to download
+
+    cache_folder : folder holding the cache
+
+    Returns
+    -------
+    Path of the finished, verified zip inside the cache
+
+    Raises
+    ------
+    IOError if the connection ends before the whole file arrives, or the server gives no size and the file
+        isn't a complete zip
+        The bytes that did arrive are kept, and the next call resumes from them
+    """
+
+    partial_folder = os.path.join(cache_folder, "partial")
+    object_folder = os.path.join(cache_folder, "objects")
+    os.makedirs(partial_folder, exist_ok=True)
+    os.makedirs(object_folder, exist_ok=True)
+
+    part = os.path.join(partial_folder, url_key(url) + ".part")
+
+    # Resume from whatever a previous attempt left behind
+    have = os.path.getsize(part) if os.path.exists(part) else 0
+
+    headers = {"Range": f"bytes={have}-"} if have else {}
+
+    try:
+        response = urlopen(Request(url, headers=headers), timeout=download_timeout)
+    except HTTPError as e:
+        if e.code != 416 or not have:
+            raise
+
+        # 416 means the range asked for doesn't exist. That's expected when the partial file already holds
+            # every byte (the last attempt stopped after the body, before the move), so compare it with the
+            # server's size first. The 416 carries the size as: bytes */{total}
+        size = e.headers.get("Content-Range", "").rpartition("/")[2]
+        if (size.isdigit() and int(size) == have) or (not size.isdigit() and zip_complete(part)):
+            return store_download(url, cache_folder, part, file_sha256(part))
+
+        # Otherwise the partial file can't be trusted. Start over.
+        os.remove(part)
+        return download_to_cache(url, cache_folder)
+
+    with response:
+        total = None
+
+        if have and response.status == 206:
+            # The server honored the range, so keep the bytes we already have
+                # Content-Range looks like: bytes {first}-{last}/{total}
+            content_range = response.headers.get("Content-Range", "")
+            first, _, size = content_range.replace("bytes ", "").partition("/")
+
+            if not first.startswith(f"{have}-"):
+                raise IOError(f"Server resumed {url} at the wrong position ({content_range})")
+            if size.isdigit():
+                total = int(size)
+
+            mode = "ab"
+        else:
+            # Either this is a fresh download or the server ignored the range, so start from the beginning
+            have = 0
+            mode = "wb"
+
+            length = response.headers.get("Content-Length")
+            if length is not None and length.isdigit():
+                total = int(length)
+
+        hasher = hashlib.sha256()
+
+        # Bytes kept from the previous attempt still count towards the checksum
+        if have:
+            with open(part, "rb") as f:
+                for chunk in iter(lambda: f.read(download_chunk_size), b""):
+                    hasher.update(chunk)
+
+        with open(part, mode) as f:
+            for chunk in iter(lambda: response.read(download_chunk_size), b""):
+                f.write(chunk)
+                hasher.update(chunk)
+
+    size = os.path.getsize(part)
+
+    # The partial file is kept so that the next attempt can pick up where this one stopped
+    if total is not None and size != total:
+        raise IOError(f"Download of {url} stopped at {size} of {total} bytes")
+    if total is None and not zip_complete(part):
+        raise IOError(f"Download of {url} stopped at {size} bytes, the server gave no size and the zip is incomplete")
+
+    return store_download(url, cache_folder, part, hasher.hexdigest())
+
+
+def store_download(url, cache_folder, part, sha256):
+    """
+    Moves a finished partial file into objects/ under its checksum and writes the URL's record
+
+    Returns
+    -------
+    Path of the zip inside the cache
+    """
+
+    size = os.path.getsize(part)
+    path = os.path.join(cache_folder, "objects", sha256 + ".zip")
+
+    # Identical content is only stored once
+    if os.path.exists(path):
+        os.remove(part)
+    else:
+        os.replace(part, path)
+
+    write_record(url, cache_folder, {"url": url, "size": size, "sha256": sha256})
+
+    return path
+
+
+def cached_zip_path(url, cache_folder, verify=False):
+    """
+    Parameters
+    ----------
+    url : link to the file, exactly as it appears in URLs
+
+    cache_folder : folder holding the cache
+
+    verify : If True, recompute the checksum of a cached file before trusting it
+        The size is always checked. The checksum reads the whole file, so it is off by default
+
+    Returns
+    -------
+    Path of the zip inside the cache, downloading (or resuming) it first if it isn't already there
+    """
+
+    record = cache_record(url, cache_folder)
+
+    if record is not None:
+        path = os.path.join(cache_folder, "objects", record["sha256"] + ".zip")
+
+        if os.path.exists(path):
+            if os.path.getsize(path) == record["size"] and (not verify or file_sha256(path) == record["sha256"]):
+                return path
+
+            # The cached file was damaged, so throw it away rather than keep handing it out
+            os.remove(path)
+
+    return download_to_cache(url, cache_folder)
+
+
+
+
+########################################
+### Prefetching Ahead of the Filters ###
+########################################
+
+'''
+Each worker used to download its own file before filtering it, so its core sat idle while it waited on the
+network, and the network sat idle while every core was busy testing segments. Instead, a few threads in the
+main process download the upcoming files into the cache, and a file is only handed to the filtering pool once
+it is already on disk. The workers then read it straight from the cache.
+
+Only a limited number of files (prefetch_window) wait on disk for a filter to start on them. The files being
+filtered hold a slot too, until their results come back, so the window is counted on top of the number of
+filters running at once: every core can be busy while prefetch_window more files wait for it, and the
+downloads never run far ahead and fill up scratch space with files the filters won't reach for hours.
+
+A download that fails is tried again after a wait that doubles each time, and a download that stopped part way
+resumes from the bytes it already has. If every attempt fails, the file is handed on anyway, and the worker
+tries once more (and reports the failure like any other).
+'''
+
+# The number of files downloading at the same time
+prefetch_connections = 4
+
+# The most files downloaded ahead of the filters, counting the ones downloading right now
+    # On top of the files the filters are working on, see running in prefetch
+prefetch_window = 8
+
+# The number of times a download is tried before it is handed on as failed
+download_attempts = 5
+
+# Seconds to wait after the first failed attempt, doubling after every attempt after that
+retry_seconds = 30
+
+
+def download_with_retries(url, cache_folder, attempts=download_attempts, wait=retry_seconds):
+    """
+    Returns
+    -------
+    Path of the zip inside the cache, like cached_zip_path
+
+    Raises
+    ------
+    The last error, if every attempt failed
+        A file the server says doesn't exist (EX: 404) isn't tried again, since it never will exist
+    """
+
+    for attempt in range(attempts):
+        try:
+            return cached_zip_path(url, cache_folder)
+        except HTTPError as e:
+            # Asking too often (429) or timing out (408) can pass, other client errors won't
+            if 400 <= e.code < 500 and e.code not in (408, 429):
+                raise
+            error = e
+        except OSError as e:
+            # Dropped connections, timeouts, and downloads that stopped part way
+            error = e
+
+        if attempt + 1 < attempts:
+            # A little randomness keeps every thread from retrying at the same moment
+            delay = wait * 2 ** attempt * random.uniform(0.5, 1.5)
+            print(f"Download of {url} failed ({error}), trying again in {delay:.0f} seconds", flush=True)
+            time.sleep(delay)
+
+    raise error
+
+
+def prefetch(urls, cache_folder, connections=prefetch_connections, window=prefetch_window, running=1, ordered=False, attempts=download_attempts, wait=retry_seconds):
+    """
+    Parameters
+    ----------
+    urls : every url to download, in the order they should be started
+
+    cache_folder : folder holding the cache
+
+    connections : the number of files downloading at once
+
+    window : the most files downloaded (or downloading) that no filter has started on yet
+
+    running : the most files the filters work on at once, EX: the number of processes in the pool
+        Files being filtered keep their slot until finished_with, so they are added on top of the window
+
+    ordered : If True, urls are handed out in the order given, instead of the order they finish downloading
+
+    attempts, wait : passed on to download_with_retries
+
+    Returns
+    -------
+    ready : generator of every url, each one once its zip is in the cache (or every attempt to download it failed)
+
+    finished_with : call this once for every url whose results came back, to let another download start
+    """
+
+    urls = list(urls)
+    slots = threading.BoundedSemaphore(max(window, 1) + max(running, 0))
+    downloaded = Queue()
+
+    def fetch(url):
+        try:
+            download_with_retries(url, cache_folder, attempts, wait)
+        except Exception as e:
+            print(f"Prefetching {url} failed, leaving it for the worker \n Error: {e}", flush=True)
+        downloaded.put(url)
+
+    def start_downloads(executor):
+        # Each download waits for a slot in the window before it starts
+        for url in urls:
+            slots.acquire()
+            executor.submit(fetch, url)
+        executor.shutdown(wait=False)
+
+    executor = ThreadPoolExecutor(max_workers=max(connections, 1))
+    threading.Thread(target=start_downloads, args=[executor], daemon=True).start()
+
+    def ready():
+        if not ordered:
+            for _ in urls:
+                yield downloaded.get()
+            return
+
+        # Hold on to the files that finished early, until every file before them has been handed out
+        finished = set()
+        for url in urls:
+            while url not in finished:
+                finished.add(downloaded.get())
+            finished.remove(url)
+            yield url
+
+    def finished_with():
+        try:
+            slots.release()
+        except ValueError:
+            # More results came back than files were downloaded (EX: a file that was never prefetched)
+            pass
+
+    return ready(), finished_with
+
+
+
+
+##########################################
+### Checking Against a Stand-In Server ###
+##########################################
+
+'''
+Running this file checks the cache and the prefetching against a small HTTP server on this machine, standing in
+for NOAA's. The server hands out made-up files, turns down the first request for some of them (503), cuts off
+the first download of another part way, and doesn't have one at all (404). Stand-in filters then take each file
+as it is handed out, a few at a time like the pool would, and the check fails unless
+
+    every file the server has ends up in the cache, with the same bytes, and the cut off one was resumed
+    the missing file is still handed on, so the worker reports it
+    no more than connections downloads ever ran at once
+    every filter was busy at once, so the window never held the filters back
+    no more than window files were ever downloaded (or downloading) on top of the ones being filtered
+
+It then checks the cache alone, on zips the server sends without a size, and fails unless
+
+    a cut off download with no size is refused, and resumed into the same bytes on the next attempt
+    a partial file that already holds every byte is kept when the server answers its range with a 416
+
+EX: python AIS_Download_Cache.py
+'''
+
+
+def stand_in_server(files, refuse=(), cut_off=(), no_size=(), delay=0.05):
+    """
+    Parameters
+    ----------
+    files : Dictionary of the form Path: Bytes, every file the server has, EX: {"/2020/AIS_2020_01_01.zip": b"..."}
+
+    refuse : paths whose first request is turned down with a 503
+
+    cut_off : paths whose first download stops half way
+
+    no_size : paths sent without Content-Length, and with * as the total in Content-Range
+
+    delay : seconds each response takes, so downloads overlap
+
+    Returns
+    -------
+    server : the running server, call server.shutdown() when done
+
+    seen : Dictionary holding every request as (path, Range header) under "requests", and the most requests
+        handled at once under "most"
+    """
+
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    seen = {"requests": [], "now": 0, "most": 0}
+    refuse, cut_off, no_size = set(refuse), set(cut_off), set(no_size)
+    lock = threading.Lock()
+
+    class StandIn(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            with lock:
+                seen["requests"].append((self.path, self.headers.get("Range")))
+                seen["now"] += 1
+                seen["most"] = max(seen["most"], seen["now"])
+            try:
+                self.respond()
+            finally:
+                with lock:
+                    seen["now"] -= 1
+
+        def respond(self):
+            time.sleep(delay)
+
+            if self.path not in files:
+                self.send_error(404)
+                return
+            if self.path in refuse:
+                refuse.discard(self.path)
+                self.send_error(503)
+                return
+
+            data = files[self.path]
+            start = int(self.headers["Range"][len("bytes="):].split("-")[0]) if self.headers.get("Range") else 0
+
+            # Nothing is left past the end of the file, so the range can't be served
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            total = "*" if self.path in no_size else len(data)
+
+            self.send_response(206 if start else 200)
+            if start:
+                self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{total}")
+            if self.path not in no_size:
+                self.send_header("Content-Length", str(len(data) - start))
+            self.end_headers()
+
+            # The connection closes after half the file, like a dropped download
+            if self.path in cut_off:
+                cut_off.discard(self.path)
+                self.wfile.write(data[start:start + (len(data) - start) // 2])
+                self.close_connection = True
+                return
+
+            self.wfile.write(data[start:])
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, seen
+
+
+def check_prefetch(count=16, connections=3, window=2, running=4, filter_seconds=0.2):
+    """
+    Returns
+    -------
+    Dictionary of the form Check: True if it passed, for every check described above
+    """
+
+    import tempfile
+    import shutil
+
+    rng = random.Random(0)
+    files = {f"/2020/AIS_2020_01_{day:02d}.zip": rng.randbytes(rng.randint(50_000, 400_000)) for day in range(1, count + 1)}
+    paths = sorted(files)
+
+    server, seen = stand_in_server(files, refuse=paths[1:3], cut_off=paths[3:4])
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    urls = [base + path for path in paths] + [base + "/2020/AIS_2020_02_30.zip"]
+
+    cache_folder = tempfile.mkdtemp()
+    lock = threading.Lock()
+    state = {"filtering": 0, "most filtering": 0, "waiting": 0, "most held": 0, "on disk first": True}
+
+    def stand_in_filter(url):
+        # Takes a file off the waiting count once it starts, like a worker would
+        with lock:
+            state["waiting"] -= 1
+            state["filtering"] += 1
+            state["most filtering"] = max(state["most filtering"], state["filtering"])
+            if url != urls[-1] and cache_record(url, cache_folder) is None:
+                state["on disk first"] = False
+        time.sleep(filter_seconds)
+        with lock:
+            state["filtering"] -= 1
+
+    def fetch_started(url, cache_folder, attempts, wait):
+        # Every download counts as waiting from the moment it starts, until a filter picks it up
+        with lock:
+            state["waiting"] += 1
+            state["most held"] = max(state["most held"], state["waiting"] + state["filtering"])
+        return download(url, cache_folder, attempts, wait)
+
+    global download_with_retries
+    download = download_with_retries
+    download_with_retries = fetch_started
+
+    try:
+        ready, finished_with = prefetch(urls, cache_folder, connections=connections, window=window, running=running, attempts=3, wait=0.05)
+
+        # Every ready file is handed over as it arrives, the same way imap_unordered reads ahead of the pool
+            # Each result makes room for another download as soon as it is back, like run_files
+        with ThreadPoolExecutor(max_workers=running) as pool:
+            futures = []
+            for url in ready:
+                futures.append(pool.submit(stand_in_filter, url))
+                futures[-1].add_done_callback(lambda future: finished_with())
+
+            for future in futures:
+                future.result()
+    finally:
+        download_with_retries = download
+        server.shutdown()
+
+    cached = [cache_record(url, cache_folder) for url in urls[:-1]]
+    same = all(record is not None and record["sha256"] == hashlib.sha256(files[path]).hexdigest() for record, path in zip(cached, paths))
+
+    checks = {"every file cached with the same bytes": same and len(futures) == len(urls),
+              "cut off download resumed": (paths[3], f"bytes={len(files[paths[3]]) // 2}-") in seen["requests"],
+              "refused downloads tried again": all(sum(p == path for p, _ in seen["requests"]) >= 2 for path in paths[1:3]),
+              "missing file handed on": cache_record(urls[-1], cache_folder) is None,
+              "files handed on once downloaded": state["on disk first"],
+              f"at most {connections} connections": seen["most"] <= connections,
+              f"all {running} filters busy at once": state["most filtering"] == running,
+              f"at most {window} files ahead of the filters": state["most held"] <= window + running}
+
+    shutil.rmtree(cache_folder, ignore_errors=True)
+
+    return checks
+
+
+def check_cache():
+    """
+    Returns
+    -------
+    Dictionary of the form Check: True if it passed, for every cache check described above
+    """
+
+    import io
+    import tempfile
+    import shutil
+
+    # Real zips this time, since a file without a size is only kept if it opens as one
+    rng = random.Random(1)
+    files = {}
+    for path in ["/2020/AIS_2020_03_01.zip", "/2020/AIS_2020_03_02.zip"]:
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as z:
+            z.writestr(os.path.basename(path).replace(".zip", ".csv"), rng.randbytes(200_000))
+        files[path] = buffer.getvalue()
+    cut, whole = sorted(files)
+
+    server, seen = stand_in_server(files, cut_off=[cut], no_size=files, delay=0)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    cache_folder = tempfile.mkdtemp()
+
+    try:
+        # The first attempt gets half the bytes with no size to compare them against
+        try:
+            download_to_cache(base + cut, cache_folder)
+            refused = False
+        except IOError:
+            refused = cache_record(base + cut, cache_folder) is None
+        download_to_cache(base + cut, cache_folder)
+
+        # Every byte is already in the partial file, as if the last attempt stopped just before the move
+        os.makedirs(os.path.join(cache_folder, "partial"), exist_ok=True)
+        with open(os.path.join(cache_folder, "partial", url_key(base + whole) + ".part"), "wb") as f:
+            f.write(files[whole])
+        download_to_cache(base + whole, cache_folder)
+    finally:
+        server.shutdown()
+
+    def same(path):
+        record = cache_record(base + path, cache_folder)
+        return record is not None and record["sha256"] == hashlib.sha256(files[path]).hexdigest()
+
+    checks = {"cut off download with no size refused": refused,
+              "cut off download with no size resumed": same(cut) and (cut, f"bytes={len(files[cut]) // 2}-") in seen["requests"],
+              "complete partial file kept on a 416": same(whole) and [r for p, r in seen["requests"] if p == whole] == [f"bytes={len(files[whole])}-"]}
+
+    shutil.rmtree(cache_folder, ignore_errors=True)
+
+    return checks
+
+
+if __name__ == "__main__":
+    checks = {**check_prefetch(), **check_cache()}
+    for name, passed in checks.items():
+        print(f"{'passed' if passed else 'FAILED'}  {name}")
+
+    if not all(checks.values()):
+        raise SystemExit(1)
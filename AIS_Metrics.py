@@ -0,0 +1,259 @@
+## Per-file stage timings and throughput for the download and filter workers
+
+# A job on the cluster only ever printed "Script Began" and the odd "File ... failed", so there was no way to tell
+# whether a day was slow because of the network, unzipping, parsing the csv, or testing the segments. Every
+# worker now times each stage of each file it filters, counts the bytes, rows, segments, and crossings, and
+# appends one line per file to a metrics log. Running this file summarizes a run: where the time went, and which
+# files and stages were the slowest.
+
+
+
+##########################
+### Importing Packages ###
+##########################
+
+import os
+import sys
+import json
+import time
+import socket
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import pandas as pd
+
+# The same measurements the scheduler makes of each file
+from AIS_Scheduler import resident_memory, peak_memory
+
+
+
+
+##########################
+### What Gets Recorded ###
+##########################
+
+'''
+Each file gets one record, a line of json in {metrics folder}/{run}/{worker}.jsonl. Every worker writes its own
+log, so the workers of a run (and the nodes of a split job) never write to the same file. A record holds
+
+    file, kind       the daily file, and whether it was filtered for "bridges" or "ports"
+    worker, run      the process that filtered it, EX: node12-48213, and the run it was part of
+    stages           Dictionary of the form Stage: Seconds, for the stages in metric_stages
+    seconds          the whole file, start to finish
+    bytes            the size of the zip (or archived day), csv_bytes the size of the csv inside it
+    rows             broadcasts read, rows_masked left after the vessel mask, rows_near left after the prefilter
+                     rows_late arrived while streaming older than the broadcast carried for their boat
+    segments         segments tested against the boundaries
+    crossings        crossings found
+    peak_rss         the most memory the worker has used at once, rss the memory it used at the end
+    error            what went wrong, if the file failed
+
+Timing a stage takes two calls to a clock, and stages are timed per file (or per streamed chunk), never per
+row, so the records can be left on for every run. Unzipping is timed inside the reads pandas makes from the zip,
+and parsing is the rest of the time spent reading.
+'''
+
+# The stages of a file, in the order they happen
+    # download : opening the zip, downloading it first if it isn't in the download cache
+    # decompress : unzipping the csv, parse : turning it into a data frame
+    # mask, prefilter, sort, intersect : the vessel mask, the track prefilter, compact_tracks, and find_crossings
+    # gather : building the output rows of the crossings
+    # write : writing the archived day, when ingesting
+metric_stages = ["download", "decompress", "parse", "mask", "prefilter", "sort", "intersect", "gather", "write"]
+
+# Every record of a job shares a run name
+    # SLURM gives every task of a job (or array job) the same id, otherwise workers inherit the time the job started
+run_name = os.environ.get("SLURM_ARRAY_JOB_ID") or os.environ.get("SLURM_JOB_ID") or datetime.now().strftime("%Y%m%d-%H%M%S")
+
+# The record of the file this process is filtering, or None between files
+    # Each worker process filters one file at a time, so one record per process is enough
+current = None
+
+
+def begin_file(name, kind):
+    # Start the record of a file. Until end_file, every stage and count is added to it
+    global current
+    current = {"file": name, "kind": kind, "run": run_name, "worker": f"{socket.gethostname()}-{os.getpid()}",
+               "started": datetime.now(timezone.utc).isoformat(timespec="seconds"), "stages": {}, "clock": time.perf_counter()}
+
+
+@contextmanager
+def stage(name):
+    # Adds the time spent inside the with block to the stage, when a file is being recorded
+    if current is None:
+        yield
+        return
+
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        current["stages"][name] = current["stages"].get(name, 0) + time.perf_counter() - began
+
+
+def count(name, n):
+    # Adds n to one of the counts of the file being recorded
+    if current is not None:
+        current[name] = current.get(name, 0) + int(n)
+
+
+def timed_reads(file):
+    """
+    Returns
+    -------
+    The same open file, with its reads timed as the decompress stage
+        pandas reads a zip member through read1, so both read and read1 are timed
+    """
+
+    for name in ("read", "read1"):
+        read = getattr(file, name, None)
+        if read is None:
+            continue
+
+        def timed(*args, _read=read, **kwargs):
+            with stage("decompress"):
+                return _read(*args, **kwargs)
+
+        setattr(file, name, timed)
+
+    return file
+
+
+def timed_chunks(reader):
+    # Yields the chunks of a pd.read_csv reader, timing each read as the read stage
+    while True:
+        with stage("read"):
+            chunk = next(reader, None)
+
+        if chunk is None:
+            return
+
+        count("rows", len(chunk))
+        yield chunk
+
+
+def end_file(folder, error=None):
+    """
+    Parameters
+    ----------
+    folder : the metrics folder, EX: {output folder}/Metrics/
+
+    error : what went wrong, if the file failed
+
+    Returns
+    -------
+    The finished record, which is also appended to this worker's log
+    """
+
+    global current
+    record, current = current, None
+
+    if record is None:
+        return None
+
+    record["seconds"] = round(time.perf_counter() - record.pop("clock"), 4)
+
+    # The read stage covers unzipping and parsing together, so parsing is what's left once unzipping is taken out
+    stages = record["stages"]
+    if "read" in stages:
+        stages["parse"] = max(stages.pop("read") - stages.get("decompress", 0), 0)
+    record["stages"] = {name: round(stages[name], 4) for name in metric_stages if name in stages}
+
+    record["peak_rss"] = peak_memory()
+    record["rss"] = resident_memory()
+    if error is not None:
+        record["error"] = str(error)
+
+    # One line per file, appended to a log only this worker writes to
+    path = os.path.join(folder, record["run"], record["worker"] + ".jsonl")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+    return record
+
+
+
+
+#########################
+### Summarizing a Run ###
+#########################
+
+def load_metrics(folder, run=None):
+    """
+    Returns
+    -------
+    Data frame with one row per file of the run, and one column per stage
+        The latest run in folder is used when run isn't given
+    """
+
+    if run is None:
+        runs = [name for name in os.listdir(folder) if os.path.isdir(os.path.join(folder, name))]
+        if not runs:
+            raise FileNotFoundError(f"No runs have been recorded in {folder}")
+        run = max(runs, key=lambda name: os.path.getmtime(os.path.join(folder, name)))
+
+    records = []
+    for name in sorted(os.listdir(os.path.join(folder, run))):
+        if name.endswith(".jsonl"):
+            with open(os.path.join(folder, run, name)) as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+
+    frame = pd.DataFrame(records)
+    stages = pd.DataFrame([r.get("stages", {}) for r in records], columns=metric_stages).fillna(0)
+
+    return pd.concat([frame.drop(columns="stages", errors="ignore"), stages], axis=1)
+
+
+def summarize(folder, run=None, top=10):
+    """
+    Prints where the time of a run went, its throughput, and its slowest files and stages
+
+    Returns
+    -------
+    Data frame of the run's records, from load_metrics
+    """
+
+    frame = load_metrics(folder, run)
+    stages = [s for s in metric_stages if frame[s].sum() > 0]
+
+    print(f"Run {frame['run'].iloc[0]}: {len(frame)} files on {frame['worker'].nunique()} workers", flush=True)
+    if "error" in frame:
+        print(f"{frame['error'].notna().sum()} files failed", flush=True)
+
+    # Where the time went, added up over every file
+    total = frame[stages].sum()
+    print("\nTime by stage (seconds, share of all stages)")
+    for name in stages:
+        print(f"    {name:<12}{total[name]:>12.1f}{total[name] / total.sum():>8.1%}")
+
+    # Throughput of the whole run, from the time the workers spent on files
+    seconds = frame["seconds"].sum()
+    for name, unit, scale in [("bytes", "MB", 1e6), ("csv_bytes", "MB of csv", 1e6), ("rows", "rows", 1), ("segments", "segments", 1)]:
+        if name in frame and seconds > 0:
+            print(f"{frame[name].sum() / scale / seconds:,.1f} {unit} per second per worker")
+    if "crossings" in frame:
+        print(f"{int(frame['crossings'].sum())} crossings found")
+    if "rows_late" in frame and frame["rows_late"].sum() > 0:
+        print(f"{int(frame['rows_late'].sum())} broadcasts arrived out of order while streaming, in {int((frame['rows_late'] > 0).sum())} files")
+
+    # The slowest files, and the stage that took most of each one's time
+    columns = [c for c in ["file", "seconds", "rows", "segments", "crossings"] if c in frame]
+    slowest = frame.nlargest(top, "seconds")[columns + stages].copy()
+    slowest["slowest stage"] = slowest[stages].idxmax(axis=1)
+    slowest["peak MB"] = (frame.loc[slowest.index, "peak_rss"] / 1e6).round(0)
+    print(f"\nSlowest {len(slowest)} files")
+    print(slowest[columns + ["slowest stage", "peak MB"]].to_string(index=False))
+
+    # The file that spent the longest in each stage
+    print("\nSlowest file in each stage")
+    for name in stages:
+        row = frame.loc[frame[name].idxmax()]
+        print(f"    {name:<12}{row[name]:>10.1f} s   {row['file']}")
+
+    return frame
+
+
+if __name__ == "__main__":
+    # EX: python AIS_Metrics.py {output folder}/Metrics/ [run name]
+    summarize(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
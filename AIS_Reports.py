@@ -0,0 +1,308 @@
+## Report generation for the bridge rankings, histograms, and box plots
+
+# Making the figures used to take longer than counting the crossings. Every bridge's PDF was drawn one after
+# another, and every bar of a ranking was its own plt.bar call. This file draws each chart with one call, draws
+# the PDFs in a pool of processes, and remembers what each figure was made from, so a figure whose numbers
+# haven't changed since the last run isn't drawn again.
+
+
+
+##########################
+### Importing Packages ###
+##########################
+
+import os
+import json
+import hashlib
+import multiprocessing as mlt
+
+import pandas as pd
+
+# Figures are only ever saved to files, so no window (or display) is needed
+    # This has to be picked before pyplot is imported
+import matplotlib
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+
+
+
+
+############################
+### Skipping Old Figures ###
+############################
+
+'''
+Every figure is made from a small set of numbers: a bridge's counts by year and size, or the daily trips of
+every bridge in a ranking. A hash of those numbers (the figure's "key") is saved in report_cache.json, next to
+the figures. The next run works out each figure's key again, and only draws the figures whose key changed or
+whose file is missing.
+
+When the numbers come from the aggregate cube, a key only changes if one of the bridge's counts did, so adding a
+month of data only redraws the bridges that were crossed that month. When they come from each bridge's csv file,
+the key is the file's size and time it was last changed, so a bridge's file isn't even read if it hasn't changed.
+'''
+
+report_cache_name = 'report_cache.json'
+
+# The number of processes drawing figures at once, every core by default
+report_processes = None
+
+
+def report_key(*parts):
+    """
+    Parameters
+    ----------
+    parts : everything a figure is made from, EX: Data frames of counts, lists of names, colors, and titles
+
+    Returns
+    -------
+    A short hash that changes whenever any of the parts change
+    """
+
+    hasher = hashlib.sha256()
+
+    for part in parts:
+        if isinstance(part, (pd.DataFrame, pd.Series)):
+            # The labels are hashed along with the values, so renaming a column changes the key too
+            hasher.update(pd.util.hash_pandas_object(part, index=True).to_numpy().tobytes())
+            labels = part.columns if isinstance(part, pd.DataFrame) else [part.name]
+            hasher.update(json.dumps([str(c) for c in labels]).encode("utf-8"))
+        else:
+            hasher.update(json.dumps(part, default=str).encode("utf-8"))
+
+    return hasher.hexdigest()[:16]
+
+
+def file_key(path):
+    # A csv file's key, from its size and when it was last changed, or None if it doesn't exist
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    return report_key(stat.st_size, stat.st_mtime_ns)
+
+
+def load_report_cache(folder):
+    """
+    Returns
+    -------
+    Dictionary of the form Figure Path: Key it was last drawn with
+    """
+
+    path = os.path.join(folder, report_cache_name)
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_report_cache(folder, cache):
+    # Write to a temporary file first, then swap it into place so a crash never leaves half a cache
+    os.makedirs(folder, exist_ok=True)
+
+    path = os.path.join(folder, report_cache_name)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=1)
+
+    os.replace(path + '.tmp', path)
+
+
+def is_current(cache, path, key):
+    # True if the figure at path exists and was drawn from the same numbers
+    return key is not None and cache.get(path) == key and os.path.exists(path)
+
+
+
+
+######################
+### Drawing Charts ###
+######################
+
+def bar_chart(names, values, colors, title, label_format=".2f", label_size="small", xlabel='Bridge Names', ylabel='Average Trips per Day', figsize=(20, 8)):
+    """
+    Parameters
+    ----------
+    names, values, colors : the name, height, and color of every bar, in order
+
+    title, xlabel, ylabel : labels of the chart
+
+    label_format : format of the value written on top of each bar
+
+    label_size : font size of the values on top of the bars
+
+    Returns
+    -------
+    The matplotlib figure, with every bar drawn in a single call
+    """
+
+    fig, ax = plt.subplots(figsize=figsize)
+
+    # One call draws every bar, and one more writes every value on top of its bar
+    bars = ax.bar(list(names), list(values), color=list(colors))
+    ax.bar_label(bars, labels=[f"{v:{label_format}}" for v in values], fontsize=label_size)
+
+    # Ensure each bridge name is readable by tilting them
+    ax.tick_params(axis="x", labelsize=10)
+    plt.setp(ax.get_xticklabels(), rotation=45, ha='right')
+
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+
+    fig.tight_layout()
+
+    return fig
+
+
+def ranking_pdf(path, traffic, colors, title, label_size="small", tops=(10, 25, 50)):
+    """
+    Parameters
+    ----------
+    path : where to save the PDF
+
+    traffic : List of (Bridge, Average Daily Trips), from most to least traffic
+
+    colors : Dictionary of the form Bridge: Color
+
+    title : title of the chart of the top n bridges, with {n} where the number of bridges goes
+        EX: "Top {n} Bridges for Ships above 300 m"
+
+    tops : a chart is made of the top n bridges for every n here
+
+    Returns
+    -------
+    path, once the PDF is saved
+    """
+
+    with PdfPages(path) as pdf:
+        for n in tops:
+            names = [b for b, _ in traffic[:n]]
+            values = [t for _, t in traffic[:n]]
+
+            fig = bar_chart(names, values, [colors[b] for b in names], title.format(n=len(names)), label_size=label_size)
+            pdf.savefig(fig)
+            plt.close(fig)
+
+    return path
+
+
+def size_pdf(path, bridge, counts, colors, counts_path=None):
+    """
+    Parameters
+    ----------
+    path : where to save the PDF
+
+    bridge : name of the bridge
+
+    counts : Data frame of the bridge's trips, one row per year and one column per ship size
+
+    colors : a color for every year, in the same order as the rows
+
+    counts_path : where to also save counts as a csv file, if anywhere
+
+    Returns
+    -------
+    path, once the PDF is saved
+    """
+
+    # Imported here so only the processes drawing box plots need seaborn
+    import seaborn as sns
+
+    sizes = list(counts.columns)
+
+    with PdfPages(path) as pdf:
+        # A bar plot for each year, overlapping with each other
+            # Each face is transparent, and each year has a different line color
+        fig, ax = plt.subplots()
+        for (year, row), c in zip(counts.iterrows(), colors):
+            ax.bar(sizes, row.to_numpy(), fc=(1, 1, 1, 0), ls="solid", lw=1, ec=c, label=year)
+
+        ax.set_title(f"{bridge} Histogram")
+        ax.set_xlabel("Length (m)")
+        ax.set_ylabel("Count (Annual)")
+        fig.tight_layout()
+        ax.legend()
+        pdf.savefig(fig)
+        plt.close(fig)
+
+        if counts_path is not None:
+            counts.to_csv(counts_path)
+
+        # A box plot of the years, with whiskers from the min to the max
+        fig, ax = plt.subplots()
+        sns.boxplot(counts, whis=(0, 100), ax=ax)
+        ax.set_title(f"{bridge} Box Plot")
+        ax.set_xlabel("Length (m)")
+        ax.set_ylabel("Count (Annual)")
+        fig.tight_layout()
+        pdf.savefig(fig)
+        plt.close(fig)
+
+    return path
+
+
+
+
+###########################
+### Drawing in Parallel ###
+###########################
+
+def draw_task(task):
+    # Runs in a worker process: task is (function, path, key, args)
+    function, path, key, args = task
+    function(path, *args)
+    return path, key
+
+
+def render_reports(tasks, cache_folder, processes=report_processes):
+    """
+    Parameters
+    ----------
+    tasks : List of (function, path, key, args), one per figure
+        function(path, *args) draws and saves the figure, EX: ranking_pdf or size_pdf
+        key is its report_key, the figure is skipped if it was already drawn with the same key
+        Functions must be defined at the top level of a file, so the worker processes can find them
+
+    cache_folder : folder holding report_cache.json
+
+    processes : the number of processes drawing at once
+
+    Returns
+    -------
+    The number of figures that were drawn
+    """
+
+    cache = load_report_cache(cache_folder)
+    tasks = [task for task in tasks if not is_current(cache, task[1], task[2])]
+
+    if not tasks:
+        return 0
+
+    for task in tasks:
+        os.makedirs(os.path.dirname(task[1]) or '.', exist_ok=True)
+
+    # A single figure isn't worth starting a pool for
+    if len(tasks) == 1 or processes == 1:
+        finished = map(draw_task, tasks)
+        pool = None
+    else:
+        pool = mlt.Pool(min(processes or os.cpu_count(), len(tasks)))
+        finished = pool.imap_unordered(draw_task, tasks)
+
+    try:
+        for path, key in finished:
+            # Only remembered once it is saved, so a figure that failed is drawn again next time
+            cache[path] = key
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        save_report_cache(cache_folder, cache)
+
+    return len(tasks)
@@ -0,0 +1,214 @@
+## Run manifest for the AIS filtering job
+
+# If the filtering job stopped part way, the only way to pick up where it left off was to slice URLs by hand,
+# and files that failed were only reported in the job's printed output. This file keeps a record of every daily
+# file the job has handled, so a restarted job (or a job with new days added to URLs) only filters the files
+# that are missing, failed, or were filtered with different boundaries.
+
+
+
+##########################
+### Importing Packages ###
+##########################
+
+import os
+import json
+import hashlib
+from datetime import datetime, timezone
+
+import numpy as np
+
+
+
+
+#######################
+### Manifest Layout ###
+#######################
+
+'''
+The manifest is one json file kept next to the output it describes:
+
+    {
+        "files":   {url: {"state": "done" or "failed",
+                          "boundary_hash": hash of the boundaries and settings the file was filtered with,
+                          "rows": {structure: number of crossing rows written},
+                          "updated": time of the last change}},
+        "journal": {path of a csv file: its size before the write in progress, or None if it didn't exist}
+    }
+
+A file with no entry is still pending.
+
+Rows are written in checkpoints: everything the writer is holding is written together, and only then are the
+files those rows came from marked done. Before a checkpoint appends to any csv file, the size of every file it
+will touch is saved in the journal. If the job dies part way through a checkpoint, the next run cuts each file
+back to its journaled size, so the half written checkpoint disappears and its files are simply filtered again.
+That way no crossing is ever written twice.
+
+The manifest itself is always written to a temporary file and swapped into place, so it is never half written.
+'''
+
+
+def boundary_hash(geometry, min_boat_length, *settings):
+    """
+    Parameters
+    ----------
+    geometry : Dictionary of boundary lines from compile_boundaries
+
+    min_boat_length : the smallest length a boat must be to be important
+
+    settings : any other settings that change the output, EX: "events"
+        Left out when they have their default value, so older manifests stay valid
+
+    Returns
+    -------
+    A short hash that changes whenever a structure, its lines, min_boat_length, or one of the settings changes
+    """
+
+    hasher = hashlib.sha256()
+
+    hasher.update(json.dumps(list(geometry["names"])).encode("utf-8"))
+    hasher.update(np.ascontiguousarray(geometry["edges"], dtype=np.float64).tobytes())
+    hasher.update(np.ascontiguousarray(geometry["owner"], dtype=np.int64).tobytes())
+    hasher.update(str(min_boat_length).encode("utf-8"))
+
+    for setting in settings:
+        hasher.update(("/" + str(setting)).encode("utf-8"))
+
+    return hasher.hexdigest()[:16]
+
+
+def load_manifest(path):
+    """
+    Returns
+    -------
+    The manifest stored at path, or an empty manifest if there isn't one yet
+    """
+
+    if not os.path.exists(path):
+        return {"files": {}, "journal": {}}
+
+    with open(path) as f:
+        manifest = json.load(f)
+
+    manifest.setdefault("files", {})
+    manifest.setdefault("journal", {})
+
+    return manifest
+
+
+def save_manifest(manifest, path):
+    # Write to a temporary file first, then swap it into place so a crash never leaves half a manifest
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    os.replace(path + ".tmp", path)
+
+
+def mark_file(manifest, url, state, signature=None, rows=None):
+    """
+    Parameters
+    ----------
+    manifest : the manifest to update (it is not saved here)
+
+    url : link to the daily file
+
+    state : "done" or "failed"
+
+    signature : boundary_hash the file was filtered with
+
+    rows : Dictionary of the form Structure: number of crossing rows written
+
+    Returns
+    -------
+    None
+    """
+
+    entry = {"state": state, "updated": datetime.now(timezone.utc).isoformat(timespec="seconds")}
+
+    if signature is not None:
+        entry["boundary_hash"] = signature
+    if rows is not None:
+        entry["rows"] = rows
+
+    manifest["files"][url] = entry
+
+
+def files_to_run(manifest, urls, signature, rerun_stale=True):
+    """
+    Parameters
+    ----------
+    manifest : the manifest of earlier runs
+
+    urls : every url the job should cover
+
+    signature : boundary_hash of the current boundaries and settings
+
+    rerun_stale : If True, files that were done with different boundaries are filtered again
+        Only safe when the output replaces a file's old crossings, like the columnar crossing store
+
+    Returns
+    -------
+    run : the urls that still need filtering, in the order given
+
+    stale : the urls that were done with different boundaries
+    """
+
+    run = []
+    stale = []
+
+    for url in urls:
+        entry = manifest["files"].get(url)
+
+        if entry is None or entry["state"] != "done":
+            run.append(url)
+        elif entry.get("boundary_hash") != signature:
+            stale.append(url)
+            if rerun_stale:
+                run.append(url)
+
+    return run, stale
+
+
+def begin_checkpoint(manifest, path, files):
+    """
+    Parameters
+    ----------
+    manifest : the manifest, saved to path once the journal is filled in
+
+    files : paths of every csv file the checkpoint is about to append to
+
+    Returns
+    -------
+    None. The size of each file (None if it doesn't exist yet) is saved before anything is written
+    """
+
+    manifest["journal"] = {f: (os.path.getsize(f) if os.path.exists(f) else None) for f in files}
+    save_manifest(manifest, path)
+
+
+def undo_interrupted_checkpoint(manifest, path):
+    """
+    Returns
+    -------
+    The number of csv files cut back to their size from before a checkpoint that never finished
+    """
+
+    journal = manifest.get("journal", {})
+
+    for f, size in journal.items():
+        if size is None:
+            # The file was created by the unfinished checkpoint
+            if os.path.exists(f):
+                os.remove(f)
+        elif os.path.exists(f) and os.path.getsize(f) > size:
+            os.truncate(f, size)
+
+    if journal:
+        manifest["journal"] = {}
+        save_manifest(manifest, path)
+
+    return len(journal)
@@ -0,0 +1,331 @@
+## Memory-aware scheduler for the download and filter stage
+
+# The number of processes used to be picked by trial and error: 36 cores on one node ran fine, but 72 cores on
+# two nodes ran out of memory. This file runs the daily files with as many processes as the node has cores, but
+# only starts a new file while the memory every running file is expected to use still fits in a budget.
+
+
+
+##########################
+### Importing Packages ###
+##########################
+
+import os
+import resource
+import multiprocessing as mlt
+from queue import Queue
+from threading import Thread
+
+
+
+
+############################
+### How the Budget Works ###
+############################
+
+'''
+How much memory a file needs is roughly proportional to how big it is. Each file is run in a fresh process, and
+when it finishes, the process reports how much its memory grew while filtering (its peak resident memory minus
+what it started with). Dividing that by the size of the file gives bytes of memory per byte of file, and the
+largest ratio seen so far (times a safety factor) is used to guess how much the next file will need.
+
+Before any file has finished, there's nothing to go on, so a cautious starting ratio is used instead.
+
+A file is only started if the guesses for every running file, plus its own, still fit in the budget. If the
+first file in line is too big, a smaller one further back can start instead, so cores don't sit idle. A file
+that is bigger than the whole budget still runs, but only once nothing else is running.
+
+Pools can't reach across nodes. For a job with several nodes, each node runs this script on its own share of
+the days (see node_share), with a pool and budget sized to that node.
+'''
+
+# Bytes of memory per byte of (compressed) file, used until the first file finishes
+    # The daily csv files are roughly 5 to 6 times larger than their zips, and pandas needs a few times more than that
+initial_memory_ratio = 30.0
+
+# Guesses are the largest ratio seen so far times this
+memory_safety_factor = 1.25
+
+# The fraction of the node's memory that files are allowed to use
+    # The rest is left for the main process, the writer, and anything else on the node
+memory_headroom = 0.8
+
+# Marks an item arriving on the queue of finished items, rather than a result (see scheduled_imap)
+arrival = object()
+
+
+def node_memory():
+    """
+    Returns
+    -------
+    The bytes of memory this job can use on this node
+        SLURM's allocation if there is one, otherwise the memory currently available on the machine
+    """
+
+    # SLURM gives the memory per node in megabytes
+    if os.environ.get("SLURM_MEM_PER_NODE", "").isdigit():
+        return int(os.environ["SLURM_MEM_PER_NODE"]) * 1024 * 1024
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    # Listed in kilobytes
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def node_cores():
+    """
+    Returns
+    -------
+    The number of cores this job can use on this node
+    """
+
+    if os.environ.get("SLURM_CPUS_ON_NODE", "").isdigit():
+        return int(os.environ["SLURM_CPUS_ON_NODE"])
+
+    return len(os.sched_getaffinity(0))
+
+
+def memory_budget(headroom=memory_headroom):
+    # The bytes of memory that running files may use together
+    return int(node_memory() * headroom)
+
+
+def node_share(items, node=None, nodes=None):
+    """
+    Parameters
+    ----------
+    items : every item of the job, EX: URLs
+
+    node : which node this is, counting from 0. SLURM_NODEID by default
+
+    nodes : how many nodes the job has. SLURM_NNODES by default
+
+    Returns
+    -------
+    This node's share of the items, one unbroken block of them
+        Blocks keep consecutive days on the same node, so only the midnights between blocks are lost to stitching
+    """
+
+    node = int(os.environ.get("SLURM_NODEID", 0)) if node is None else node
+    nodes = int(os.environ.get("SLURM_NNODES", 1)) if nodes is None else nodes
+
+    items = list(items)
+    per_node, extra = divmod(len(items), nodes)
+
+    # The first few nodes take one extra item each when they don't split evenly
+    start = node * per_node + min(node, extra)
+    stop = start + per_node + (1 if node < extra else 0)
+
+    return items[start:stop]
+
+
+
+
+########################
+### Measuring Memory ###
+########################
+
+def resident_memory():
+    # The bytes of memory this process is using right now
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def peak_memory():
+    # The most bytes of memory this process has used at once
+        # Linux reports it in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measured_call(function, key, item):
+    """
+    Runs function(item) in a worker process
+
+    Returns
+    -------
+    key : passed straight through, so the result can be matched to its item
+
+    result : whatever function returned
+
+    used : how many bytes the process grew by while running function
+        Each worker only ever runs one item, so its peak memory belongs to that item alone
+    """
+
+    start = resident_memory()
+    result = function(item)
+
+    return key, result, max(peak_memory() - start, 0)
+
+
+def new_memory_model(initial_ratio=initial_memory_ratio, safety_factor=memory_safety_factor):
+    # Everything the scheduler learns about memory as files finish
+    return {"ratio": None, "initial_ratio": initial_ratio, "safety_factor": safety_factor, "largest_size": 0, "files": 0}
+
+
+def estimate_memory(model, size):
+    """
+    Parameters
+    ----------
+    model : Dictionary from new_memory_model
+
+    size : bytes in the file, or None if it isn't known
+
+    Returns
+    -------
+    The bytes of memory the file is expected to need
+    """
+
+    # A file of unknown size is treated like the biggest file seen so far
+    if size is None:
+        size = model["largest_size"]
+
+    ratio = model["initial_ratio"] if model["ratio"] is None else model["ratio"]
+
+    return int(size * ratio * model["safety_factor"])
+
+
+def observe_memory(model, size, used):
+    # Learn from a file that finished, the largest ratio seen so far is kept
+    model["files"] += 1
+
+    if not size:
+        return
+
+    model["largest_size"] = max(model["largest_size"], size)
+    model["ratio"] = max(model["ratio"] or 0.0, used / size)
+
+
+
+
+#########################
+### Running the Files ###
+#########################
+
+def scheduled_imap(function, items, size_of, budget=None, max_workers=None, model=None, lookahead=None, report=False):
+    """
+    Parameters
+    ----------
+    function : the function to run on every item, EX: download_and_filter_bridges
+        Must be defined at the top level of a file, so the worker processes can find it
+
+    items : every item to run, EX: the urls to filter
+        A list is known up front. Any other iterable (EX: files as they finish downloading) is read by a thread,
+        and each item joins the line as it arrives, while the items already running keep going
+
+    size_of : function giving the bytes in an item's file, or None if they aren't known
+
+    budget : the bytes of memory running items may use together, memory_budget() by default
+
+    max_workers : the most items running at once, node_cores() by default
+
+    model : Dictionary from new_memory_model, to keep what was learned between calls
+
+    lookahead : how far down the line to look for an item that fits, 2 x max_workers by default
+
+    report : If True, print when the scheduler starts holding files back to stay within the budget
+
+    Returns
+    -------
+    A generator of function's results, in whatever order the items finish, just like imap_unordered
+
+    """
+
+    budget = memory_budget() if budget is None else budget
+    max_workers = node_cores() if max_workers is None else max_workers
+    model = new_memory_model() if model is None else model
+    lookahead = 2 * max_workers if lookahead is None else lookahead
+
+    sizes = {}
+
+    # Dictionary of the form Item Number: Expected Bytes of Memory, for every item that is running
+    running = {}
+
+    # Finished items are handed back from the pool's result thread through this queue
+        # So are items that arrive while others are running
+    finished = Queue()
+
+    if isinstance(items, (list, tuple)):
+        pending = list(enumerate(items))
+        arriving = False
+    else:
+        pending = []
+        arriving = True
+
+        def arrive():
+            for item in items:
+                finished.put((arrival, item))
+            finished.put((arrival, arrival))
+
+        Thread(target=arrive, daemon=True).start()
+
+    arrived = 0
+
+    was_held_back = False
+
+    # Each process runs a single item and is then replaced, so its peak memory belongs to that item alone
+    with mlt.Pool(max_workers, maxtasksperchild=1) as pool:
+        while pending or running or arriving:
+
+            # Start items until the cores or the budget run out
+            held_back = False
+            while pending and len(running) < max_workers:
+                planned = sum(running.values())
+                chosen = None
+
+                # Take the first item in line that fits
+                    # Only a few items are looked at, since finding an item's size can mean asking the server
+                for position, (key, item) in enumerate(pending[:lookahead]):
+                    if key not in sizes:
+                        sizes[key] = size_of(item)
+
+                    expected = estimate_memory(model, sizes[key])
+
+                    # With nothing running, any item is allowed, even one bigger than the whole budget
+                    if not running or planned + expected <= budget:
+                        chosen = position
+                        break
+
+                if chosen is None:
+                    held_back = True
+                    break
+
+                key, item = pending.pop(chosen)
+                running[key] = estimate_memory(model, sizes[key])
+
+                pool.apply_async(measured_call, (function, key, item), callback=finished.put,
+                                 error_callback=lambda error: finished.put(error))
+
+            # Only say so when files start being held back, rather than every time one finishes
+            if held_back and report and not was_held_back:
+                print(f"Holding back {len(pending)} files to stay within {budget / 2**30:.1f} GB "
+                      f"({len(running)} running, {sum(running.values()) / 2**30:.1f} GB expected)", flush=True)
+
+            was_held_back = held_back
+
+            # Wait for the next item to finish (or arrive), rather than checking over and over
+            done = finished.get()
+
+            if isinstance(done, BaseException):
+                raise done
+
+            if done[0] is arrival:
+                # The arrival marker itself means every item has arrived
+                if done[1] is arrival:
+                    arriving = False
+                else:
+                    pending.append((arrived, done[1]))
+                    arrived += 1
+                continue
+
+            key, result, used = done
+            del running[key]
+
+            observe_memory(model, sizes[key], used)
+
+            yield result
@@ -0,0 +1,498 @@
+## Work queue on a shared folder, for spreading the daily files over many nodes
+
+# A multiprocessing pool only reaches the cores of the node it was started on. This file lets any number of
+# separate processes (EX: the tasks of a SLURM array job, on as many nodes as the allocation has) share the list
+# of daily files through a folder on scratch storage. Each process claims a file, filters it, saves its results
+# as a part of its own, and claims the next one. A process that dies gives up its files after a while, and
+# another process picks them up.
+
+
+
+##########################
+### Importing Packages ###
+##########################
+
+import os
+import json
+import time
+import socket
+import threading
+from datetime import datetime, timezone
+
+
+
+
+###########################
+### How the Queue Works ###
+###########################
+
+'''
+The queue is a folder that every process can see:
+
+    {queue folder}/leases/{key}.lease    a file being worked on right now, holding who claimed it
+    {queue folder}/done/{key}.json       a file that is finished, and its part has been saved
+    {queue folder}/failed/{key}.json     a file that failed, how many times it has been tried, and when it can
+                                         be tried again
+
+Claiming a file creates its lease with O_EXCL, which only ever succeeds for one process, so two processes can
+never claim the same file. While a process works, a heartbeat thread touches the lease every few seconds. If a
+lease hasn't been touched for lease_seconds, the process holding it is assumed to be dead, and the lease can be
+taken over. Taking over renames the old lease out of the way first, which again only one process can do.
+
+A process only marks a file done if it still holds the lease, so a process that was too slow and lost its
+lease never overwrites the work of the process that took over. The marker is written to a temporary file and
+swapped into place, so it is never half written.
+
+A file that fails isn't claimed again until retry_seconds have passed, so a problem that clears up on its own
+(EX: the server being down for a few minutes) doesn't use up every attempt at once. Until then the processes
+move on to the other files, and only wait on the failed ones once nothing else is left.
+
+Once every file is done (or has failed too many times), the parts are combined in a single merge step.
+'''
+
+# Seconds without a heartbeat before a lease is considered abandoned
+lease_seconds = 900
+
+# Seconds between heartbeats
+    # Must be much smaller than lease_seconds, so a slow shared file system never costs a live process its lease
+heartbeat_seconds = 30
+
+# The number of times a file is tried before it is left for someone to look at
+max_attempts = 3
+
+# Seconds a file that failed waits before it is tried again
+retry_seconds = 600
+
+# Seconds to wait before looking again, when every file left is claimed by another process
+poll_seconds = 60
+
+
+def queue_paths(folder, key):
+    # Where the lease, done marker, and failure record of a file are kept
+    return {"lease": os.path.join(folder, "leases", key + ".lease"),
+            "done": os.path.join(folder, "done", key + ".json"),
+            "failed": os.path.join(folder, "failed", key + ".json")}
+
+
+def write_json(path, record):
+    # Write to a temporary file first, then swap it into place so a crash never leaves half a file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    temporary = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(record, f)
+
+    os.replace(temporary, path)
+
+
+def read_json(path):
+    # The record at path, or None if there isn't one
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def worker_name():
+    # Names the process holding a lease, EX: node12-48213
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+
+
+#######################
+### Claiming a File ###
+#######################
+
+def create_lease(path, owner):
+    # Only one process can ever create the same lease
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+
+    with os.fdopen(fd, "w") as f:
+        json.dump({"owner": owner, "claimed": datetime.now(timezone.utc).isoformat(timespec="seconds")}, f)
+
+    return True
+
+
+def lease_age(path):
+    # Seconds since the lease was last touched, or None if there is no lease
+    try:
+        return time.time() - os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+
+
+def try_claim(folder, key, owner, lease_seconds=lease_seconds):
+    """
+    Parameters
+    ----------
+    folder : the queue folder
+
+    key : the name of the file in the queue
+
+    owner : the name of the claiming process, from worker_name
+
+    lease_seconds : seconds without a heartbeat before someone else's lease can be taken over
+
+    Returns
+    -------
+    True if this process now holds the lease, False if another process does
+    """
+
+    path = queue_paths(folder, key)["lease"]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if create_lease(path, owner):
+        return True
+
+    age = lease_age(path)
+    if age is None or age < lease_seconds:
+        return False
+
+    # The lease was abandoned. Rename it out of the way, which only one process can do
+    expired = f"{path}.{owner}.expired"
+    try:
+        os.rename(path, expired)
+    except FileNotFoundError:
+        return False
+
+    # Another process may have taken over the lease between the age check and the rename
+        # If what was renamed is fresh, it belongs to that process, so put it back
+    if (lease_age(expired) or 0) < lease_seconds:
+        try:
+            os.link(expired, path)
+        except FileExistsError:
+            pass
+        os.remove(expired)
+        return False
+
+    os.remove(expired)
+    return create_lease(path, owner)
+
+
+def holds_lease(folder, key, owner):
+    # True if owner still holds the lease on key
+    record = read_json(queue_paths(folder, key)["lease"])
+    return record is not None and record.get("owner") == owner
+
+
+def start_heartbeat(folder, key, owner, interval=heartbeat_seconds):
+    """
+    Returns
+    -------
+    A threading.Event. Set it to stop the heartbeat
+        The thread touches the lease every interval seconds, for as long as owner still holds it
+    """
+
+    stop = threading.Event()
+    path = queue_paths(folder, key)["lease"]
+
+    def beat():
+        while not stop.wait(interval):
+            if not holds_lease(folder, key, owner):
+                return
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return
+
+    threading.Thread(target=beat, daemon=True).start()
+
+    return stop
+
+
+def release_lease(folder, key, owner):
+    # Give up the lease, but only if owner still holds it
+    if holds_lease(folder, key, owner):
+        try:
+            os.remove(queue_paths(folder, key)["lease"])
+        except FileNotFoundError:
+            pass
+
+
+
+
+##########################
+### Working Through It ###
+##########################
+
+def attempts(folder, key):
+    # The number of times key has failed
+    record = read_json(queue_paths(folder, key)["failed"])
+    return 0 if record is None else record.get("attempts", 0)
+
+
+def retry_after(folder, key):
+    # The time (as time.time()) before which key shouldn't be tried again, 0 if it hasn't failed
+    record = read_json(queue_paths(folder, key)["failed"])
+    return 0 if record is None else record.get("retry_after", 0)
+
+
+def finished_keys(folder):
+    # Every key marked done, listed once rather than checking each file on the shared file system
+    try:
+        return {name[:-5] for name in os.listdir(os.path.join(folder, "done")) if name.endswith(".json")}
+    except FileNotFoundError:
+        return set()
+
+
+def work_loop(function, folder, items, key_of, owner=None, wait_for_stragglers=True, lease_seconds=lease_seconds, retry_seconds=retry_seconds, poll_seconds=poll_seconds):
+    """
+    Parameters
+    ----------
+    function : the function to run on every item. It should save its own output (EX: a part file per day)
+        Returns a Dictionary to keep in the done marker, and raises an exception if the item failed
+
+    folder : the queue folder, on storage every process can see
+
+    items : every item of the job, EX: URLs. Every process should be given the same list
+
+    key_of : function giving the name of an item in the queue, EX: AIS_2020_01_01
+
+    owner : the name of this process, worker_name() by default
+
+    wait_for_stragglers : If True, keep waiting while other processes hold the last items, so that if one of
+        them dies, its items are taken over. If False, stop as soon as there's nothing left to claim
+        Items waiting to be retried are always waited for, until they run out of attempts
+
+    lease_seconds : seconds without a heartbeat before someone else's lease can be taken over
+
+    retry_seconds : seconds a failed item waits before it is claimed again
+
+    poll_seconds : seconds to wait before looking again, when every item left is claimed by another process
+
+    Returns
+    -------
+    The number of items this process finished
+    """
+
+    owner = worker_name() if owner is None else owner
+    finished = 0
+
+    while True:
+        done = finished_keys(folder)
+        claimed = False
+        held_elsewhere = False
+        retries = []
+
+        for item in items:
+            key = key_of(item)
+
+            if key in done or attempts(folder, key) >= max_attempts:
+                continue
+
+            # A failed item sits out until its retry time, and the items after it are claimed in the meantime
+            if retry_after(folder, key) > time.time():
+                retries.append(retry_after(folder, key))
+                continue
+
+            if not try_claim(folder, key, owner, lease_seconds):
+                held_elsewhere = True
+                continue
+
+            # Another process may have finished it, or failed it, between the checks above and claiming it
+            if os.path.exists(queue_paths(folder, key)["done"]) or retry_after(folder, key) > time.time():
+                release_lease(folder, key, owner)
+                continue
+
+            claimed = True
+            heartbeat = start_heartbeat(folder, key, owner)
+
+            try:
+                record = function(item)
+            except Exception as e:
+                heartbeat.set()
+                print(f"{key} failed on {owner} \n Error: {e}", flush=True)
+
+                if holds_lease(folder, key, owner):
+                    write_json(queue_paths(folder, key)["failed"], {"attempts": attempts(folder, key) + 1, "error": str(e), "owner": owner,
+                                                                    "retry_after": time.time() + retry_seconds})
+                    release_lease(folder, key, owner)
+                break
+
+            heartbeat.set()
+
+            # Only the process holding the lease gets to mark the item done
+            if holds_lease(folder, key, owner):
+                write_json(queue_paths(folder, key)["done"], dict(record or {}, owner=owner,
+                                                                  finished=datetime.now(timezone.utc).isoformat(timespec="seconds")))
+                release_lease(folder, key, owner)
+                finished += 1
+            else:
+                print(f"{key} was taken over by another process before {owner} finished it", flush=True)
+
+            # Start over from the top, so the earliest items left are always claimed first
+            break
+
+        if claimed:
+            continue
+
+        # Everything left is claimed by someone else, so wait to see if they finish or their leases run out
+            # Failed items are waited on until the first of them can be tried again
+        waits = [poll_seconds] if held_elsewhere and wait_for_stragglers else []
+        if retries:
+            waits.append(min(retries) - time.time())
+
+        if not waits:
+            return finished
+
+        time.sleep(max(0, min(waits)))
+
+
+def queue_status(folder, items, key_of):
+    """
+    Returns
+    -------
+    Dictionary of the form State: Number of Items, for the states done, failed, working, abandoned, retrying,
+        and pending
+        failed only counts items that have used up all of their attempts, retrying counts the ones waiting for
+        their next attempt
+    """
+
+    done = finished_keys(folder)
+    status = {"done": 0, "failed": 0, "working": 0, "abandoned": 0, "retrying": 0, "pending": 0}
+
+    for item in items:
+        key = key_of(item)
+        age = lease_age(queue_paths(folder, key)["lease"])
+
+        if key in done:
+            status["done"] += 1
+        elif attempts(folder, key) >= max_attempts:
+            status["failed"] += 1
+        elif age is None and retry_after(folder, key) > time.time():
+            status["retrying"] += 1
+        elif age is None:
+            status["pending"] += 1
+        elif age < lease_seconds:
+            status["working"] += 1
+        else:
+            status["abandoned"] += 1
+
+    return status
+
+
+
+
+##################################
+### Checking With Many Workers ###
+##################################
+
+'''
+Running this file starts a few separate processes on one queue, with the lease and retry times cut down to
+seconds. The stand-in job fails the first attempt of one item, fails every attempt of another, and kills the
+process running the first attempt of a third. The check fails unless
+
+    every other item is done exactly once, and the one killed part way is taken over by another process
+    the item that always fails is tried max_attempts times and then left alone
+    a failed item isn't tried again until retry_seconds have passed, and other items are started in between
+    no item is ever worked on by two processes at once
+
+EX: python AIS_Work_Queue.py
+'''
+
+
+def stand_in_job(log_folder, item):
+    # Logs each start and finish of item, and fails (or dies) the way its name says to
+    log = os.path.join(log_folder, item + ".log")
+    with open(log) as f:
+        tries = sum(line.startswith("start") for line in f)
+
+    with open(log, "a") as f:
+        f.write(f"start {time.time()} {os.getpid()}\n")
+
+    if item.startswith("dies") and tries == 0:
+        os._exit(1)
+    if item.startswith("broken") or (item.startswith("flaky") and tries == 0):
+        with open(log, "a") as f:
+            f.write(f"failed {time.time()} {os.getpid()}\n")
+        raise RuntimeError(f"{item} failed on purpose")
+
+    time.sleep(0.1)
+
+    with open(log, "a") as f:
+        f.write(f"end {time.time()} {os.getpid()}\n")
+
+
+def check_queue(workers=4, count=12, lease=1.0, retry=1.0, poll=0.1):
+    """
+    Returns
+    -------
+    Dictionary of the form Check: True if it passed, for every check described above
+    """
+
+    import tempfile
+    import shutil
+    import functools
+    import multiprocessing
+
+    folder = tempfile.mkdtemp()
+    log_folder = os.path.join(folder, "logs")
+    os.makedirs(log_folder)
+
+    items = ["flaky_00", "broken_01", "dies_02"] + [f"good_{i:02d}" for i in range(3, count)]
+    for item in items:
+        open(os.path.join(log_folder, item + ".log"), "w").close()
+
+    job = functools.partial(stand_in_job, log_folder)
+    processes = [multiprocessing.Process(target=work_loop, args=(job, folder, items, str),
+                                         kwargs={"lease_seconds": lease, "retry_seconds": retry, "poll_seconds": poll})
+                 for _ in range(workers)]
+
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60 + max_attempts * retry)
+
+    # Every line of every log, as (item, what, when, process)
+    events = []
+    for item in items:
+        with open(os.path.join(log_folder, item + ".log")) as f:
+            for line in f:
+                what, when, pid = line.split()
+                events.append((item, what, float(when), pid))
+
+    def starts(item):
+        return [when for name, what, when, _ in events if name == item and what == "start"]
+
+    def ends(item):
+        return [when for name, what, when, _ in events if name == item and what == "end"]
+
+    def alone(item):
+        # Every attempt ends (or fails) before the next one starts, other than the one whose process was killed
+        lines = [what for name, what, _, _ in sorted(events, key=lambda event: event[2]) if name == item]
+        lines = lines[1:] if item.startswith("dies") else lines
+        return len(lines) > 0 and lines[0::2] == ["start"] * len(lines[0::2]) and all(what != "start" for what in lines[1::2])
+
+    others_between = any(starts("flaky_00")[0] < when < starts("flaky_00")[1] for item in items[3:] for when in starts(item))
+    done = finished_keys(folder)
+
+    checks = {"every process finished": all(not process.is_alive() for process in processes),
+              "every other item done once": done == set(items) - {"broken_01"} and all(len(ends(item)) == 1 for item in items if item != "broken_01"),
+              "killed item taken over": len({pid for name, _, _, pid in events if name == "dies_02"}) == 2,
+              f"always failing item tried {max_attempts} times": len(starts("broken_01")) == max_attempts and queue_status(folder, items, str)["failed"] == 1,
+              f"failed items waited {retry} seconds": all(later - earlier >= retry for item in ["flaky_00", "broken_01"]
+                                                          for earlier, later in zip(starts(item), starts(item)[1:])),
+              "other items started before a retry": others_between,
+              "no item worked on twice at once": all(alone(item) for item in items)}
+
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+
+    shutil.rmtree(folder, ignore_errors=True)
+
+    return checks
+
+
+if __name__ == "__main__":
+    checks = check_queue()
+    for name, passed in checks.items():
+        print(f"{'passed' if passed else 'FAILED'}  {name}")
+
+    if not all(checks.values()):
+        raise SystemExit(1)
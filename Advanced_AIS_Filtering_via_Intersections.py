@@ -15,11 +15,44 @@ import numpy as np
 # Packages for interfacing with internet
 from io import BytesIO
 from zipfile import ZipFile
-from urllib.request import urlopen
+from urllib.request import urlopen, Request
+from AIS_Download_Cache import cached_zip_path, cache_record, prefetch
+
+# Package for writing the columnar crossing store
+from AIS_Crossing_Store import write_crossings, remove_sources
+
+# Package for the columnar archive of the raw daily files
+from AIS_Archive import write_archive, read_archive, is_archived, noaa_time_format
+
+# Package for keeping track of which files have been filtered
+from AIS_Run_Manifest import boundary_hash, load_manifest, save_manifest, mark_file, files_to_run, begin_checkpoint, undo_interrupted_checkpoint
+
+# Package for running files only while they fit in memory
+from AIS_Scheduler import scheduled_imap, node_share, node_cores
+
+# Package for sharing the files between many separate processes
+from AIS_Work_Queue import work_loop, queue_status, queue_paths, read_json, max_attempts
+
+# Package for keeping the aggregate cube of crossing counts
+from AIS_Aggregate_Cube import update_cube, cube_file_name
+
+# Package for timing each stage of each file
+from AIS_Metrics import begin_file, end_file, stage, count, timed_reads, timed_chunks, summarize, run_name
+
+# Package for the compiled bridge and port boundaries
+from AIS_Boundary_Geometry import load_geometry, boundary_set, close_ring
+
+# Package for indexing the crossings for quick queries
+from AIS_Crossing_Query import build_index
 
 # Packages for parallel processing
 from threading import Thread
-import multiprocessing as mlt 
+from queue import Queue
+import multiprocessing as mlt
+import os
+import pickle
+import json
+from datetime import datetime, timedelta
 
 
 
@@ -81,19 +114,24 @@ URLs.append('https://coast.noaa.gov/htdata/CMSP/AISDataHandler/2024/AIS_2024_02_
     #https://documentation.spire.com/ais-fundamentals/different-classes-of-ais/ais-channel-access-methods/
 
 
-# Read filters from the excel Sheet "Port_Boundaries" in this GitHub Repository    
-port_data = pd.read_excel("https://raw.githubusercontent.com/DiranOrange/Key-Bridge-Code-and-Data/main/Port_Boundaries.xlsx", header = 0, index_col=0)
-
-dict_ports = port_data.transpose().to_dict('list')
+# The boundaries come from the spreadsheets in this repository, compiled into boundary_geometry.bin (see AIS_Boundary_Geometry.py)
+    # The file is only rebuilt when a spreadsheet changes, and every process maps the same copy of it into memory
+    # So importing this script (which every spawned worker does) reads no Excel and makes no network access
+boundary_geometry = load_geometry()
 
-# Each port boundary is defined as an array of four vertices based on real world lat/lon data
-port_boxes = {port: np.array(dict_ports[port]).reshape(5, 2) for port in dict_ports}
+# The sets of bridges to filter for, from geometry_sources in AIS_Boundary_Geometry.py
+    # Add "river_bridges" to also filter for the bridges in River_Bridge_Boundaries.xlsx
+bridge_geometry_sets = ["bridges"]
 
+# Each port boundary is defined as an array of vertices based on real world lat/lon data
+    # A port can have as many vertices as it needs, the sheet just needs a longitude and latitude column for each
+    # Each boundary already ends where it started
+port_boxes = boundary_set(boundary_geometry, "ports")
 
-# Same method as port boundaries, but for bridges. Each bridge is defined by two points
-bridge_data = pd.read_excel("https://raw.githubusercontent.com/DiranOrange/Key-Bridge-Code-and-Data/main/Bridge_Boundaries.xlsx", header=0, index_col = 0, usecols=["STRUCTURE_NAME", "START_X", "START_Y","END_X", "END_Y"], converters={"START_X":float, "START_Y":float, "END_X": float, "END_Y":float})
-dict_bridges = bridge_data.transpose().to_dict('list')
-bridge_lines = {bridge: np.array(dict_bridges[bridge]).reshape(2,2) for bridge in dict_bridges}
+# Same method as port boundaries, but for bridges. Each bridge is defined by two or more points
+    # Bridges with a curve can list the points along it as VERTEX_1_X, VERTEX_1_Y, VERTEX_2_X, ... columns
+    # A bridge in more than one set keeps the points of the last set it is in
+bridge_lines = {bridge: points for name in bridge_geometry_sets for bridge, points in boundary_set(boundary_geometry, name).items()}
 
 
 ###################################################
@@ -101,9 +139,21 @@ bridge_lines = {bridge: np.array(dict_bridges[bridge]).reshape(2,2) for bridge i
 ###################################################
 
 '''
-Each bridge gets its own csv file. To prevent processes from hanging by trying to write to the same csv
-file, each file will get its own thread with a queue of data to write. This ensures a single file doesn't
-get multiple simultaneous write requests.
+Each bridge gets its own csv file. Workers never write files themselves. Instead, each worker hands its
+results back to the main process as soon as its file is finished, and the main process passes them to a
+single long-lived writer thread through a queue. Since only the writer touches the csv files, a single
+file never gets multiple simultaneous write requests.
+
+The writer holds rows until there are enough of them to be worth a write, then writes every bridge's rows at
+once (a checkpoint). When every file is finished, the main process puts None on the queue. That is the writer's
+signal to write everything it is still holding and stop, so the queue never has to be polled to see if it is empty.
+
+Instead of csv files, the writer can also fill the columnar crossing store (see AIS_Crossing_Store.py), which
+keeps every column's type and splits each bridge's crossings up by year and month.
+
+After each checkpoint, the writer marks the files it just wrote as done in the run manifest (see
+AIS_Run_Manifest.py). A restarted job reads the manifest and only filters files that aren't done yet, so URLs
+never have to be sliced by hand.
 '''
 
 # WARNING!!!
@@ -117,20 +167,227 @@ data_folder = '/home/{your jhed}/scr4_mshiel10/{your usename}/{your folder}/'
 # data_folder = '/home/djimene9/scr4_mshiel10/djimenez/Bridge_Filtering_Data/'
 
 
-# This function takes a dataframe out of a queue and writes it to a csv file
-def writer(queue, bridge):
-    # Keep writing until all dataframes have been processed
-    while not queue.empty():
-        
-        # Remove the first dataframe from the que
-        df = queue.get()
+# Either "csv" for one "<bridge> Data.csv" per bridge, or "parquet" for the columnar crossing store
+output_format = "csv"
+
+# What is written for each crossing
+    # "pairs" : the two AIS broadcasts on either side of the crossing, next to each other
+    # "events" : one row per crossing, with the interpolated time, place, speed, and course, and which way it went
+        # Events are written to "<bridge> Events.csv" instead of "<bridge> Data.csv"
+crossing_records = "pairs"
+
+# WARNING!!!
+# Like data_folder, adjust this if writing to the columnar crossing store
+# WARNING!!!
+
+store_folder = '/home/{your jhed}/scr4_mshiel10/{your usename}/Crossing_Store/'
+
+
+# The number of rows held before every bridge's rows are written
+writer_flush_rows = 50_000
+
+# The most results that can wait for the writer before workers' results have to wait on it
+writer_queue_size = 1000
+
+
+# Keep a manifest of the files that are done, so a restarted job skips them
+    # The manifest is kept in the output folder, so a new output folder starts a fresh run
+use_manifest = True
+
+
+def default_format(file_format=None):
+    # output_format, unless another was asked for. Ports are only ever written as csv files (see run_target)
+    if file_format is not None:
+        return file_format
+    return "csv" if run_target == "ports" else output_format
+
+
+def output_folder(file_format=None):
+    # data_folder for csv files, store_folder for the columnar crossing store
+    file_format = default_format(file_format)
+
+    # Ports are written like csv bridges, but to port_folder
+    if run_target == "ports":
+        return port_folder + node_subfolder()
+
+    # The store keeps a separate file for every daily file, so every node of a split job can share it
+        # csv files are appended to, so each node gets its own folder of them
+    return store_folder if file_format == "parquet" else data_folder + node_subfolder()
+
+
+def manifest_path(file_format=None):
+    # Each node of a split job keeps its own manifest
+    file_format = default_format(file_format)
+    return output_folder(file_format) + (node_subfolder() if file_format == "parquet" else '') + 'run_manifest.json'
+
+
+# Keep the aggregate cube of crossing counts up to date as rows are written (see AIS_Aggregate_Cube.py)
+    # The rankings and histograms can then be made from the cube instead of every bridge's crossings
+use_cube = True
+
+
+# Index every bridge's crossings for quick queries once the job is written (see AIS_Crossing_Query.py)
+    # Only the bridges whose files changed are indexed again, and the index is kept in the output folder
+    # A port job indexes its ports' crossings or visits in port_folder
+use_query_index = True
+
+
+def cube_path(file_format=None):
+    # The cube is kept next to the run manifest, since the number of days comes from the manifest
+    return os.path.join(os.path.dirname(manifest_path(file_format)), cube_file_name)
+
+
+def csv_path(folder, bridge):
+    # A port's visits get their own name, since they aren't crossings at all
+    if run_target == "ports":
+        return folder + bridge + (' Visits.csv' if port_records == "visits" else ' Data.csv')
+    return folder + bridge + (' Events.csv' if crossing_records == "events" else ' Data.csv')
+
+
+def write_batch(folder, bridge, frames, sources, file_format="csv"):
+    if file_format == "parquet":
+        # The store keeps one file per bridge per daily file, so re-filtering a day replaces its crossings
+        for df, source in zip(frames, sources):
+            write_crossings(folder, bridge, df, source)
+        return
+    
+    # Write a bridge's held rows to its csv file in one append
+    path = csv_path(folder, bridge)
+    
+    # Only a new (or empty) file gets a header, so the header is never repeated in the middle of the data
+    new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+    pd.concat(frames, ignore_index=True).to_csv(path, index=False, mode="a", header=new_file)
+    return
+
+
+def checkpoint(folder, held, held_sources, finished, file_format, manifest=None, signature=None):
+    """
+    Parameters
+    ----------
+    folder : folder to write to
+    
+    held, held_sources : Dictionaries of the form Bridge: List of Data Frames / List of their daily file names
+    
+    finished : List of (url, Dictionary of the form Bridge: Number of Rows) for every file whose rows are held
+    
+    file_format : "csv" or "parquet"
+    
+    manifest : the run manifest to mark the finished files done in, or None to not keep one
+    
+    signature : boundary_hash the files were filtered with
+    
+    Returns
+    -------
+    None. Every held row is written, and only then are the finished files marked done
+    """
+    
+    # The cube only counts bridge crossings
+    cube = use_cube and run_target == "bridges"
+    
+    # Remember how long every csv file was, so an interrupted checkpoint can be undone by the next run
+        # The cube is appended to like the csv files, so it is undone with them
+    if manifest is not None and file_format == "csv":
+        begin_checkpoint(manifest, manifest_path(file_format), [csv_path(folder, bridge) for bridge in held] + ([cube_path(file_format)] if cube else []))
+    
+    # A day filtered again can cross different bridges than before, so every file it wrote to the store is removed
+        # first, including at bridges it no longer crosses at all. A crash in between leaves the day not done, so it's filtered again
+    if file_format == "parquet":
+        remove_sources(folder, [source_name(url) for url, _ in finished])
+    
+    for bridge in held:
+        write_batch(folder, bridge, held[bridge], held_sources[bridge], file_format)
+    
+    # The counts go in the cube before the files are marked done, so a day is never done without its counts
+        # Every finished day is passed, so a day that no longer crosses anything loses its old counts too
+    if cube:
+        update_cube(cube_path(file_format), held, held_sources, events=(crossing_records == "events"),
+                    sources=[source_name(url) for url, _ in finished])
+    
+    if manifest is not None:
+        for url, rows in finished:
+            mark_file(manifest, url, "done", signature=signature, rows=rows)
         
-        # Write the dataframe to a bridge's csv file
-        df.to_csv(data_folder + bridge + ' Data.csv', index=False, mode="a")
-    return    
+        # Saving the manifest with an empty journal is what makes the checkpoint final
+        manifest["journal"] = {}
+        save_manifest(manifest, manifest_path(file_format))
+    return
 
-# Each writer is a separate thread, which handles one bridge in particular
-    # If there were only a single thread for writing files, it would likely bottleneck the whole process
+
+# This function takes dataframes out of a queue and writes them to each bridge's file
+def writer(queue, folder=None, flush_rows=writer_flush_rows, file_format=None, manifest=None, signature=None):
+    """
+    Parameters
+    ----------
+    queue : Queue of (url, Dictionary of the form Bridge: Data Frame) items, ended by None
+        A file that failed to filter is sent as (url, None)
+        A port job sends Port: Data Frame instead, and each port is written like a bridge
+    
+    folder : folder to write to, data_folder (csv), store_folder (parquet), or port_folder (ports) by default
+    
+    flush_rows : the number of rows held before every bridge's rows are written
+    
+    file_format : "csv" or "parquet", output_format by default (csv for ports)
+    
+    manifest : the run manifest to record each file in, or None to not keep one
+    
+    signature : boundary_hash the files were filtered with
+    
+    Returns
+    -------
+    None. Runs until it takes None off the queue, then writes everything it is still holding
+    """
+    
+    file_format = default_format(file_format)
+    
+    if folder is None:
+        folder = output_folder(file_format)
+    
+    os.makedirs(folder, exist_ok=True)
+    
+    held = {}
+    held_sources = {}
+    held_rows = 0
+    finished = []
+    
+    while True:
+        # Wait for the next result, rather than checking if the queue is empty over and over
+        item = queue.get()
+        
+        # None means every file has been filtered
+        if item is None:
+            break
+        
+        url, results = item
+        
+        # A failed file has already been reported by its worker, it just needs to be recorded
+        if results is None:
+            if manifest is not None:
+                mark_file(manifest, url, "failed", signature=signature)
+                save_manifest(manifest, manifest_path(file_format))
+            continue
+        
+        # The daily file's name goes along with its data, so the store can name its files after it
+        source = source_name(url)
+        
+        for bridge in results:
+            held.setdefault(bridge, []).append(results[bridge])
+            held_sources.setdefault(bridge, []).append(source)
+            held_rows += len(results[bridge])
+        
+        # A file with no crossings at all is still done once the next checkpoint is written
+        finished.append((url, {bridge: len(results[bridge]) for bridge in results}))
+        
+        # Once enough rows are held, write them all at once
+        if held_rows >= flush_rows:
+            checkpoint(folder, held, held_sources, finished, file_format, manifest, signature)
+            held = {}
+            held_sources = {}
+            held_rows = 0
+            finished = []
+    
+    # Write whatever is left
+    checkpoint(folder, held, held_sources, finished, file_format, manifest, signature)
+    return
 
 
 ###########################
@@ -142,274 +399,77 @@ min_boat_length = 150
     # Units = meters
 
 
-def filter_ports(file, boundaries, min_boat_length):
+# Each file is prepared as a data frame
+    # To improve memory efficiency and read speeds, the datatype of each column is specified
+ais_dtypes = {"Heading": "Int64",
+              "VesselName": str,
+              "IMO":str,
+              "MMSI":str, #Technically this should be an integer, but some files accidentally insert an alphanumeric character, causing a ValueError
+              "LAT":np.float64,
+              "LON":np.float64,
+              "SOG":np.float64,
+              "COG":np.float64,
+              "CallSign":str,
+              "VesselType":"Int64",
+              "Status":"Int64",
+              "Length":"Int64",
+              "Width":"Int64",
+              "Cargo":"Int64",
+              "Draft":np.float64,
+              "TransceiverClass":str,
+              "TranscieverClass":str}
+
+
+def read_ais_file(file):
     """
     Parameters
     ----------
-    file : path to the file to be filtered
+    file : path to the file to be read
         Zipfiles from the internet will be opened, and the path will be listed here
-    
-    boundaries : Dictionary of the form Port: Points Defining Port's Boundaries
-        This function handles ports, while the other handles bridges. They are nearly identical, except
-        each port is defined by four line segments, while bridges are only defined by one.
-        
-    min_boat_length : the smallest length a boat must be to be important
-    
+        Paths ending in .parquet are read from the archive (see AIS_Archive.py)
+
     Returns
     -------
-    None. Data is written to an external file 
-        The data consists of the points forming line segments from boats which intersect a port
-        
+    Data frame of every AIS broadcast in the file
     """
-    
-    # Each file is prepared as a data frame
-        # To improve memory efficiency and read speeds, the datatype of each column is specified
-    raw_data = pd.read_csv(file, sep=',', header=0, dtype={"Heading": "Int64",
-                                                               "VesselName": str,
-                                                               "IMO":str,
-                                                               "MMSI":str, #Technically this should be an integer, but some files accidentally insert an alphanumeric character, causing a ValueError
-                                                               "LAT":np.float64,
-                                                               "LON":np.float64,
-                                                               "SOG":np.float64,
-                                                               "Heading":"Int64",
-                                                               "COG":np.float64,
-                                                               "IMO":str,
-                                                               "CallSign":str,
-                                                               "VesselType":"Int64",
-                                                               "Status":"Int64",
-                                                               "Length":"Int64",
-                                                               "Width":"Int64",
-                                                               "Cargo":"Int64",
-                                                               "Draft":np.float64,
-                                                               "TransceiverClass":str,
-                                                               "TranscieverClass":str}, on_bad_lines="skip")
-
-    
-
-    # Keeping important AIS broadcast points based on three conditions:
-    try:
-        filtered = raw_data.loc[
-            (((70 <= raw_data["VesselType"]) & (raw_data["VesselType"] < 90)) | (raw_data["VesselType"] == (1016 | 1017 | 1024 | 61)) | (raw_data["Length"] >= min_boat_length))
-                # Ships must be longer than chosen minimum length (units are meters)
-                # Or ships must be of class cargo, tanker, or cruise ship
-                    # Vessel Type codes are based on the following: https://coast.noaa.gov/data/marinecadastre/ais/VesselTypeCodes2018.pdf
-            
-            & (((raw_data["SOG"] > 3) & (raw_data["Status"] != 1) & (raw_data["Status"] != 5)) | (raw_data["Status"] == (3 | 4)) )
-                # ships must also be moving and not anchored and not moored, or moving with difficulty
-            
-            & (raw_data["TransceiverClass"] == "A")]
-                # ships must also have transceiver class A (transceiver class B tends to give faulty information)
-                
-    except KeyError:
-        filtered = raw_data.loc[
-        (((70 <= raw_data["VesselType"]) & (raw_data["VesselType"] < 90)) | (raw_data["VesselType"] == (1016 | 1017 | 1024 | 61)) | (raw_data["Length"] >= min_boat_length) )
-        & (((raw_data["SOG"] > 3) & (raw_data["Status"] != 1) & (raw_data["Status"] != 5)) | (raw_data["Status"] == (3 | 4)) )
-        & (raw_data["TranscieverClass"] == "A")]
-            # For some stupid reason there's occasionally a typo here
-                # TranscIEver instead of TranscEIver
-                
-    # A list of all boats remaining after filtering        
-    boats = filtered.drop_duplicates(["MMSI"])["MMSI"].values
-    
-    for port in boundaries:
 
-            columns = filtered.columns.values.tolist()
-            
-            # Arrays can quickly be concatenated, great for combining chunks of data
-            port_array = np.array([columns])
-            
-            # Data frames write to csv files quickly and robustly
-            port_data = pd.DataFrame({})
-            
-            for i in range(4):
-                # Each port consists of 4 line segments
-                port_1_x = boundaries[port][i][0]
-                port_1_y = boundaries[port][i][1]
-                
-                port_2_x = boundaries[port][i+1][0]
-                port_2_y = boundaries[port][i+1][1]
-                
-                
-                for boat in boats:
-                    # Filter by each boat separately to prevent paths from getting wonky
-                    # Additionally, organize chronologically to prevent paths from getting wonky
-                    boat_broadcasts = filtered.loc[filtered["MMSI"] == boat].sort_values(["BaseDateTime"]).to_numpy()
-                    
-                    # Keep in mind these are vectors of x coordinates and y coordinates
-                        # All calculations are performed as vectorized operations for speed
-                    
-                    boat_1_x = boat_broadcasts[:-1,3]
-                    boat_1_y = boat_broadcasts[:-1,2]
-                    
-                    boat_2_x = boat_broadcasts[1:,3]
-                    boat_2_y = boat_broadcasts[1:,2]
-                    
-                    # Be mindful of the indexing: if there are n boat points then there are n-1 line segments
-                    
-                    # a = segment boat_1 to boat_2
-                    # b = segment port_1 to port_2
-                    # c = segment boat_2 to port_1
-                    # d = segment boat_2 to port_2
-                    # e = segment port_2 to boat_1
-                    
-                    
-                    a_x = boat_2_x - boat_1_x
-                    a_y = boat_2_y - boat_1_y
-                    
-                    b_x = port_2_x - port_1_x
-                    b_y = port_2_y - port_1_y
-                    
-                    c_x = port_1_x - boat_2_x
-                    c_y = port_1_y - boat_2_y
-                    
-                    d_x = port_2_x - boat_2_x
-                    d_y = port_2_y - boat_2_y
-                    
-                    e_x = boat_1_x - port_2_x
-                    e_y = boat_1_y - port_2_y
-                    
-                    # The 2D cross product returns a scalar
-                    # Perform it on the boat segment to each bridge point, and bridge segment to each boat point
-                        # Hence, each cross product checks three points, since the end of one segment is the start of the second
-                    
-                    cross1 = a_x * c_y - a_y * c_x
-                    cross2 = a_x * d_y - a_y * d_x
-                    
-                    cross3 = b_x * e_y - b_y * e_x
-                    cross4 = b_y * d_x - b_x * d_y
-                    
-                        # cross4 should techincally be: b X (-d) {in english, b cross -d}
-                        # However, the negative has been distributed to d X b, as is done above
-                        # Hence, the swapping of x and y
-                    
-                    
-                    # If the scalar is positive, the points are oriented counterclockwise (denoted 1)
-                    # If the scalar is negative, the points are oriented clockwise (denoted -1)
-                    # If the scalar is 0, the points are collinear
-                    
-                    o1 = np.where( (cross1 > 0), 1, 0)
-                    O1 = np.where( (cross1 < 0), -1, o1)
-
-                    o2 = np.where( (cross2> 0), 1, 0)
-                    O2 = np.where( (cross2 < 0), -1, o2)
-
-                    o3 = np.where( (cross3> 0), 1, 0)
-                    O3 = np.where( (cross3 < 0), -1, o3)
-
-                    o4 = np.where( (cross4 > 0), 1, 0)
-                    O4 = np.where( (cross4 < 0), -1, o4)
-                    
-                    # When O1 and O2 have different signs, then the boat segment sees one bridge point on the left, and the other on the right
-                        # As in, the orientation of the points is different
-                        # Hence, it is intersected
-                        
-                    # However, the same must also be true from the bridge's perspective, otherwise the segments do not intersect
-                        # See this page for a diagram: https://www.geeksforgeeks.org/check-if-two-given-line-segments-intersect/#
-
-                    O_mask = np.where( ( (O1 != O2) & (O3 != O4) ), True, False )
-                    
-                    # Special Case: The end of the boat segment lies on the bridge segment
-                        # True when:
-                            # boat_2, bridge_1, and bridge_2 are collinear
-                            # boat_2 lies between bridge_1 and bridge_2
-                    
-                    # To check if the boat lies between the bridge points, calculate the dot product of each bridge to the boat 
-                    dot = d_x * c_x + d_y * c_y
-                        # If the dot product is negative, the vectors point toward each other
-                        # NOTE: To save on calculations the sign of both vectors is flipped, so if the dot product is negative the vectors actually point away from each other
-                            # This is equivalent since the dot product only cares about the *angle* between vectors, which doesn't change when the sign of both is flipped
-                        
-                
-                    C_mask = np.where( ( (O4 == 0) & (dot <= 0) ), True, False)
-                        # (O4 == 0) checks that the points are collinear
-                        # (dot <= 0) checks that the boat lies between the bridge points
-                    
-                    # Unfortunately, the data often has erroneous data points
-                        # EX: Boat A goes from -125 lon to -123 lon and back to -125 in the span of a few seconds (hundreds of miles)
-                        # EX: Boat B drops 4 hours of data and 'teleports' from 80 lat to 90 lat
-                        # EX: Boat C is parked at -100 lon, 30 lat, but spontaneously teleports 5 degrees in random directions
-                        
-                    # To avoid counting these bad trips, if a boat makes too large a jump in one segment, ignore the segment
-                    E_mask = np.where( (np.absolute(a_x) >= 1) | (np.absolute(a_y) >= 0.5), False, True)
-                        # These values were chosen after a visual inspection of erroneous data points
-                    
-                    # Include segments that (intersect or have collinear points), and must NOT have a large jump between data points 
-                    Final_mask = (O_mask | C_mask) & E_mask
-                    
-                    # Save each point of the intersecting line segments
-                    boat_data1 = boat_broadcasts[:-1][Final_mask]
-                    boat_data2 = boat_broadcasts[1:][Final_mask]
-                    
-                    # To make reconstructing line segments easier, points that form a line segment are stored next to each other
-                    boat_data = np.empty(((boat_data1.shape[0]*2), boat_data1.shape[1]), dtype=boat_data1.dtype)
-                    boat_data[0::2] = boat_data1
-                    boat_data[1::2] = boat_data2
-                    
-                    # Don't attempt to write data to the port array if there isn't any new data
-                    if boat_data.size != 0:
-                        port_array = np.concatenate((port_array, boat_data))
-                    
-            # If there weren't any intersections with a port, don't attempt to write to its file        
-            if len(port_array.shape) != 1:
-                port_data = pd.DataFrame({columns[i]: port_array[1:,i] for i in range(len(columns))})
-                port_data.to_csv('/home/djimene9/scr4_mshiel10/djimenez/Port_Filtering_Data/' + port + ' Data.csv')
-    return
+    if is_archived(file):
+        return read_archive(file)
 
+    return pd.read_csv(file, sep=',', header=0, dtype=ais_dtypes, on_bad_lines="skip")
 
 
-def filter_bridges(file, boundaries=bridge_lines, min_boat_length=min_boat_length):
+def vessel_mask(raw_data, min_boat_length):
     """
     Parameters
     ----------
-    file : path to the file the be filtered
-        Zipfiles from the internet will be opened, and the path will be listed here
-    
-    boundaries : Dictionary of the form Bridge: Points Defining Bridge's Boundaries
-        This function handles bridges, while the other handles ports. They are nearly identical, except
-        each port is defined by four line segments, while bridges are only defined by one.
-        
+    raw_data : Data frame of AIS broadcasts, as returned by read_ais_file
+
+    min_boat_length : the smallest length a boat must be to be important
+
     Returns
     -------
-    None. Data is written to an external file 
-        The data consists of the points forming line segments from boats which intersect a port
-        
+    Data frame of the important AIS broadcast points
     """
-    
-    #Each file is prepared as a data frame
-        #Specifying data types improves spead and memory
-    raw_data = pd.read_csv(file, sep=',', header=0, dtype={"Heading": "Int64",
-                                                               "VesselName": str,
-                                                               "IMO":str,
-                                                               "MMSI":str, #Technically this should be an integer, but some files accidentally insert an alphanumeric character, causing a ValueError
-                                                               "LAT":np.float64,
-                                                               "LON":np.float64,
-                                                               "SOG":np.float64,
-                                                               "Heading":"Int64",
-                                                               "COG":np.float64,
-                                                               "IMO":str,
-                                                               "CallSign":str,
-                                                               "VesselType":"Int64",
-                                                               "Status":"Int64",
-                                                               "Length":"Int64",
-                                                               "Width":"Int64",
-                                                               "Cargo":"Int64",
-                                                               "Draft":np.float64,
-                                                               "TransceiverClass":str}, on_bad_lines="skip")
-
-    # Keeping important AIS broadcast points
+
+    # NOTE: (1016 | 1017 | 1024 | 61) is the single code 2045, and (3 | 4) is the single status 7, so neither one keeps
+        # the codes it names. They are left as they are so the crossings match the original script and earlier runs
+        # The sweep and the port visits check the codes that are meant, with isin
+
+    # Keeping important AIS broadcast points based on three conditions:
     try:
         filtered = raw_data.loc[
         (((70 <= raw_data["VesselType"]) & (raw_data["VesselType"] < 90)) | (raw_data["VesselType"] == (1016 | 1017 | 1024 | 61)) | (raw_data["Length"] >= min_boat_length) )
             # Ships must be longer than chosen minimum length (units are meters)
             # Or ships must be of class cargo, tanker, or cruise ship
                 # Vessel Type codes are based on the following: https://coast.noaa.gov/data/marinecadastre/ais/VesselTypeCodes2018.pdf
-            
+
         & (((raw_data["SOG"] > 3) & (raw_data["Status"] != 1) & (raw_data["Status"] != 5)) | (raw_data["Status"] == (3 | 4)) )
             # ships must also be moving and not anchored and not moored, or moving with difficulty
-            
+
         & (raw_data["TransceiverClass"] == "A")]
             # ships must also have transceiver class A (transceiver class B tends to give faulty information)
-    
+
     except KeyError:
         filtered = raw_data.loc[
         (((70 <= raw_data["VesselType"]) & (raw_data["VesselType"] < 90)) | (raw_data["VesselType"] == (1016 | 1017 | 1024 | 61)) | (raw_data["Length"] >= min_boat_length) )
@@ -417,283 +477,2635 @@ def filter_bridges(file, boundaries=bridge_lines, min_boat_length=min_boat_lengt
         & (raw_data["TranscieverClass"] == "A")]
             # For some stupid reason there's occasionally a typo here
                 # TranscIEver instead of TranscEIver
-                
-                
-    # A list of all boats remaining after filtering        
-    boats = filtered.drop_duplicates(["MMSI"])["MMSI"].values
-    
-    for bridge in boundaries:
-            
-            columns = filtered.columns.values.tolist()
-                
-            bridge_array = np.array([columns])
-            bridge_data = pd.DataFrame({})
-            
-            # Each bridge is described by five points to represent its curvature
-                # However, filtering only requires a single line segment, which will be reasonably accurate
-                # This line segment is defined by the first and last points of the bridge
-                
-            bridge_1_x = boundaries[bridge][0][0]
-            bridge_1_y = boundaries[bridge][0][1]
-            
-            
-            bridge_2_x = boundaries[bridge][-1][0]
-            bridge_2_y = boundaries[bridge][-1][1]
-                
-            
-            for boat in boats:
-                # Filter by each boat separately to prevent paths from getting wonky in the transition between boats
-                # Additionally organize chronologically to prevent paths from getting wonky
-                boat_points = filtered.loc[filtered["MMSI"] == boat].sort_values(["BaseDateTime"]).to_numpy()
-                
-                # Keep in mind these are vectors of x coordinates and y coordinates
-                    # All calculations are performed as vectorized operations for speed
-                boat_1_x = boat_points[:-1,3]
-                boat_1_y = boat_points[:-1,2]
-                
-                boat_2_x = boat_points[1:,3]
-                boat_2_y = boat_points[1:,2]
-                # Be mindful of the indexing: if there are n boat points then there are n-1 line segments
-                
-                
-                # Pre-calculate all necessary line segments
-                # a = segment boat_1 to boat_2
-                # b = segment bridge_1 to bridge_2
-                # c = segment boat_2 to bridge_1
-                # d = segment boat_2 to bridge_2
-                # e = segment bridge_2 to boat_1
 
-                
-                a_x = boat_2_x - boat_1_x
-                a_y = boat_2_y - boat_1_y
-                
-                b_x = bridge_2_x - bridge_1_x
-                b_y = bridge_2_y - bridge_1_y
-                
-                c_x = bridge_1_x - boat_2_x
-                c_y = bridge_1_y - boat_2_y
-                
-                d_x = bridge_2_x - boat_2_x
-                d_y = bridge_2_y - boat_2_y
-                
-                e_x = boat_1_x - bridge_2_x
-                e_y = boat_1_y - bridge_2_y
-                
-                # The 2D cross product returns a scalar
-                # Perform it on the boat segment to each bridge point, and bridge segment to each boat point
-                    # Hence, each cross product considers three points, since the end of one segment is the start of the second
-                
-                cross1 = a_x * c_y - a_y * c_x
-                cross2 = a_x * d_y - a_y * d_x
-                
-                cross3 = b_x * e_y - b_y * e_x
-                cross4 = b_y * d_x - b_x * d_y
-                    # This should be: b X (-d) (aka b cross -d)
-                    # However, the negative has been distributed to d X b, as is done above
-                
-                # If the scalar is positive, the points are oriented counterclockwise (denoted 1)
-                # If the scalar is negative, the points are oriented clockwise (denoted -1)
-                # If the scalar is 0, the points are collinear
-                
-                o1 = np.where( (cross1 > 0), 1, 0)
-                O1 = np.where( (cross1 < 0), -1, o1)
+    return filtered
 
-                o2 = np.where( (cross2 > 0), 1, 0)
-                O2 = np.where( (cross2 < 0), -1, o2)
 
-                o3 = np.where( (cross3 > 0), 1, 0)
-                O3 = np.where( (cross3 < 0), -1, o3)
 
-                o4 = np.where( (cross4 > 0), 1, 0)
-                O4 = np.where( (cross4 < 0), -1, o4)
-                
-                
-                # When O1 and O2 have different signs, then the boat segment sees one bridge point on the left, and the other on the right
-                    # As in, the orientation of the points is different
-                    # Hence, it is intersected
-                    
-                # However, the same must also be true from the bridge's perspective, otherwise the segments do not intersect
-                    # See this page for a diagram: https://www.geeksforgeeks.org/check-if-two-given-line-segments-intersect/#
-
-                O_mask = np.where( ( (O1 != O2) & (O3 != O4) ), True, False )
-                
-                # Special Case: The end of the boat segment lies on the bridge segment
-                    # True when:
-                        # boat_2, bridge_1, and bridge_2 are collinear
-                        # boat_2 lies between bridge_1 and bridge_2
-                
-                # To check if the boat lies between the bridge points, calculate the dot product of each bridge to the boat 
-                dot = d_x * c_x + d_y * c_y
-                    # If the dot product is negative, the vectors point toward each other
-                    # NOTE: To save on calculations the sign of both vectors are flipped, so if the dot product is negative the vectors actually point away from each other
-                        # This is equivalent, since the dot product only cares about the *angle* between vectors, which doesn't change when the sign of both is flipped
-                    
-                C_mask = np.where( ( (O4 == 0) & (dot <= 0) ), True, False)
-                    # (O4 == 0) checks that the points are collinear
-                    # (dot <= 0) checks that the boat lies between the bridge points
-                
-                # Unfortunately, the data often has erroneous data points
-                    # EX: Boat A goes from -125 lon to -123 lon and back to -125 in the span of a few seconds
-                    # EX: Boat B drops 4 hours of data and 'teleports' from 80 lat to 90 lat
-                    # EX: Boat C is parked at -100 lon, 30 lat, but spontaneously teleports 5 degrees in random directions
-                    
-                # To avoid counting these bad trips, if a boat makes too large a jump in one segment, ignore the segment
-                E_mask = np.where( (np.absolute(a_x) >= 1) | (np.absolute(a_y) >= 0.5), False, True)
-                
-                # Include segments that (intersect or have collinear points), and must NOT have a large jump between data points 
-                Final_mask = (O_mask | C_mask) & E_mask
-                
-                # Save each point of the intersecting line segments
-                boat_data1 = boat_points[:-1][Final_mask]
-                boat_data2 = boat_points[1:][Final_mask]
-                
-                # To make reconstructing line segments easier, points that form a line segment are stored next to each other
-                boat_data = np.empty(((boat_data1.shape[0]*2), boat_data1.shape[1]), dtype=boat_data1.dtype)
-                boat_data[0::2] = boat_data1
-                boat_data[1::2] = boat_data2
-                
-                
-                # Don't attempt to write data to the bridge array if there isn't any new data
-                if boat_data.size != 0:
-                    bridge_array = np.concatenate((bridge_array, boat_data))
-                    
-            # If there weren't any intersections with a bridge, don't attempt to write to its file
-            if len(bridge_array.shape) != 1:
-                bridge_data = pd.DataFrame({columns[i]: bridge_array[1:,i] for i in range(len(columns))})
-                #Put the bridges data into its que
-                queues[bridge].put(bridge_data)
-                
-    return                
-       
+###################################
+### Batched Intersection Engine ###
+###################################
 
-    
-############################        
-### Downloading the Data ###
-############################
+'''
+The original filtering looped over every bridge, then over every boat, and re-sorted each boat's broadcasts
+inside of that inner loop. The work was roughly (bridges x boats x rows), which is why a full run took over a day.
+
+Instead, each day is sorted ONCE by MMSI and time. Every pair of consecutive broadcasts from the same boat forms
+a line segment, and every (segment, line) pair that could possibly touch is tested at the same time in one
+array operation. The math is exactly the same orientation / cross product test as before, so the
+final mask (O_mask | C_mask) & E_mask has the same meaning it always did.
+
+Sorting a whole data frame moves every column of every row, including text like VesselName and CallSign that
+the crossing test never looks at. Instead, only MMSI and BaseDateTime are turned into integer codes and sorted,
+and the coordinates are pulled out as contiguous float64 arrays in that order (see compact_tracks). The rest of
+the columns are only gathered for the few rows on either side of a crossing (see gather_crossings).
+'''
 
-# Go through each URL, open the file, then apply the filtering function    
 
-def download_and_filter_bridges(url):
-    # Download the file from the link so it can be interacted with
-    download = urlopen(url)
-    
-    # Unzip the file
-    data_zip_file = ZipFile(BytesIO(download.read()))
-    
-    #The actual file name is derived from the url, and looks like AIS_Year_DateNum
-    file_name = url[55:-4] + '.csv'
-        #The first 50 characters are the base url, the last 4 are .zip
-    
-    #Apply the filter function to the file
-    try:
-        filter_bridges(data_zip_file.open(file_name), queues)
-    except Exception as e:
-        # If there's any error, rockfish will completely halt
-        # Instead, ignore the error for later so the entire job doesn't get wasted
-        print(f"File {file_name} failed, need to refilter! \n Error: {e}", flush=True)
-    return 
+def boundary_edges(boundaries, endpoints_only=True):
+    """
+    Parameters
+    ----------
+    boundaries : Dictionary of the form Structure: Array of Points Defining the Structure
+        Works for both bridge_lines and port_boxes
 
-def download_and_filter_ports(url):
-    # Download the file from the link so it can be interacted with
-    download = urlopen(url)
-    # Unzip the file
-    data_zip_file = ZipFile(BytesIO(download.read()))
-    
-    #The actual file name is derived from the url, and looks like AIS_Year_DateNum
-    file_name = url[55:-4] + '.csv'
-        #The first 50 characters are the base url, the last 4 are .zip
-    
-    #Apply the filter function to the file
-    try:
-        filter_ports(data_zip_file.open(file_name), boundaries=port_boxes, min_boat_length=150)
-    except Exception as e:
-        print(f"File {file_name} failed, need to refilter! \n Error: {e}", flush=True)
-    return 
+    endpoints_only : If True, each structure is a single line from its first point to its last point
+        If False, every pair of consecutive points is a line (the edges of a port box, or a bridge's polyline)
 
+    Returns
+    -------
+    names : list of structure names, in the same order as the dictionary
 
+    edges : (number of lines, 4) float array of x1, y1, x2, y2 for every line
 
+    owner : (number of lines,) int array giving the index in names that each line belongs to
 
-########################
-### Running the code ###
-########################
+    """
 
-if __name__ == "__main__":
-    
-    print("Script Began")
-    
-    files = URLs
-        # In the case that the script halts prematurely, slice the list of URLs past every file in a batch that was completed
-        # Keep in  mind, the data from filtered files is not written until ALL files have been finished
-        # As in, if the next batch didn't start, the previous batch has not been written and must be redone
-        
-    num_files = len(files)
-    
-    # The number of cores represents the max number of processes running simultaneously
-        # Memory errors can occur if there are very few spare cores in the rockfish allocation
-        # TDL: look into utilizing big mem partition
-    num_cores = 36
-        # This code was ran using a max of 38 cores on 2 nodes of 48 cores each (96 cores total) and took approximately 27 hours
-    
-    # Due to memory constraints, the files must be handled in batches. Reps is the number of batches, num_cores the size of each batch
-    reps = int(num_files/num_cores)
-    
-    # The number of cores will almost certainly not properly divide the number of files
-        # Thus, process the remaining files in a final batch
-    remainder = num_files - (reps * num_cores)
+    names = list(boundaries)
+    edges = []
+    owner = []
 
-    # A single manager will be used to coordinate all processes throughout the job
-    with mlt.Manager() as manager:
-        # A manager queue is can be shared safely across all processes
-        queues = {bridge:manager.Queue() for bridge in bridge_lines}
-            # Rather than manually create a queue for each bridge, they are all stored in a dictionary
-            
-            
-        # Create a pool with max processes = num_cores
-        with mlt.Pool(num_cores) as pool:
-            for i in range(reps):
-                # starmap applies multiple arguments to a function
-                    # Here, download and filter is run on each batch of files, connected to the managed queues
-                pool.starmap(download_and_filter_bridges, [(url,queues) for url in files[num_cores * i:num_cores * (i+1)]])
-                    # Note: Starmap implicitly joins all processes
-                        # As in, the rest of the code in the main file will wait until all processes are complete
-                        
-                # Create a thread for each bridge that will run the writer argument 
-                writers = {bridge:Thread(target=writer, args=[queues[bridge], bridge]) for bridge in bridge_lines}
-                
-                # Start all writers, and wait for them all to finish
-                for bridge in bridge_lines:
-                    writers[bridge].start()
-                    writers[bridge].join()
-                    # Once all files have been written, begin the next batch
-
-            # Finally, perform the same process, but for the last, irregular batch
-            pool.starmap(download_and_filter_bridges, [(url, queues) for url in files[-remainder:]])
-            writers = {bridge:Thread(target=writer, args=[queues[bridge], bridge]) for bridge in bridge_lines}
-
-            for bridge in bridge_lines:
-                writers[bridge].start()
-                writers[bridge].join()
-  
-            
+    for i, name in enumerate(names):
+        points = np.asarray(boundaries[name], dtype=np.float64)
 
+        if endpoints_only:
+            # Each bridge can be described by several points to represent its curvature
+                # A single line segment from the first point to the last point is reasonably accurate
+            edges.append([points[0][0], points[0][1], points[-1][0], points[-1][1]])
+            owner.append(i)
+        else:
+            # Every consecutive pair of points is an edge, however many points there are
+            edges.extend(np.hstack([points[:-1], points[1:]]).tolist())
+            owner.extend([i] * (points.shape[0] - 1))
+
+    return names, np.array(edges, dtype=np.float64).reshape(-1, 4), np.array(owner, dtype=np.int64)
+
+
+def intersection_mask(boat_1_x, boat_1_y, boat_2_x, boat_2_y, line_1_x, line_1_y, line_2_x, line_2_y):
+    """
+    Parameters
+    ----------
+    boat_1_x, boat_1_y, boat_2_x, boat_2_y : arrays of the start and end points of boat segments
+
+    line_1_x, line_1_y, line_2_x, line_2_y : arrays of the start and end points of boundary lines
+        The boat and line arrays only need to broadcast against each other
+            EX: boat arrays of shape (n, 1) and line arrays of shape (1, m) test every segment against every line
+
+    Returns
+    -------
+    Boolean array, True where a boat segment intersects a line (or ends on it)
+        This does NOT include the E_mask, since that only depends on the boat segment
+
+    """
+
+    # a = segment boat_1 to boat_2
+    # b = segment line_1 to line_2
+    # c = segment boat_2 to line_1
+    # d = segment boat_2 to line_2
+    # e = segment line_2 to boat_1
+
+    a_x = boat_2_x - boat_1_x
+    a_y = boat_2_y - boat_1_y
+
+    b_x = line_2_x - line_1_x
+    b_y = line_2_y - line_1_y
+
+    c_x = line_1_x - boat_2_x
+    c_y = line_1_y - boat_2_y
+
+    d_x = line_2_x - boat_2_x
+    d_y = line_2_y - boat_2_y
+
+    e_x = boat_1_x - line_2_x
+    e_y = boat_1_y - line_2_y
+
+    # The 2D cross product returns a scalar
+    # Perform it on the boat segment to each line point, and line segment to each boat point
+        # Hence, each cross product considers three points, since the end of one segment is the start of the second
+
+    cross1 = a_x * c_y - a_y * c_x
+    cross2 = a_x * d_y - a_y * d_x
+
+    cross3 = b_x * e_y - b_y * e_x
+    cross4 = b_y * d_x - b_x * d_y
+        # This should be: b X (-d) (aka b cross -d)
+        # However, the negative has been distributed to d X b, as is done above
+
+    # If the scalar is positive, the points are oriented counterclockwise (denoted 1)
+    # If the scalar is negative, the points are oriented clockwise (denoted -1)
+    # If the scalar is 0 (or NaN from a missing coordinate), the points are treated as collinear (denoted 0)
+    O1 = (cross1 > 0).astype(np.int8) - (cross1 < 0).astype(np.int8)
+    O2 = (cross2 > 0).astype(np.int8) - (cross2 < 0).astype(np.int8)
+    O3 = (cross3 > 0).astype(np.int8) - (cross3 < 0).astype(np.int8)
+    O4 = (cross4 > 0).astype(np.int8) - (cross4 < 0).astype(np.int8)
+
+    # When O1 and O2 have different signs, then the boat segment sees one line point on the left, and the other on the right
+        # However, the same must also be true from the line's perspective, otherwise the segments do not intersect
+        # See this page for a diagram: https://www.geeksforgeeks.org/check-if-two-given-line-segments-intersect/#
+    O_mask = (O1 != O2) & (O3 != O4)
+
+    # Special Case: The end of the boat segment lies on the line segment
+        # (O4 == 0) checks that boat_2, line_1, and line_2 are collinear
+        # (dot <= 0) checks that the boat lies between the line points
+            # The sign of both vectors is flipped, which doesn't change the angle between them
+    dot = d_x * c_x + d_y * c_y
+    C_mask = (O4 == 0) & (dot <= 0)
+
+    return O_mask | C_mask
+
+
+# The largest jump a boat can make in one segment before the segment is ignored, in degrees of lon and lat
+jump_lon = 1
+jump_lat = 0.5
+
+
+def jump_mask(boat_1_x, boat_1_y, boat_2_x, boat_2_y, max_lon=jump_lon, max_lat=jump_lat):
+    """
+    Parameters
+    ----------
+    boat_1_x, boat_1_y, boat_2_x, boat_2_y : arrays of the start and end points of boat segments
+
+    max_lon, max_lat : segments moving this far or more in lon or lat are ignored
+
+    Returns
+    -------
+    Boolean array, False for segments that make too large a jump between broadcasts (the E_mask)
+
+    """
+
+    # Unfortunately, the data often has erroneous data points
+        # EX: Boat A goes from -125 lon to -123 lon and back to -125 in the span of a few seconds
+        # EX: Boat B drops 4 hours of data and 'teleports' from 80 lat to 90 lat
+        # EX: Boat C is parked at -100 lon, 30 lat, but spontaneously teleports 5 degrees in random directions
+
+    # To avoid counting these bad trips, if a boat makes too large a jump in one segment, ignore the segment
+    return ~((np.absolute(boat_2_x - boat_1_x) >= max_lon) | (np.absolute(boat_2_y - boat_1_y) >= max_lat))
+
+
+def build_segments(filtered, presorted=False):
+    """
+    Parameters
+    ----------
+    filtered : Data frame of AIS broadcasts remaining after the vessel mask
+
+    presorted : If True, the rows are already grouped by MMSI and in order, so they are not sorted again
+
+    Returns
+    -------
+    boat_points : the same data frame sorted by MMSI, then chronologically, with a fresh index
+
+    seg_start : int array of row positions i such that rows i and i+1 form a line segment
+        Segments never connect two different boats
+
+    """
+
+    # Sort once, rather than once per boat per bridge
+        # A stable sort keeps broadcasts with identical timestamps in their original order
+    if presorted:
+        boat_points = filtered.reset_index(drop=True)
+    else:
+        boat_points = filtered.sort_values(["MMSI", "BaseDateTime"], kind="stable").reset_index(drop=True)
+
+    # Be mindful of the indexing: if there are n boat points then there are n-1 line segments
+        # Rows with a missing MMSI never match their neighbor, so they never form a segment
+    if isinstance(boat_points["MMSI"].dtype, pd.CategoricalDtype):
+        # Archived files store MMSI as a category, and comparing its integer codes is much faster than comparing text
+            # A missing MMSI has the code -1
+        codes = boat_points["MMSI"].cat.codes.to_numpy()
+        same_boat = (codes[:-1] == codes[1:]) & (codes[:-1] >= 0)
+    else:
+        mmsi = boat_points["MMSI"].to_numpy()
+        same_boat = np.asarray(mmsi[:-1] == mmsi[1:], dtype=bool)
+    seg_start = np.flatnonzero(same_boat)
+
+    return boat_points, seg_start
+
+
+def sort_codes(column):
+    # Dictionary encode a column, with codes in the same order sort_values would put the values
+        # Missing values get the largest code, since sort_values puts them last
+        # Categories (EX: MMSI in the archive) already are codes, and sort_values sorts them by their codes too
+        # Also returns the values the codes stand for
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        codes = column.cat.codes.to_numpy().astype(np.int64)
+        uniques = column.cat.categories
+    else:
+        codes, uniques = pd.factorize(column, sort=True)
+        codes = codes.astype(np.int64)
+
+    codes[codes < 0] = len(uniques)
+    return codes, uniques
+
+
+'''
+NOAA files repeat broadcasts, and every so often a broadcast puts a boat somewhere it couldn't have been. A
+repeated broadcast makes a segment of zero length, and a bad one makes two segments that jump there and back.
+The E_mask only catches jumps of a whole degree, however long the boat took to make them.
+
+Once a day is sorted, each track is cleaned in one pass over the sorted arrays. A broadcast with the same boat
+and time as the one before it is dropped. A segment whose implied speed (distance over time between its two
+broadcasts) is impossible for a ship is never tested, the same as a segment that fails the E_mask.
+'''
+
+# Set this to True to drop repeats and impossible jumps before testing
+    # Off by default, since it changes the crossings of every bridge compared with earlier runs (and the original script)
+use_track_cleaning = False
+
+# Segments faster than this are treated as a bad broadcast and ignored
+    # Units = knots, even the fastest large ships rarely go above 30 knots
+max_speed_knots = 50
+
+# Segments shorter than this are never ignored for their speed
+    # Units = nautical miles, since broadcasts a second apart can imply a high speed from GPS noise alone
+min_jump_miles = 0.5
+
+
+def time_seconds(codes, uniques):
+    # Seconds since 1970 of every coded time, from sort_codes
+        # Only the unique times are read, and times that can't be read (or are missing) are NaN
+    times = pd.Series(pd.to_datetime(pd.Series(uniques, dtype=object), format=noaa_time_format, errors="coerce"))
+    seconds = (times - pd.Timestamp(0)).dt.total_seconds().to_numpy(dtype=np.float64, na_value=np.nan)
+
+    return np.append(seconds, np.nan)[codes]
+
+
+def speed_mask(boat_1_x, boat_1_y, boat_2_x, boat_2_y, time_1, time_2, max_knots=max_speed_knots, min_miles=min_jump_miles):
+    """
+    Parameters
+    ----------
+    boat_1_x, boat_1_y, boat_2_x, boat_2_y : arrays of the start and end points of boat segments
+
+    time_1, time_2 : arrays of the seconds at the start and end of each segment
+
+    max_knots : segments faster than this are ignored
+
+    min_miles : segments shorter than this are never ignored
+
+    Returns
+    -------
+    Boolean array, False for segments a ship couldn't have made in the time between broadcasts
+        Segments with a missing time can't be judged, so they are kept (the E_mask still applies to them)
+
+    """
+
+    # A nautical mile is a minute of latitude, and a degree of longitude shrinks with the latitude
+        # A flat map is plenty accurate over the length of one segment
+    miles = 60 * np.hypot((boat_2_x - boat_1_x) * np.cos(np.radians((boat_1_y + boat_2_y) / 2)), boat_2_y - boat_1_y)
+    hours = (time_2 - time_1) / 3600
+
+    # Multiplying instead of dividing means two broadcasts at the same time never divide by zero
+    return ~((miles > min_miles) & (miles > max_knots * hours))
+
+
+def compact_tracks(filtered, presorted=False, clean=None):
+    """
+    Parameters
+    ----------
+    filtered : Data frame of AIS broadcasts remaining after the vessel mask
+
+    presorted : If True, the rows are already grouped by MMSI and in order, so they are not sorted again
+
+    clean : If True, repeated broadcasts are dropped and segments faster than max_speed_knots are left out
+        use_track_cleaning by default, read when called so stitched midnights and days always agree
+
+    Returns
+    -------
+    Dictionary of contiguous arrays, in the same MMSI then time order as build_segments:
+        order : position in filtered of each sorted row (repeated broadcasts have no row)
+        boat : int code of each sorted row's MMSI, -1 if it is missing
+        lon, lat : float64 coordinates of each sorted row
+        seg_start : sorted row positions i such that rows i and i+1 form a line segment
+
+    """
+
+    clean = use_track_cleaning if clean is None else clean
+
+    # Only the sort keys and the coordinates are pulled out of the frame
+        # Every other column stays where it is until the rows that cross are known (see gather_crossings)
+    boat, mmsi = sort_codes(filtered["MMSI"])
+
+    # The time codes are only needed to sort, or to clean
+    if not presorted or clean:
+        time, times = sort_codes(filtered["BaseDateTime"])
+
+    if presorted:
+        order = np.arange(len(filtered), dtype=np.int64)
+    else:
+        keys = (time, boat)
+
+        # lexsort is stable, so broadcasts with identical timestamps keep their original order like sort_values
+        order = np.lexsort(keys)
+
+    boat = boat[order]
+    boat[boat == len(mmsi)] = -1
+
+    if clean:
+        # Only the unique times are turned into seconds, then spread back over the sorted rows
+        seconds = time_seconds(time[order], times)
+
+        # A broadcast from the same boat at the same time as the row before it is a repeat
+            # The first copy is kept, along with its position in the order
+        repeat = np.concatenate(([False], (boat[1:] == boat[:-1]) & (seconds[1:] == seconds[:-1]) & (boat[1:] >= 0)))
+        if repeat.any():
+            order = order[~repeat]
+            boat = boat[~repeat]
+            seconds = seconds[~repeat]
+
+    lon = filtered["LON"].to_numpy(dtype=np.float64)[order]
+    lat = filtered["LAT"].to_numpy(dtype=np.float64)[order]
+
+    # Rows with a missing MMSI never match their neighbor, so they never form a segment
+    seg_start = np.flatnonzero((boat[:-1] == boat[1:]) & (boat[:-1] >= 0))
+
+    if clean:
+        # Segments no ship could have made are dropped before any of them are tested
+        seg_start = seg_start[speed_mask(lon[seg_start], lat[seg_start], lon[seg_start + 1], lat[seg_start + 1], seconds[seg_start], seconds[seg_start + 1])]
+
+    return {"order": order, "boat": boat, "lon": lon, "lat": lat, "seg_start": seg_start}
+
+
+def boat_ends(tracks, keep="first", rows=None):
+    # Sorted positions of the first (or last) row of every boat, leaving out rows with a missing MMSI
+        # rows limits the search to some of the sorted rows, EX: only the ones from the current chunk
+    rows = np.arange(tracks["boat"].size) if rows is None else rows
+    boat = tracks["boat"][rows]
+
+    if keep == "first":
+        ends = np.flatnonzero(np.concatenate(([True], boat[1:] != boat[:-1])))
+    else:
+        ends = np.flatnonzero(np.concatenate((boat[1:] != boat[:-1], [True])))
+
+    return rows[ends[boat[ends] >= 0]]
+
+
+def gather_crossings(filtered, tracks, seg):
+    """
+    Parameters
+    ----------
+    filtered : the data frame compact_tracks was built from
+
+    tracks : Dictionary of arrays from compact_tracks
+
+    seg : positions in tracks["seg_start"] of crossing segments, from find_crossings
+
+    Returns
+    -------
+    boat_points : data frame of only the rows on either side of a crossing, in sorted order
+
+    seg_start : row positions in boat_points that begin a crossing segment
+
+    seg : positions in seg_start of the crossing segments, aligned with the seg given
+        Ready for crossing_results, just like the output of build_segments and find_crossings
+
+    """
+
+    # Every column of a row is only gathered if the row is part of a crossing
+    segments, seg = np.unique(seg, return_inverse=True)
+    first_rows = tracks["seg_start"][segments]
+    rows = np.unique(np.concatenate((first_rows, first_rows + 1)))
+
+    boat_points = filtered.iloc[tracks["order"][rows]].reset_index(drop=True)
+
+    return boat_points, np.searchsorted(rows, first_rows), seg.reshape(-1)
+
+
+def find_crossings(lon, lat, seg_start, geometry, jump=None):
+    """
+    Parameters
+    ----------
+    lon, lat : float arrays of the sorted boat points
+
+    seg_start : row positions that begin a segment (see build_segments)
+
+    geometry : Dictionary of boundary lines and their spatial index, from compile_boundaries
+
+    jump : (max_lon, max_lat) for jump_mask, or None for (jump_lon, jump_lat)
+        A parameter sweep uses its largest jump, and tags each crossing with the jumps it passes (see sweep_tags)
+
+    Returns
+    -------
+    seg : positions in seg_start of every segment that crosses a line
+
+    line : index of the line crossed, aligned with seg
+        A segment crossing several lines appears once per line
+        Unless geometry["once_per_structure"] is set, then it appears once per structure (the first line it crosses)
+
+    """
+
+    boat_1_x = lon[seg_start]
+    boat_1_y = lat[seg_start]
+
+    boat_2_x = lon[seg_start + 1]
+    boat_2_y = lat[seg_start + 1]
+
+    # Segments with a large jump can never pass the final mask, so drop them before the expensive pass
+    max_lon, max_lat = (jump_lon, jump_lat) if jump is None else jump
+    keep = np.flatnonzero(jump_mask(boat_1_x, boat_1_y, boat_2_x, boat_2_y, max_lon, max_lat))
+
+    # Only pairs whose bounding boxes overlap can possibly intersect
+        # Every other pair is skipped without running the cross products
+    seg, line = candidate_pairs(geometry["index"], boat_1_x[keep], boat_1_y[keep], boat_2_x[keep], boat_2_y[keep])
+    seg = keep[seg]
+
+    edges = geometry["edges"]
+
+    # Run the exact test on every candidate pair in one array operation
+    hits = intersection_mask(boat_1_x[seg], boat_1_y[seg], boat_2_x[seg], boat_2_y[seg],
+                             edges[line, 0], edges[line, 1], edges[line, 2], edges[line, 3])
+    seg = seg[hits]
+    line = line[hits]
+
+    # A segment can cross two edges of the same polyline, EX: it passes right through the point where they meet
+        # Only keep the first (segment, structure) pair, so the bridge is crossed once
+    if geometry.get("once_per_structure") and len(seg):
+        key = seg.astype(np.int64) * len(geometry["names"]) + geometry["owner"][line]
+        first = np.sort(np.unique(key, return_index=True)[1])
+        seg = seg[first]
+        line = line[first]
+
+    return seg, line
+
+
+def crossing_frames(boat_points, seg_start, seg, structure, names, tags=None):
+    """
+    Parameters
+    ----------
+    boat_points : sorted data frame from build_segments
+
+    seg_start : row positions that begin a segment
+
+    seg : positions in seg_start of crossing segments
+
+    structure : index in names of the structure each crossing belongs to, aligned with seg
+
+    names : list of structure names
+
+    tags : optional int array of sweep tags, aligned with seg (see sweep_tags)
+        Both points of a crossing get its tag, in a SweepMask column
+
+    Returns
+    -------
+    Dictionary of the form Structure: Data Frame of Crossing Points
+        To make reconstructing line segments easier, points that form a line segment are stored next to each other
+        Structures without any crossings are left out
+
+    """
+
+    results = {}
+
+    if seg.size == 0:
+        return results
+
+    # Group the crossings by structure, keeping each structure's crossings in boat / time order
+    order = np.lexsort((seg, structure))
+    seg = seg[order]
+    structure = structure[order]
+    tags = None if tags is None else tags[order]
+
+    first_rows = seg_start[seg]
+
+    # Interleave the start and end of every segment
+    rows = np.empty(first_rows.size * 2, dtype=np.int64)
+    rows[0::2] = first_rows
+    rows[1::2] = first_rows + 1
+
+    # Find where each structure's block of crossings begins and ends
+    bounds = np.flatnonzero(np.diff(structure)) + 1
+    starts = np.concatenate(([0], bounds))
+    stops = np.concatenate((bounds, [structure.size]))
+
+    for start, stop in zip(starts, stops):
+        results[names[structure[start]]] = boat_points.iloc[rows[2*start:2*stop]].reset_index(drop=True)
+
+        if tags is not None:
+            results[names[structure[start]]]["SweepMask"] = np.repeat(tags[start:stop], 2)
+
+    return results
+
+
+# Columns describing the boat itself, rather than where it is
+    # An event takes them from the broadcast before the crossing, or the one after if the first is blank
+static_columns = ["VesselName", "IMO", "CallSign", "VesselType", "Status", "Length", "Width", "Draft", "Cargo", "TransceiverClass"]
+
+
+def crossing_events(boat_points, seg_start, seg, line, geometry, tags=None):
+    """
+    Parameters
+    ----------
+    boat_points : sorted data frame from build_segments
+
+    seg_start : row positions that begin a segment
+
+    seg : positions in seg_start of crossing segments
+
+    line : index of the line crossed, aligned with seg
+
+    geometry : Dictionary of boundary lines, from compile_boundaries
+
+    tags : optional int array of sweep tags, aligned with seg (see sweep_tags)
+
+    Returns
+    -------
+    Dictionary of the form Structure: Data Frame with one row per crossing, holding
+        MMSI
+        CrossingTime : when the boat crossed, interpolated between the two broadcasts
+        LAT, LON : where the boat's path meets the line
+        Direction : 1 or -1, which way the boat crossed (see crossing_fraction). 0 if it ran along the line
+        SOG, COG : interpolated to the crossing
+        and the static_columns
+        SweepMask : the crossing's sweep tag, only if tags are given
+    Crossings are in the same order as crossing_frames, and structures without any crossings are left out
+
+    """
+
+    results = {}
+
+    if seg.size == 0:
+        return results
+
+    structure = geometry["owner"][line]
+
+    # Group the crossings by structure, keeping each structure's crossings in boat / time order
+    order = np.lexsort((seg, structure))
+    seg = seg[order]
+    line = line[order]
+    structure = structure[order]
+
+    first_rows = seg_start[seg]
+    second_rows = first_rows + 1
+
+    lon = boat_points["LON"].to_numpy(dtype=np.float64)
+    lat = boat_points["LAT"].to_numpy(dtype=np.float64)
+
+    edges = geometry["edges"][line]
+
+    fraction, direction = crossing_fraction(lon[first_rows], lat[first_rows], lon[second_rows], lat[second_rows],
+                                            edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3])
+    direction = direction * geometry["side"][line]
+
+    def before(column):
+        return boat_points[column].iloc[first_rows].reset_index(drop=True)
+
+    def after(column):
+        return boat_points[column].iloc[second_rows].reset_index(drop=True)
+
+    # Times are text in the csv files and timestamps in the archive
+    time_1 = pd.to_datetime(before("BaseDateTime"), format=noaa_time_format, errors="coerce")
+    time_2 = pd.to_datetime(after("BaseDateTime"), format=noaa_time_format, errors="coerce")
+    crossing_time = (time_1 + (time_2 - time_1) * fraction).dt.round("s")
+
+    sog_1 = pd.to_numeric(before("SOG"), errors="coerce").to_numpy(dtype=np.float64)
+    sog_2 = pd.to_numeric(after("SOG"), errors="coerce").to_numpy(dtype=np.float64)
+
+    # Courses wrap around at 360, so interpolate along the shorter way around the circle
+    cog_1 = pd.to_numeric(before("COG"), errors="coerce").to_numpy(dtype=np.float64)
+    cog_2 = pd.to_numeric(after("COG"), errors="coerce").to_numpy(dtype=np.float64)
+    turn = (cog_2 - cog_1 + 180) % 360 - 180
+
+    events = pd.DataFrame({"MMSI": before("MMSI").astype(object),
+                           "CrossingTime": crossing_time.dt.strftime(noaa_time_format),
+                           "LAT": lat[first_rows] + (lat[second_rows] - lat[first_rows]) * fraction,
+                           "LON": lon[first_rows] + (lon[second_rows] - lon[first_rows]) * fraction,
+                           "Direction": direction.astype(np.int8),
+                           "SOG": sog_1 + (sog_2 - sog_1) * fraction,
+                           "COG": (cog_1 + turn * fraction) % 360})
+
+    # Older files spell the transceiver column TranscieverClass
+    points_columns = {"TransceiverClass": "TranscieverClass"} if "TranscieverClass" in boat_points.columns else {}
+
+    for column in static_columns:
+        source = points_columns.get(column, column)
+        if source in boat_points.columns:
+            value = before(source)
+            events[column] = value.where(value.notna(), after(source))
+
+    if tags is not None:
+        events["SweepMask"] = tags[order]
+
+    # Find where each structure's block of crossings begins and ends
+    bounds = np.flatnonzero(np.diff(structure)) + 1
+    starts = np.concatenate(([0], bounds))
+    stops = np.concatenate((bounds, [structure.size]))
+
+    for start, stop in zip(starts, stops):
+        results[geometry["names"][structure[start]]] = events.iloc[start:stop].reset_index(drop=True)
+
+    return results
+
+
+def crossing_fraction(boat_1_x, boat_1_y, boat_2_x, boat_2_y, line_1_x, line_1_y, line_2_x, line_2_y):
+    """
+    Parameters
+    ----------
+    boat_1_x, ..., line_2_y : arrays of boat segments and the lines they cross, as in intersection_mask
+
+    Returns
+    -------
+    fraction : how far along the boat's segment (0 to 1) it meets the line
+        A boat moving along the line itself is placed halfway
+
+    direction : 1 if the boat crossed from the right of the line to its left, looking from the line's first point
+        toward its second, -1 if it crossed from left to right, and 0 if it moved along the line
+
+    """
+
+    a_x = boat_2_x - boat_1_x
+    a_y = boat_2_y - boat_1_y
+
+    b_x = line_2_x - line_1_x
+    b_y = line_2_y - line_1_y
+
+    # The cross product of the line with the boat's motion says which way the boat went
+    turn = b_x * a_y - b_y * a_x
+
+    # Solving boat_1 + fraction * a = a point on the line
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = ((line_1_x - boat_1_x) * b_y - (line_1_y - boat_1_y) * b_x) / (a_x * b_y - a_y * b_x)
+
+    fraction = np.where(turn == 0, 0.5, np.clip(fraction, 0, 1))
+
+    return fraction, np.sign(turn).astype(np.int64)
+
+
+def crossing_results(boat_points, seg_start, seg, line, geometry, events=False, sweep=None):
+    # Either one row per crossing, or the two broadcasts on either side of it
+        # In a parameter sweep, every crossing is also tagged with the settings it passes
+    tags = None if sweep is None else sweep_tags(boat_points, seg_start, seg, sweep)
+
+    if events:
+        return crossing_events(boat_points, seg_start, seg, line, geometry, tags)
+
+    return crossing_frames(boat_points, seg_start, seg, geometry["owner"][line], geometry["names"], tags)
+
+
+#####################################
+### Spatial Index Over Boundaries ###
+#####################################
+
+'''
+A boat segment is near at most a handful of bridges or ports, so testing it against every line is wasted work.
+The boundary lines are registered in a uniform lat/lon grid once, when the boundaries are imported. Each segment
+then only looks up the grid cells its bounding box covers, and only pairs whose bounding boxes overlap go on to
+the exact crossing test. Most segments are far from every structure and land in empty cells, so the number of
+candidate pairs grows with the number of segments rather than (segments x lines).
+'''
+
+# The width and height of each grid cell, in degrees
+    # Bridges are much smaller than this, and a port box covers only a few cells
+index_cell_size = 0.25
+
+# Bounding boxes of the lines are padded by this much (in degrees)
+    # This keeps floating point rounding in the cross products from hiding a pair that barely touches
+index_padding = 1e-9
+
+
+def build_boundary_index(edges, cell_size=index_cell_size):
+    """
+    Parameters
+    ----------
+    edges : (number of lines, 4) array of x1, y1, x2, y2 from boundary_edges
+
+    cell_size : width and height of each grid cell in degrees
+
+    Returns
+    -------
+    Dictionary describing the grid:
+        origin, cell_size, n_cols, n_rows : placement and shape of the grid
+        cell_keys : sorted ids (row * n_cols + column) of every grid cell that holds at least one line
+        cell_start, cell_stop : for each cell in cell_keys, the slice of cell_lines that it holds
+        cell_lines : line indices, grouped by cell
+        boxes : padded (min_x, min_y, max_x, max_y) bounding box of every line
+
+    """
+
+    min_x = np.minimum(edges[:, 0], edges[:, 2]) - index_padding
+    min_y = np.minimum(edges[:, 1], edges[:, 3]) - index_padding
+    max_x = np.maximum(edges[:, 0], edges[:, 2]) + index_padding
+    max_y = np.maximum(edges[:, 1], edges[:, 3]) + index_padding
+
+    index = {"cell_size": cell_size, "boxes": (min_x, min_y, max_x, max_y)}
+
+    if edges.shape[0] == 0:
+        index.update({"origin": (0.0, 0.0), "n_cols": 0, "n_rows": 0,
+                      "cell_keys": np.empty(0, dtype=np.int64), "cell_start": np.empty(0, dtype=np.int64),
+                      "cell_stop": np.empty(0, dtype=np.int64), "cell_lines": np.empty(0, dtype=np.int64)})
+        return index
+
+    origin_x = min_x.min()
+    origin_y = min_y.min()
+
+    # The range of cells each line's bounding box covers
+    col_0 = np.floor((min_x - origin_x) / cell_size).astype(np.int64)
+    col_1 = np.floor((max_x - origin_x) / cell_size).astype(np.int64)
+    row_0 = np.floor((min_y - origin_y) / cell_size).astype(np.int64)
+    row_1 = np.floor((max_y - origin_y) / cell_size).astype(np.int64)
+
+    n_cols = int(col_1.max()) + 1
+    n_rows = int(row_1.max()) + 1
+
+    # Register each line in every cell it covers
+    span_x = col_1 - col_0 + 1
+    span_y = row_1 - row_0 + 1
+    counts = span_x * span_y
+
+    lines = np.repeat(np.arange(edges.shape[0], dtype=np.int64), counts)
+    local = np.arange(lines.size, dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    keys = (row_0[lines] + local // span_x[lines]) * n_cols + (col_0[lines] + local % span_x[lines])
+
+    # Group the lines by cell, so each cell's lines can be found with a binary search
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    lines = lines[order]
+
+    cell_keys, cell_start = np.unique(keys, return_index=True)
+    cell_stop = np.append(cell_start[1:], keys.size)
+
+    index.update({"origin": (origin_x, origin_y), "n_cols": n_cols, "n_rows": n_rows,
+                  "cell_keys": cell_keys, "cell_start": cell_start, "cell_stop": cell_stop, "cell_lines": lines})
+    return index
+
+
+def candidate_pairs(index, boat_1_x, boat_1_y, boat_2_x, boat_2_y):
+    """
+    Parameters
+    ----------
+    index : Dictionary from build_boundary_index
+
+    boat_1_x, boat_1_y, boat_2_x, boat_2_y : arrays of the start and end points of boat segments
+
+    Returns
+    -------
+    seg : index of each candidate segment
+
+    line : index of each candidate line, aligned with seg
+        Each (segment, line) pair appears once, and only if their bounding boxes overlap
+
+    """
+
+    empty = np.empty(0, dtype=np.int64)
+
+    if index["cell_keys"].size == 0 or boat_1_x.size == 0:
+        return empty, empty
+
+    origin_x, origin_y = index["origin"]
+    cell_size = index["cell_size"]
+    n_cols = index["n_cols"]
+    n_rows = index["n_rows"]
+
+    seg_min_x = np.minimum(boat_1_x, boat_2_x)
+    seg_min_y = np.minimum(boat_1_y, boat_2_y)
+    seg_max_x = np.maximum(boat_1_x, boat_2_x)
+    seg_max_y = np.maximum(boat_1_y, boat_2_y)
+
+    col_0 = np.floor((seg_min_x - origin_x) / cell_size)
+    col_1 = np.floor((seg_max_x - origin_x) / cell_size)
+    row_0 = np.floor((seg_min_y - origin_y) / cell_size)
+    row_1 = np.floor((seg_max_y - origin_y) / cell_size)
+
+    # Segments outside of the grid (or missing a coordinate) can't touch any line
+    inside = (col_1 >= 0) & (col_0 < n_cols) & (row_1 >= 0) & (row_0 < n_rows)
+    seg = np.flatnonzero(inside)
+
+    if seg.size == 0:
+        return empty, empty
+
+    col_0 = np.clip(col_0[seg], 0, n_cols - 1).astype(np.int64)
+    col_1 = np.clip(col_1[seg], 0, n_cols - 1).astype(np.int64)
+    row_0 = np.clip(row_0[seg], 0, n_rows - 1).astype(np.int64)
+    row_1 = np.clip(row_1[seg], 0, n_rows - 1).astype(np.int64)
+
+    span_x = col_1 - col_0 + 1
+    span_y = row_1 - row_0 + 1
+
+    cell_keys = index["cell_keys"]
+
+    found_seg = []
+    found_cell = []
+
+    # Nearly every segment sits in a single cell, so this loop usually runs once
+        # Longer segments are looked up once for every cell their bounding box covers
+    for dx in range(int(span_x.max())):
+        sel_x = np.flatnonzero(span_x > dx)
+
+        for dy in range(int(span_y[sel_x].max())):
+            sel = sel_x[span_y[sel_x] > dy]
+
+            keys = (row_0[sel] + dy) * n_cols + (col_0[sel] + dx)
+
+            # Binary search for the cell, then check that the cell actually holds lines
+            pos = np.minimum(np.searchsorted(cell_keys, keys), cell_keys.size - 1)
+            hit = cell_keys[pos] == keys
+
+            found_seg.append(sel[hit])
+            found_cell.append(pos[hit])
+
+    found_seg = np.concatenate(found_seg)
+    found_cell = np.concatenate(found_cell)
+
+    # Expand each (segment, cell) pair into a (segment, line) pair for every line in the cell
+    counts = index["cell_stop"][found_cell] - index["cell_start"][found_cell]
+    pair_seg = np.repeat(found_seg, counts)
+    pair_pos = np.repeat(index["cell_start"][found_cell] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum(), dtype=np.int64)
+    pair_line = index["cell_lines"][pair_pos]
+
+    # Keep only the pairs whose bounding boxes actually overlap
+    min_x, min_y, max_x, max_y = index["boxes"]
+    overlap = ((seg_min_x[seg][pair_seg] <= max_x[pair_line]) & (seg_max_x[seg][pair_seg] >= min_x[pair_line])
+               & (seg_min_y[seg][pair_seg] <= max_y[pair_line]) & (seg_max_y[seg][pair_seg] >= min_y[pair_line]))
+
+    pair_seg = seg[pair_seg[overlap]]
+    pair_line = pair_line[overlap]
+
+    # A segment and a line that share several cells would be found several times
+    if span_x.max() > 1 or span_y.max() > 1:
+        n_lines = index["boxes"][0].size
+        unique_pairs = np.unique(pair_seg * n_lines + pair_line)
+        pair_seg = unique_pairs // n_lines
+        pair_line = unique_pairs % n_lines
+
+    return pair_seg, pair_line
+
+
+def compile_boundaries(boundaries, endpoints_only=True, once_per_structure=False):
+    """
+    Parameters
+    ----------
+    boundaries : Dictionary of the form Structure: Array of Points Defining the Structure
+
+    endpoints_only : see boundary_edges
+
+    once_per_structure : If True, a segment that crosses several lines of one structure counts as one crossing
+        Used for bridge polylines. Ports keep one row per edge crossed
+
+    Returns
+    -------
+    Dictionary holding the structure names, their lines, which structure owns each line, and the spatial index
+    """
+
+    names, edges, owner = boundary_edges(boundaries, endpoints_only=endpoints_only)
+
+    # Which way each line faces, so crossing events into a closed boundary (a port) always have Direction 1
+        # Going around a ring counterclockwise keeps the inside on the left of every edge
+    orientation = np.ones(len(names), dtype=np.int64)
+
+    if not endpoints_only:
+        for i, name in enumerate(names):
+            points = np.asarray(boundaries[name], dtype=np.float64)
+            area = np.sum(points[:-1, 0] * points[1:, 1] - points[1:, 0] * points[:-1, 1])
+
+            # A ring needs at least three corners plus the point that closes it
+                # Checked exactly, since a short bridge's two ends are close enough to pass a tolerance
+            if len(points) > 3 and np.array_equal(points[0], points[-1]) and area < 0:
+                orientation[i] = -1
+
+    # Only worth checking when some structure actually has more than one line
+    once_per_structure = once_per_structure and len(edges) > len(names)
+
+    return {"names": names, "edges": edges, "owner": owner, "side": orientation[owner], "index": build_boundary_index(edges),
+            "once_per_structure": once_per_structure}
+
+
+# If True, bridges with more than two points are followed along every point (their full polyline)
+    # If False, each bridge is a single line from its first to last point, like the original filtering
+    # A bridge with only two points is the same either way
+use_bridge_polylines = True
+
+
+# The boundaries are indexed once, when this file is imported
+    # Ports use every edge of their boundary, however many vertices it has
+bridge_geometry = compile_boundaries(bridge_lines, endpoints_only=not use_bridge_polylines, once_per_structure=True)
+port_geometry = compile_boundaries(port_boxes, endpoints_only=False)
+
+
+
+#######################
+### Track Prefilter ###
+#######################
+
+'''
+Most broadcasts in a national daily file are nowhere near a monitored bridge or port. Before anything is sorted,
+every boat's whole daily track is reduced to a bounding box. Every segment of a track lies inside of that box,
+even the segment between two far-apart points, so a boat whose box misses every boundary box can never cross
+anything and all of its broadcasts can be dropped. The remaining boats are kept whole.
+'''
+
+# Set this to False to skip the prefilter and sort every broadcast that passes the vessel mask
+use_track_prefilter = True
+
+# The number of boats tested against every boundary box at once
+prefilter_block = 4096
+
+
+def track_prefilter(filtered, geometry):
+    """
+    Parameters
+    ----------
+    filtered : Data frame of AIS broadcasts remaining after the vessel mask
+
+    geometry : Dictionary of boundary lines and their spatial index, from compile_boundaries
+
+    Returns
+    -------
+    Data frame of the broadcasts from boats whose daily bounding box overlaps at least one boundary box
+    """
+
+    boats = filtered.groupby("MMSI", sort=False)
+
+    # The bounding box of each boat's track
+        # Missing coordinates are skipped, and a boat with no coordinates at all is dropped
+    box = boats[["LON", "LAT"]].agg(["min", "max"])
+    track_min_x = box[("LON", "min")].to_numpy(dtype=np.float64)[:, np.newaxis]
+    track_max_x = box[("LON", "max")].to_numpy(dtype=np.float64)[:, np.newaxis]
+    track_min_y = box[("LAT", "min")].to_numpy(dtype=np.float64)[:, np.newaxis]
+    track_max_y = box[("LAT", "max")].to_numpy(dtype=np.float64)[:, np.newaxis]
+
+    min_x, min_y, max_x, max_y = geometry["index"]["boxes"]
+
+    near = np.zeros(track_min_x.shape[0], dtype=bool)
+
+    # Test blocks of boats against every boundary box at once
+    for i in range(0, near.size, prefilter_block):
+        rows = slice(i, i + prefilter_block)
+        near[rows] = ((track_min_x[rows] <= max_x) & (track_max_x[rows] >= min_x)
+                      & (track_min_y[rows] <= max_y) & (track_max_y[rows] >= min_y)).any(axis=1)
+
+    # Broadcasts with a missing MMSI have no group, and could never form a segment anyway
+    group = boats.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    keep = np.zeros(group.size, dtype=bool)
+    has_group = group >= 0
+    keep[has_group] = near[group[has_group]]
+
+    return filtered.loc[keep]
+
+
+
+#######################
+### Parameter Sweep ###
+#######################
+
+'''
+The vessel mask and the jump thresholds are fixed when a file is filtered, so trying a different cutoff used to
+mean filtering every file again. A sweep filters with the loosest of a grid of settings instead, and tags every
+crossing with the settings it passes. One pass then gives the crossings of every combination in the grid.
+
+Each combination of settings (a "variant") gets one bit of the SweepMask column. A crossing passes a variant if
+the broadcasts on both sides of it pass that variant's vessel mask, and the jump between them is smaller than
+the variant's jump thresholds. Counting the crossings of a variant is then just a bit test, EX:
+(df["SweepMask"] >> i) & 1 for the variant numbered i in sweep_variants.json.
+
+This is the same as removing crossings after the fact, like the rankings do with Length. Filtering with a
+stricter mask from the start can occasionally find a few more crossings, since a boat's broadcasts on either
+side of a dropped broadcast are then joined into a segment of their own.
+'''
+
+# If True, the job filters with the loosest settings in sweep_grid and tags every crossing with a SweepMask
+    # Sweeps are written like any other run, so give them their own data_folder or store_folder
+use_sweep = False
+
+# Every combination of these settings is a variant
+    # Length : smallest length of a boat to be important, unless it is one of the vessel types (like min_boat_length)
+    # SOG : a boat must move faster than this to be important, unless its status says it is moving with difficulty
+    # VesselType : Dictionary of the form Group Name: Vessel types that are important whatever their length
+        # Each entry is a (low, high) range of codes, low <= code < high, or a single code
+        # None means no vessel type is important on its own, only boats of the right length
+        # The "Cargo and Tanker" group holds the codes vessel_mask names, see the note in vessel_mask
+    # Jump : (lon, lat) thresholds of jump_mask
+sweep_grid = {"Length": [150, 180, 215, 250, 275, 300],
+              "SOG": [3, 5],
+              "VesselType": {"Cargo and Tanker": [(70, 90), 1016, 1017, 1024, 61], "Length Only": None},
+              "Jump": [(1, 0.5), (0.5, 0.25)]}
+
+
+def sweep_variants(grid):
+    """
+    Parameters
+    ----------
+    grid : Dictionary of settings to sweep, like sweep_grid
+
+    Returns
+    -------
+    List of every variant, each a Dictionary of its settings
+        The variant at position i is bit i of SweepMask
+    """
+
+    variants = []
+
+    for length in grid["Length"]:
+        for sog in grid["SOG"]:
+            for group, types in grid["VesselType"].items():
+                for max_lon, max_lat in grid["Jump"]:
+                    variants.append({"Length": length, "SOG": sog, "VesselType": group,
+                                     "Types": None if types is None else [list(t) if isinstance(t, tuple) else t for t in types],
+                                     "Jump": [max_lon, max_lat]})
+
+    # SweepMask is a 64 bit integer, and the top bit is its sign
+    if len(variants) > 63:
+        raise ValueError(f"sweep_grid has {len(variants)} variants, but SweepMask only holds 63")
+
+    return variants
+
+
+# The variants of the current sweep, worked out once when this file is imported
+sweep_settings = sweep_variants(sweep_grid) if use_sweep else None
+
+
+def sweep_point_mask(points, length, sog, types):
+    """
+    Parameters
+    ----------
+    points : Data frame of AIS broadcasts
+
+    length, sog, types : one variant's Length, SOG, and Types (see sweep_variants)
+
+    Returns
+    -------
+    Boolean array, True for the broadcasts that pass the variant's vessel mask
+        Works like vessel_mask, with missing values failing
+    """
+
+    def passes(condition):
+        return np.asarray(condition.fillna(False), dtype=bool)
+
+    vessel_type = points["VesselType"]
+
+    # Ships must be longer than the chosen length, or of one of the vessel types
+    important = passes(points["Length"] >= length)
+    for t in (types or []):
+        if isinstance(t, list):
+            important = important | passes((t[0] <= vessel_type) & (vessel_type < t[1]))
+
+    # The single codes are checked all at once
+    codes = [t for t in (types or []) if not isinstance(t, list)]
+    if codes:
+        important = important | passes(vessel_type.isin(codes))
+
+    # Ships must also be moving and not anchored and not moored, or moving with difficulty (status 3 or 4)
+    status = points["Status"]
+    moving = (passes(points["SOG"] > sog) & passes(status != 1) & passes(status != 5)) | passes(status.isin([3, 4]))
+
+    # Ships must also have transceiver class A
+    transceiver = points["TransceiverClass"] if "TransceiverClass" in points.columns else points["TranscieverClass"]
+
+    return important & moving & passes(transceiver == "A")
+
+
+def vessel_settings(variants):
+    # The distinct vessel masks among the variants, since several variants only differ by their jump
+    settings = []
+    for variant in variants:
+        setting = (variant["Length"], variant["SOG"], variant["Types"])
+        if setting not in settings:
+            settings.append(setting)
+
+    return settings
+
+
+def sweep_mask(raw_data, variants):
+    """
+    Parameters
+    ----------
+    raw_data : Data frame of AIS broadcasts, as returned by read_ais_file
+
+    variants : List of variants from sweep_variants
+
+    Returns
+    -------
+    Data frame of the AIS broadcasts that pass at least one variant's vessel mask
+    """
+
+    keep = np.zeros(len(raw_data), dtype=bool)
+
+    for length, sog, types in vessel_settings(variants):
+        keep |= sweep_point_mask(raw_data, length, sog, types)
+
+    return raw_data.loc[keep]
+
+
+def save_sweep_variants(folder, variants):
+    # Written next to the crossings as sweep_variants.json, so the rankings know which bit is which variant
+    os.makedirs(folder, exist_ok=True)
+
+    with open(os.path.join(folder, 'sweep_variants.json.tmp'), 'w') as f:
+        json.dump(variants, f, indent=1)
+
+    os.replace(os.path.join(folder, 'sweep_variants.json.tmp'), os.path.join(folder, 'sweep_variants.json'))
+
+
+def sweep_jump(variants):
+    # The loosest jump thresholds, which every crossing of the sweep is found with
+    return (max(v["Jump"][0] for v in variants), max(v["Jump"][1] for v in variants))
+
+
+def important_points(raw_data, min_boat_length, sweep=None):
+    # The vessel mask, or the loosest mask of a sweep
+    return vessel_mask(raw_data, min_boat_length) if sweep is None else sweep_mask(raw_data, sweep)
+
+
+def sweep_tags(boat_points, seg_start, seg, variants):
+    """
+    Parameters
+    ----------
+    boat_points, seg_start, seg : crossing segments, as given to crossing_results
+
+    variants : List of variants from sweep_variants
+
+    Returns
+    -------
+    int64 array aligned with seg, with bit i set if the crossing passes variant i
+    """
+
+    tags = np.zeros(seg.size, dtype=np.int64)
+
+    if seg.size == 0:
+        return tags
+
+    first_rows = seg_start[seg]
+    second_rows = first_rows + 1
+
+    lon = boat_points["LON"].to_numpy(dtype=np.float64)
+    lat = boat_points["LAT"].to_numpy(dtype=np.float64)
+
+    # Each distinct vessel mask is only worked out once, on the few rows next to a crossing
+    passed = {}
+    for length, sog, types in vessel_settings(variants):
+        point = sweep_point_mask(boat_points, length, sog, types)
+        passed[repr((length, sog, types))] = point[first_rows] & point[second_rows]
+
+    for bit, variant in enumerate(variants):
+        keep = passed[repr((variant["Length"], variant["SOG"], variant["Types"]))]
+        keep = keep & jump_mask(lon[first_rows], lat[first_rows], lon[second_rows], lat[second_rows], *variant["Jump"])
+
+        tags[keep] |= np.int64(1) << bit
+
+    return tags
+
+
+
+#######################
+### Streaming Reads ###
+#######################
+
+'''
+Reading a whole daily file at once holds every broadcast of the day in memory, which is what caused the memory
+errors described at the bottom of this file. Instead, the file can be decompressed and parsed a chunk of rows
+at a time. Each chunk is masked right away, so only the important broadcasts survive, and its segments are
+tested before the next chunk is read.
+
+A boat's broadcasts are usually spread across many chunks. To make sure the segment that spans two chunks isn't
+lost, the last broadcast of every boat is carried forward and placed in front of that boat's broadcasts in the
+next chunk. Only one row per active boat is ever carried, so memory stays bounded no matter how big the file is.
+
+Each boat's broadcasts almost always appear in chronological order in the file (NOAA writes them in time
+order). The carried broadcast is sorted in by time with the boat's broadcasts from the next chunk, so a
+broadcast that shows up older than the one carried for its boat still never makes a segment run backwards in
+time. It is joined to the boat's latest broadcast, rather than to the one before it in the whole day, which
+already went by in an earlier chunk. These late broadcasts are rare, and are counted as rows_late in the
+metrics. The file is never read a second time for them. Archived days are sorted, so they never have any.
+'''
+
+# The number of rows parsed at a time when streaming a file
+    # Set this to None to read each file all at once
+stream_chunksize = 500_000
+
+# Smaller column types for streaming. Strings that only take a couple of values become categories
+    # The integer columns use 32 bits so that an occasional garbage value doesn't overflow and fail the file
+stream_dtypes = dict(ais_dtypes, **{"Heading": "Int32",
+                                    "VesselType": "Int32",
+                                    "Status": "Int32",
+                                    "Length": "Int32",
+                                    "Width": "Int32",
+                                    "Cargo": "Int32",
+                                    "TransceiverClass": "category",
+                                    "TranscieverClass": "category"})
+
+
+def stream_crossings(file, geometry, min_boat_length, chunksize=stream_chunksize, carry=None, events=False, sweep=None):
+    """
+    Parameters
+    ----------
+    file : path to the file to be filtered, or an open file such as a zip member
+
+    geometry : Dictionary of boundary lines and their spatial index, from compile_boundaries
+
+    min_boat_length : the smallest length a boat must be to be important
+
+    chunksize : the number of rows parsed at a time
+
+    carry : Data frame holding the last broadcast of each boat from before this file, or None to start fresh
+
+    events : If True, one row per crossing instead of the two broadcasts on either side (see crossing_events)
+
+    sweep : List of variants from sweep_variants, or None to filter with the vessel mask
+
+    Returns
+    -------
+    results : Dictionary of the form Structure: List of Data Frames of crossings (one per chunk with crossings)
+
+    carry : Data frame holding the last broadcast of each boat seen so far
+
+    late : the number of broadcasts that arrived older than the broadcast carried for their boat
+        Also counted as rows_late in the metrics
+
+    first : Data frame holding the first broadcast of each boat in this file, by time
+
+    """
+
+    results = {}
+    late = 0
+    first = None
+
+    jump = None if sweep is None else sweep_jump(sweep)
+
+    reader = pd.read_csv(file, sep=',', header=0, dtype=stream_dtypes, on_bad_lines="skip", chunksize=chunksize)
+
+    for chunk in timed_chunks(reader):
+
+        # Mask the chunk right away, so the rest of it can be freed
+        with stage("mask"):
+            kept = important_points(chunk, min_boat_length, sweep)
+        del chunk
+        count("rows_masked", len(kept))
+
+        if kept.empty:
+            continue
+
+        chunk_late = 0
+
+        if carry is not None and not carry.empty:
+            previous = carry.loc[carry["MMSI"].isin(kept["MMSI"])]
+
+            # Count broadcasts older than the one carried for their boat
+            carried_time = kept["MMSI"].map(previous.set_index("MMSI")["BaseDateTime"])
+            chunk_late = int((kept["BaseDateTime"] < carried_time).sum())
+            late += chunk_late
+            count("rows_late", chunk_late)
+
+            # The carried broadcast is sorted in with each boat's broadcasts from this chunk
+                # It goes first, unless a broadcast arrived late, and it goes before any broadcast at the same time
+            combined = pd.concat([previous, kept])
+            carried = np.arange(len(combined)) < len(previous)
+        else:
+            combined = kept
+            carried = np.zeros(len(combined), dtype=bool)
+
+        # Sort only the keys and coordinates, the rest of the chunk isn't touched unless it crosses something
+        with stage("sort"):
+            tracks = compact_tracks(combined)
+        count("segments", tracks["seg_start"].size)
+
+        # Keep the first broadcast of every boat, replaced if one of its broadcasts arrives late
+            # Carried broadcasts came from an earlier chunk, so they are skipped
+        from_chunk = np.flatnonzero(~carried[tracks["order"]])
+        chunk_first = combined.iloc[tracks["order"][boat_ends(tracks, "first", rows=from_chunk)]]
+        if first is None:
+            first = chunk_first.reset_index(drop=True)
+        elif chunk_late:
+            # A late broadcast can be older than the first one kept for its boat, so the oldest of the two is kept
+                # The sort is stable, so the one kept already wins a tie, and the boats stay in the order they were seen
+            both = pd.concat([first, chunk_first], ignore_index=True)
+            oldest = both.sort_values(["MMSI", "BaseDateTime"], kind="stable").drop_duplicates("MMSI").index
+            first = both.loc[np.sort(oldest)].reset_index(drop=True)
+        else:
+            first = pd.concat([first, chunk_first.loc[~chunk_first["MMSI"].isin(first["MMSI"])]], ignore_index=True)
+
+        with stage("intersect"):
+            seg, line = find_crossings(tracks["lon"], tracks["lat"], tracks["seg_start"], geometry, jump)
+        count("crossings", seg.size)
+
+        with stage("gather"):
+            boat_points, seg_start, seg = gather_crossings(combined, tracks, seg)
+
+            for name, frame in crossing_results(boat_points, seg_start, seg, line, geometry, events, sweep).items():
+                results.setdefault(name, []).append(frame)
+
+        # Carry the last broadcast of every boat in this chunk, plus anything carried for boats that weren't in it
+        last = combined.iloc[tracks["order"][boat_ends(tracks, "last")]]
+
+        if carry is not None and not carry.empty:
+            carry = pd.concat([carry.loc[~carry["MMSI"].isin(last["MMSI"])], last], ignore_index=True)
+        else:
+            carry = last.reset_index(drop=True)
+
+    reader.close()
+
+    return results, carry, late, first
+
+
+def filter_file(file, geometry, min_boat_length, prefilter=use_track_prefilter, chunksize=None, return_edges=False, events=False, sweep=None):
+    """
+    Parameters
+    ----------
+    file : path to the file to be filtered, or an open file such as a zip member
+
+    geometry : Dictionary of boundary lines and their spatial index, from compile_boundaries
+
+    min_boat_length : the smallest length a boat must be to be important
+
+    prefilter : If True, boats whose whole track is far from every boundary are dropped before sorting
+        Only used when the whole file is read at once. A streamed chunk is already small
+
+    chunksize : the number of rows parsed at a time, or None to read the whole file at once
+        Archived days are always read at once, since they are already small
+
+    return_edges : If True, also return the first and last important broadcast of every boat (see track_ends)
+
+    events : If True, return one row per crossing instead of the two broadcasts on either side (see crossing_events)
+
+    sweep : List of variants from sweep_variants, or None to filter with the vessel mask
+        With a sweep, the loosest settings are used and every crossing gets a SweepMask (see sweep_tags)
+
+    Returns
+    -------
+    Dictionary of the form Structure: Data Frame of the points forming line segments which cross the structure
+        Structures without any crossings are left out
+
+    edges : (first, last) Data frames of each boat's first and last important broadcast, only if return_edges
+
+    """
+
+    archived = is_archived(file)
+
+    if chunksize is not None and not archived:
+        results, carry, _, first = stream_crossings(file, geometry, min_boat_length, chunksize=chunksize, events=events, sweep=sweep)
+
+        results = {name: pd.concat(frames, ignore_index=True) for name, frames in results.items()}
+
+        if return_edges:
+            # Nothing was carried into this file, so the carry is exactly the last broadcast of each boat
+            return results, (edge_rows(first), edge_rows(carry))
+        return results
+
+    with stage("read"):
+        raw_data = read_ais_file(file)
+    count("rows", len(raw_data))
+
+    with stage("mask"):
+        filtered = important_points(raw_data, min_boat_length, sweep)
+    del raw_data
+    count("rows_masked", len(filtered))
+
+    # The ends of every boat's track are needed for stitching days together, even for boats the prefilter drops
+    if return_edges:
+        edges = track_ends(filtered, presorted=archived)
+
+    # Drop boats that are never near any boundary before doing any per-boat work
+    if prefilter:
+        with stage("prefilter"):
+            filtered = track_prefilter(filtered, geometry)
+        count("rows_near", len(filtered))
+
+    # Sort every boat's broadcasts once and find every consecutive-point segment
+        # Archived days are already sorted, and masking them doesn't change the order
+        # Only the sort keys and coordinates are sorted, as plain arrays
+    with stage("sort"):
+        tracks = compact_tracks(filtered, presorted=archived)
+    count("segments", tracks["seg_start"].size)
+
+    # Test every segment against the nearby boundary lines in one batched pass
+    with stage("intersect"):
+        seg, line = find_crossings(tracks["lon"], tracks["lat"], tracks["seg_start"], geometry, None if sweep is None else sweep_jump(sweep))
+    count("crossings", seg.size)
+
+    # Only now are the rest of the columns gathered, and only for the rows on either side of a crossing
+    with stage("gather"):
+        boat_points, seg_start, seg = gather_crossings(filtered, tracks, seg)
+
+        results = crossing_results(boat_points, seg_start, seg, line, geometry, events, sweep)
+
+    # Write archived times as the same text the csv files use, so results from either source look the same
+        # Events always write their times as text
+    if archived and not events:
+        for name in results:
+            results[name]["BaseDateTime"] = results[name]["BaseDateTime"].dt.strftime(noaa_time_format)
+
+    if return_edges:
+        return results, edges
+    return results
+
+
+
+def filter_ports(file, boundaries=port_boxes, min_boat_length=min_boat_length, prefilter=use_track_prefilter, chunksize=None, return_edges=False, events=False, sweep=None):
+    """
+    Parameters
+    ----------
+    file : path to the file to be filtered
+        Zipfiles from the internet will be opened, and the path will be listed here
+
+    boundaries : Dictionary of the form Port: Points Defining Port's Boundaries
+        This function handles ports, while the other handles bridges. They are nearly identical, except
+        each port is a closed ring of line segments (four for a box), while a bridge is a polyline of one or more
+        segments, and a segment crossing several of a port's edges is kept once per edge
+
+    min_boat_length : the smallest length a boat must be to be important
+
+    prefilter : If True, boats whose whole track is far from every boundary are dropped before sorting
+
+    chunksize : If given, the file is streamed this many rows at a time instead of read all at once
+
+    return_edges : If True, also return each boat's first and last important broadcast, for stitching days together
+
+    events : If True, return one row per crossing instead of two broadcasts
+        Direction is 1 for a boat entering the port and -1 for a boat leaving it
+
+    sweep : List of variants from sweep_variants, to tag every crossing with the settings it passes
+
+    Returns
+    -------
+    Dictionary of the form Port: Data Frame of the points forming line segments from boats which intersect the port
+        Ports without any intersections are left out
+        A segment crossing two edges of the same port is stored once per edge
+
+    """
+
+    # Use the index built at import, unless different boundaries were given
+    geometry = port_geometry if boundaries is port_boxes else compile_boundaries(boundaries, endpoints_only=False)
+
+    return filter_file(file, geometry, min_boat_length, prefilter=prefilter, chunksize=chunksize, return_edges=return_edges, events=events, sweep=sweep)
+
+
+def filter_bridges(file, boundaries=bridge_lines, min_boat_length=min_boat_length, prefilter=use_track_prefilter, chunksize=None, return_edges=False, events=False, sweep=None):
+    """
+    Parameters
+    ----------
+    file : path to the file the be filtered
+        Zipfiles from the internet will be opened, and the path will be listed here
+
+    boundaries : Dictionary of the form Bridge: Points Defining Bridge's Boundaries
+        This function handles bridges, while the other handles ports. They are nearly identical, except
+        each bridge is a polyline of one or more segments (see use_bridge_polylines), while a port is a closed
+        ring of line segments, and a segment crossing a bridge more than once is kept once
+
+    min_boat_length : the smallest length a boat must be to be important
+
+    prefilter : If True, boats whose whole track is far from every boundary are dropped before sorting
+
+    chunksize : If given, the file is streamed this many rows at a time instead of read all at once
+
+    return_edges : If True, also return each boat's first and last important broadcast, for stitching days together
+
+    events : If True, return one row per crossing instead of two broadcasts
+        Direction is 1 for a boat crossing to the left of the bridge, looking from its START point to its END point
+
+    sweep : List of variants from sweep_variants, to tag every crossing with the settings it passes
+
+    Returns
+    -------
+    Dictionary of the form Bridge: Data Frame of the points forming line segments from boats which intersect the bridge
+        Bridges without any intersections are left out
+
+    """
+
+    # Use the index built at import, unless different boundaries were given
+    geometry = bridge_geometry if boundaries is bridge_lines else compile_boundaries(boundaries, endpoints_only=not use_bridge_polylines,
+                                                                                    once_per_structure=True)
+
+    return filter_file(file, geometry, min_boat_length, prefilter=prefilter, chunksize=chunksize, return_edges=return_edges, events=events, sweep=sweep)
+
+
+
+###############################
+### Stitching Days Together ###
+###############################
+
+'''
+Each NOAA file is one UTC day, and segments are only ever built within a file. A boat whose last broadcast
+before midnight and first broadcast after midnight are on opposite sides of a bridge would never be counted.
+
+To catch these, every filtered day also saves the first and last important broadcast of each boat (its "edges")
+in a small file. Once two consecutive days both have edges, each boat's last broadcast from the first day is
+joined to its first broadcast from the second day, and that one segment per boat goes through the same crossing
+test as every other segment. Only one row per boat per day is ever held, so memory stays small.
+
+Stitching only needs the edges, not the days themselves, so it works the same whether the days were filtered
+in order by one process ("sequential") or in any order by the pool ("parallel"). In both cases, the crossings
+found across the midnight that starts a day are written as their own source, {daily file}_midnight, and recorded
+in the run manifest under the day's url followed by #midnight. A day filtered again later is stitched again
+without touching the crossings from the day itself.
+
+Days are only stitched if they are consecutive on the calendar. A boat that doesn't broadcast for a whole day
+isn't joined across the gap.
+'''
+
+# How crossings over midnight are found
+    # None : they aren't, like the original script
+    # "parallel" : days are filtered by the pool, and stitched as soon as both sides of a midnight are done
+    # "sequential" : days are filtered one at a time in calendar order by a single process
+stitch_mode = "parallel"
+
+
+def edges_folder():
+    # The edges are kept with the output they belong to
+    return output_folder() + 'Day_Edges/'
+
+
+def track_ends(points, presorted=False):
+    """
+    Parameters
+    ----------
+    points : Data frame of important AIS broadcasts from one day
+
+    presorted : If True, the rows are already sorted by MMSI, then chronologically
+
+    Returns
+    -------
+    first, last : Data frames of the first and last broadcast of every boat, ready for edge_rows
+    """
+
+    if not presorted:
+        # Only the two sort columns are sorted, then the rows are gathered
+        order = points[["MMSI", "BaseDateTime"]].sort_values(["MMSI", "BaseDateTime"], kind="stable").index
+        points = points.loc[order]
+
+    points = points.loc[points["MMSI"].notna()]
+
+    return edge_rows(points.drop_duplicates("MMSI", keep="first")), edge_rows(points.drop_duplicates("MMSI", keep="last"))
+
+
+def edge_rows(points):
+    # A day without any important broadcasts has no edges
+    if points is None:
+        return pd.DataFrame({"MMSI": pd.Series(dtype=object), "BaseDateTime": pd.Series(dtype=object),
+                             "LAT": pd.Series(dtype=np.float64), "LON": pd.Series(dtype=np.float64)})
+
+    # Edges from csv files and from the archive are stored the same way, so any two days can be joined
+    points = points.rename(columns={"TranscieverClass": "TransceiverClass"}).reset_index(drop=True)
+
+    points["MMSI"] = points["MMSI"].astype(object)
+    if pd.api.types.is_datetime64_any_dtype(points["BaseDateTime"]):
+        points["BaseDateTime"] = points["BaseDateTime"].dt.strftime(noaa_time_format)
+
+    # Categories from one day don't match the next day's, so go back to plain columns
+    for column in points.columns:
+        if isinstance(points[column].dtype, pd.CategoricalDtype):
+            points[column] = points[column].astype(object)
+
+    return points
+
+
+def stitch_crossings(last, first, geometry, events=False, sweep=None):
+    """
+    Parameters
+    ----------
+    last : Data frame of the last broadcast of each boat on one day
+
+    first : Data frame of the first broadcast of each boat on the next day
+
+    geometry : Dictionary of boundary lines and their spatial index, from compile_boundaries
+
+    events : If True, one row per crossing instead of the two broadcasts on either side (see crossing_events)
+
+    sweep : List of variants from sweep_variants, if the edges were saved by a sweep
+
+    Returns
+    -------
+    Dictionary of the form Structure: Data Frame of the points forming line segments which cross the structure
+        Each segment runs from a boat's last broadcast before midnight to its first broadcast after
+    """
+
+    previous = last.loc[last["MMSI"].isin(first["MMSI"])]
+    following = first.loc[first["MMSI"].isin(previous["MMSI"])]
+
+    # A stable sort on MMSI puts each boat's broadcast from before midnight right in front of the one after
+    boat_points = pd.concat([previous, following], ignore_index=True).sort_values("MMSI", kind="stable").reset_index(drop=True)
+
+    # Every boat has exactly two rows, so the segments start at every other row
+    seg_start = np.arange(0, len(boat_points) - 1, 2, dtype=np.int64)
+
+    # A boat that jumps too far overnight is a bad broadcast, the same as during the day
+    if use_track_cleaning and len(seg_start):
+        time, times = sort_codes(boat_points["BaseDateTime"])
+        seconds = time_seconds(time, times)
+        lon = boat_points["LON"].to_numpy(dtype=np.float64)
+        lat = boat_points["LAT"].to_numpy(dtype=np.float64)
+        seg_start = seg_start[speed_mask(lon[seg_start], lat[seg_start], lon[seg_start + 1], lat[seg_start + 1], seconds[seg_start], seconds[seg_start + 1])]
+
+    seg, line = find_crossings(boat_points["LON"].to_numpy(dtype=np.float64), boat_points["LAT"].to_numpy(dtype=np.float64), seg_start, geometry,
+                               None if sweep is None else sweep_jump(sweep))
+
+    return crossing_results(boat_points, seg_start, seg, line, geometry, events, sweep)
+
+
+def day_of(url):
+    # The date of a daily file, from its name, EX: AIS_2020_01_01
+    return datetime.strptime(zip_member_name(url)[4:-4], "%Y_%m_%d").date()
+
+
+def edges_path(url):
+    return edges_folder() + zip_member_name(url)[:-4] + '.pkl'
+
+
+def save_edges(url, edges, min_boat_length=min_boat_length):
+    # Written to a temporary file first, so a crash never leaves half an edges file
+    os.makedirs(edges_folder(), exist_ok=True)
+
+    path = edges_path(url)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump({"min_boat_length": min_boat_length, "sweep": sweep_settings, "first": edges[0], "last": edges[1]}, f)
+
+    os.replace(path + '.tmp', path)
+
+
+def load_edges(url, min_boat_length=min_boat_length):
+    """
+    Returns
+    -------
+    (first, last) Data frames saved for the day, or None if the day has no edges saved with the current settings
+    """
+
+    path = edges_path(url)
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        saved = pickle.load(f)
+
+    # Edges saved with a different vessel mask (or sweep) don't match the rest of the run
+    if saved["min_boat_length"] != min_boat_length or saved.get("sweep") != sweep_settings:
+        return None
+
+    return saved["first"], saved["last"]
+
+
+def stitch_midnight(url, day_urls, geometry=None, manifest=None, signature=None, rerun_stale=True):
+    """
+    Parameters
+    ----------
+    url : the daily file whose first midnight should be stitched
+
+    day_urls : Dictionary of the form Date: URL for every day of the job, used to find the day before
+
+    geometry : Dictionary of boundary lines, bridge_geometry by default
+
+    manifest : the run manifest, used to skip midnights that were already written
+
+    signature : boundary_hash the midnight would be written with
+
+    rerun_stale : If True, a midnight written with different boundaries is stitched again (see files_to_run)
+
+    Returns
+    -------
+    key : the url followed by #midnight, which is how the midnight is recorded
+
+    results : Dictionary of the form Bridge: Data Frame of crossing points, or None if it can't (or needn't) be stitched
+    """
+
+    geometry = bridge_geometry if geometry is None else geometry
+    key = url + '#midnight'
+
+    if manifest is not None:
+        entry = manifest["files"].get(key)
+        if entry is not None and entry["state"] == "done" and (entry.get("boundary_hash") == signature or not rerun_stale):
+            return key, None
+
+    before = day_urls.get(day_of(url) - timedelta(days=1))
+
+    if before is None:
+        return key, None
+
+    following = load_edges(url)
+    previous = load_edges(before)
+
+    if following is None or previous is None:
+        return key, None
+
+    return key, stitch_crossings(previous[1], following[0], geometry, events=(crossing_records == "events"), sweep=sweep_settings)
+
+
+
+###################
+### Port Visits ###
+###################
+
+'''
+Crossing a port's edge only says a boat went in or out. For congestion, what matters is how long boats stay.
+Instead of writing every broadcast near a port, the visit mode writes one row per port visit: when the boat was
+first and last seen inside, how long it stayed, and how many broadcasts it sent while there.
+
+Every important broadcast is first tested against the bounding box of every port at once, which throws out
+almost all of them. Only the broadcasts inside a box get the exact point-in-polygon test, which is also done
+for every (broadcast, port) pair at once by casting a ray to the east and counting the edges it crosses.
+Only boats with at least one broadcast inside a port are sorted, and a visit is a run of that boat's broadcasts
+that are all inside the same port.
+
+Visits are found within a single daily file. A visit over midnight is split in two, and Entered / Exited tell
+whether the boat was actually seen outside the port before and after the visit, or if the day just ran out.
+'''
+
+# WARNING!!!
+# Like data_folder, adjust this to where port data should be written
+# WARNING!!!
+
+port_folder = '/home/{your jhed}/scr4_mshiel10/{your usename}/Port_Filtering_Data/'
+
+# Example:
+# port_folder = '/home/djimene9/scr4_mshiel10/djimenez/Port_Filtering_Data/'
+
+
+# What is written for each port
+    # "pairs" : the two AIS broadcasts on either side of every edge crossing, like filter_ports
+    # "visits" : one row per port visit, written to "<port> Visits.csv"
+port_records = "pairs"
+
+# Which boundaries the job filters
+    # "bridges" : bridge crossings, written to data_folder or store_folder (see output_format)
+    # "ports" : port crossings or visits (see port_records), written as csv files to port_folder
+        # Ports go through the same writer as bridges, with their own run manifest in port_folder
+run_target = "bridges"
+
+# The number of broadcasts tested against every port's box at once
+port_visit_block = 65_536
+
+
+def visit_mask(raw_data, min_boat_length):
+    """
+    Returns
+    -------
+    Data frame of the broadcasts from the same boats as vessel_mask
+        Unlike vessel_mask, slow, anchored, and moored broadcasts are kept, since that's most of a port visit
+    """
+
+    # Older files spell the transceiver column TranscieverClass
+    transceiver = "TranscieverClass" if "TranscieverClass" in raw_data.columns else "TransceiverClass"
+
+    # The same vessel types vessel_mask names, checked with isin (see the note in vessel_mask)
+    return raw_data.loc[
+        (((70 <= raw_data["VesselType"]) & (raw_data["VesselType"] < 90)) | raw_data["VesselType"].isin([1016, 1017, 1024, 61]) | (raw_data["Length"] >= min_boat_length) )
+        & (raw_data[transceiver] == "A")]
+
+
+def compile_polygons(boundaries):
+    """
+    Parameters
+    ----------
+    boundaries : Dictionary of the form Port: Array of Points Defining the Port's Boundary
+
+    Returns
+    -------
+    Dictionary holding the port names, the bounding box of each port, and every port's vertices in one array
+        Ports with fewer vertices are padded by repeating their last point, and a zero length edge is never crossed
+    """
+
+    names = list(boundaries)
+    rings = [close_ring(np.asarray(boundaries[name], dtype=np.float64)) for name in names]
+    most = max(len(ring) for ring in rings)
+
+    vertices = np.stack([np.vstack([ring, np.repeat(ring[-1:], most - len(ring), axis=0)]) for ring in rings])
+
+    return {"names": names, "vertices": vertices,
+            "min_x": vertices[:, :, 0].min(axis=1), "max_x": vertices[:, :, 0].max(axis=1),
+            "min_y": vertices[:, :, 1].min(axis=1), "max_y": vertices[:, :, 1].max(axis=1)}
+
+
+# The ports are compiled once, when this file is imported
+port_polygons = compile_polygons(port_boxes)
+
+
+def inside_polygons(lon, lat, polygons, block=port_visit_block):
+    """
+    Parameters
+    ----------
+    lon, lat : float arrays of broadcast positions
+
+    polygons : Dictionary of port vertices and boxes, from compile_polygons
+
+    block : the number of broadcasts tested at a time
+
+    Returns
+    -------
+    point : positions of broadcasts that are inside a port
+
+    port : index of the port each one is inside, aligned with point
+        A broadcast inside two overlapping ports appears once per port
+    """
+
+    points = []
+    ports = []
+
+    for i in range(0, lon.size, block):
+        x = lon[i:i + block, np.newaxis]
+        y = lat[i:i + block, np.newaxis]
+
+        # Only broadcasts inside a port's bounding box can be inside the port
+            # Missing coordinates are never inside anything
+        near = ((x >= polygons["min_x"]) & (x <= polygons["max_x"])
+                & (y >= polygons["min_y"]) & (y <= polygons["max_y"]))
+        point, port = np.nonzero(near)
+
+        if point.size == 0:
+            continue
+
+        # Test every remaining (broadcast, port) pair against every edge of its port at once
+        ring = polygons["vertices"][port]
+        x_1, y_1 = ring[:, :-1, 0], ring[:, :-1, 1]
+        x_2, y_2 = ring[:, 1:, 0], ring[:, 1:, 1]
+        point_x = x[point]
+        point_y = y[point]
+
+        # An edge is crossed by the ray if it has one end above the point and one end below,
+            # and it meets the point's latitude to the east of the point
+            # Flat edges never have one end above and one below, so their division by zero is never used
+        straddle = (y_1 > point_y) != (y_2 > point_y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            meet_x = x_1 + (point_y - y_1) * (x_2 - x_1) / (y_2 - y_1)
+
+        # An odd number of crossings means the point is inside
+        inside = (np.count_nonzero(straddle & (point_x < meet_x), axis=1) % 2) == 1
+
+        points.append(point[inside] + i)
+        ports.append(port[inside])
+
+    if not points:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    return np.concatenate(points).astype(np.int64), np.concatenate(ports).astype(np.int64)
+
+
+def port_visits(points, polygons=port_polygons, presorted=False):
+    """
+    Parameters
+    ----------
+    points : Data frame of important AIS broadcasts from one day, from visit_mask
+
+    polygons : Dictionary of port vertices and boxes, from compile_polygons
+
+    presorted : If True, the rows are already sorted by MMSI, then chronologically
+
+    Returns
+    -------
+    Dictionary of the form Port: Data Frame with one row per visit, holding
+        MMSI
+        EnterTime, ExitTime : the first and last broadcast inside the port
+        DwellHours : the time between them
+        Broadcasts : the number of broadcasts sent from inside the port
+        Entered : True if the boat was seen outside the port right before the visit, False if the visit started the day
+        Exited : True if the boat was seen outside the port right after the visit, False if the visit ended the day
+        and the static_columns, from the first broadcast of the visit
+    Ports without any visits are left out
+
+    """
+
+    results = {}
+
+    points = points.reset_index(drop=True)
+
+    point, port = inside_polygons(points["LON"].to_numpy(dtype=np.float64), points["LAT"].to_numpy(dtype=np.float64), polygons)
+
+    # Only boats that were inside a port at some point are sorted
+        # All of their broadcasts are kept, so it's clear when they were outside
+    keep = points["MMSI"].isin(points["MMSI"].iloc[point]) & points["MMSI"].notna()
+
+    if presorted:
+        order = np.flatnonzero(keep.to_numpy())
+    else:
+        order = points.loc[keep, ["MMSI", "BaseDateTime"]].sort_values(["MMSI", "BaseDateTime"], kind="stable").index.to_numpy()
+
+    # Where each broadcast ends up after sorting, -1 if it was dropped
+    position = np.full(len(points), -1, dtype=np.int64)
+    position[order] = np.arange(order.size)
+
+    boat_points, seg_start = build_segments(points.iloc[order], presorted=True)
+
+    point = position[point]
+    port = port[point >= 0]
+    point = point[point >= 0]
+
+    if point.size == 0:
+        return results
+
+    # Whether each broadcast has one from the same boat right before it, and right after it
+    follows = np.zeros(len(boat_points), dtype=bool)
+    follows[seg_start + 1] = True
+    leads = np.zeros(len(boat_points), dtype=bool)
+    leads[seg_start] = True
+
+    # Group the broadcasts by port, keeping each boat's broadcasts in time order
+    sort = np.lexsort((point, port))
+    point = point[sort]
+    port = port[sort]
+
+    # A visit ends when the port changes, or when the boat's next broadcast is outside the port (or is another boat's)
+    new_visit = np.ones(point.size, dtype=bool)
+    new_visit[1:] = (port[1:] != port[:-1]) | (point[1:] != point[:-1] + 1) | ~follows[point[1:]]
+
+    starts = np.flatnonzero(new_visit)
+    stops = np.concatenate((starts[1:], [point.size])) - 1
+
+    first_rows = point[starts]
+    last_rows = point[stops]
+    visit_port = port[starts]
+
+    # Times are text in the csv files and timestamps in the archive
+    time = pd.to_datetime(boat_points["BaseDateTime"], format=noaa_time_format, errors="coerce")
+    enter = time.iloc[first_rows].reset_index(drop=True)
+    leave = time.iloc[last_rows].reset_index(drop=True)
+
+    visits = pd.DataFrame({"MMSI": boat_points["MMSI"].iloc[first_rows].reset_index(drop=True).astype(object),
+                           "EnterTime": enter.dt.strftime(noaa_time_format),
+                           "ExitTime": leave.dt.strftime(noaa_time_format),
+                           "DwellHours": (leave - enter).dt.total_seconds() / 3600,
+                           "Broadcasts": stops - starts + 1,
+                           "Entered": follows[first_rows],
+                           "Exited": leads[last_rows]})
+
+    # Older files spell the transceiver column TranscieverClass
+    points_columns = {"TransceiverClass": "TranscieverClass"} if "TranscieverClass" in boat_points.columns else {}
+
+    for column in static_columns:
+        source = points_columns.get(column, column)
+        if source in boat_points.columns:
+            visits[column] = boat_points[source].iloc[first_rows].reset_index(drop=True)
+
+    # Find where each port's block of visits begins and ends
+    bounds = np.flatnonzero(np.diff(visit_port)) + 1
+    blocks = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [visit_port.size]))
+
+    for start, stop in zip(blocks, ends):
+        results[polygons["names"][visit_port[start]]] = visits.iloc[start:stop].reset_index(drop=True)
+
+    return results
+
+
+def filter_port_visits(file, boundaries=port_boxes, min_boat_length=min_boat_length, chunksize=None):
+    """
+    Parameters
+    ----------
+    file : path to the file to be filtered, or an open file such as a zip member
+
+    boundaries : Dictionary of the form Port: Points Defining Port's Boundaries
+
+    min_boat_length : the smallest length a boat must be to be important
+
+    chunksize : If given, the file is read this many rows at a time, and each chunk is masked right away
+        Archived days are always read at once
+
+    Returns
+    -------
+    Dictionary of the form Port: Data Frame with one row per visit (see port_visits)
+
+    """
+
+    # Use the ports compiled at import, unless different boundaries were given
+    polygons = port_polygons if boundaries is port_boxes else compile_polygons(boundaries)
+
+    archived = is_archived(file)
+
+    if chunksize is not None and not archived:
+        reader = pd.read_csv(file, sep=',', header=0, dtype=stream_dtypes, on_bad_lines="skip", chunksize=chunksize)
+        points = pd.concat([visit_mask(chunk, min_boat_length) for chunk in timed_chunks(reader)], ignore_index=True)
+        reader.close()
+    else:
+        with stage("read"):
+            raw_data = read_ais_file(file)
+        count("rows", len(raw_data))
+        points = visit_mask(raw_data, min_boat_length)
+        del raw_data
+    count("rows_masked", len(points))
+
+    # Archived days are already sorted, and masking them doesn't change the order
+    with stage("intersect"):
+        visits = port_visits(points, polygons, presorted=archived)
+    count("crossings", sum(len(frame) for frame in visits.values()))
+
+    return visits
+
+
+
+##############################
+### Archiving the Raw Data ###
+##############################
+
+'''
+Every filter setting (min_boat_length, the boundaries, the jump thresholds) is applied after the file is read,
+so there's no reason to download and parse the csv files again each time one of them changes. Instead, each
+daily file can be converted once into the archive (see AIS_Archive.py), and the filters re-run from there.
+
+Only the transceiver class is filtered before archiving, since class B boats are always thrown out. Every
+other condition of the vessel mask is still applied when filtering, so changing it never needs a new archive.
+'''
+
+
+def archive_file(file, path, chunksize=stream_chunksize):
+    """
+    Parameters
+    ----------
+    file : path to the csv file to be archived, or an open file such as a zip member
+
+    path : where to write the archived day, EX: {archive folder}/AIS_2020_01_01.parquet
+
+    chunksize : the number of rows parsed at a time, or None to read the whole file at once
+
+    Returns
+    -------
+    The number of broadcasts written to the archive
+    """
+
+    kept = []
+
+    with stage("read"):
+        reader = pd.read_csv(file, sep=',', header=0, dtype=stream_dtypes, on_bad_lines="skip", chunksize=chunksize)
+
+    if chunksize is None:
+        count("rows", len(reader))
+
+    # Without a chunksize, read_csv returns the whole file instead of a reader
+    for chunk in ([reader] if chunksize is None else timed_chunks(reader)):
+
+        # Every archived day spells the transceiver column the same way
+        chunk = chunk.rename(columns={"TranscieverClass": "TransceiverClass"})
+
+        # Class B boats are never important, so they are never archived
+        kept.append(chunk.loc[chunk["TransceiverClass"] == "A"])
+        del chunk
+
+    if chunksize is not None:
+        reader.close()
+
+    day = pd.concat(kept, ignore_index=True)
+    del kept
+
+    # Sort once here, so filtering never has to sort again
+        # This is the same stable sort build_segments does, so the same segments are found in the same order
+    with stage("sort"):
+        day = day.sort_values(["MMSI", "BaseDateTime"], kind="stable")
+
+    with stage("write"):
+        write_archive(day, path)
+
+    return len(day)
+
+
+
+############################
+### Downloading the Data ###
+############################
+
+# Go through each URL, open the file, then apply the filtering function    
+
+# Every zip is kept in a local cache on scratch disk, so re-running the filters doesn't download everything again
+    # Set this to False to always stream the file straight from NOAA into memory
+use_download_cache = True
+
+# WARNING!!!
+# Like data_folder, adjust this to a scratch folder with room for every zip (a few hundred GB)
+# WARNING!!!
+
+cache_folder = '/home/{your jhed}/scr4_mshiel10/{your usename}/AIS_Zip_Cache/'
+
+# Download the upcoming files in the main process while the workers filter (see AIS_Download_Cache.py)
+    # The workers then read each file from the cache, so their cores never wait on the network
+    # Set prefetch_connections and prefetch_window in AIS_Download_Cache.py
+    # Check the downloads against a stand-in server with: python AIS_Download_Cache.py
+use_prefetch = True
+
+
+def prefetching():
+    # Prefetched files are handed over through the cache, and archived days aren't downloaded at all
+    return use_prefetch and use_download_cache and run_mode != "archive"
+
+
+def open_zip(url):
+    """
+    Returns
+    -------
+    ZipFile of the daily file at url, read from the download cache when it is turned on
+    """
+    
+    if use_download_cache:
+        # Downloads (or resumes) the file only the first time it is asked for
+        return ZipFile(cached_zip_path(url, cache_folder))
+    
+    # Download the file from the link so it can be interacted with
+    download = urlopen(url)
+    
+    # Unzip the file
+    return ZipFile(BytesIO(download.read()))
+
+
+def zip_member_name(url):
+    #The actual file name is derived from the url, and looks like AIS_Year_DateNum
+        #The last 4 characters of the url are .zip
+    return url.rsplit('/', 1)[-1][:-4] + '.csv'
+
+
+def source_name(url):
+    # The name results are written under, EX: AIS_2020_01_01, or AIS_2020_01_01_midnight for a stitched midnight
+    url, _, part = url.partition('#')
+    return zip_member_name(url)[:-4] + ('_' + part if part else '')
+
+
+# What running this file does
+    # "download" : download (or read from the cache) each daily zip and filter it
+    # "ingest"   : convert each daily zip into the archive, without filtering anything
+    # "archive"  : filter the archived days instead of the zips. Run "ingest" once first
+run_mode = "download"
+
+# WARNING!!!
+# Like data_folder, adjust this to a scratch folder with room for the archive
+# WARNING!!!
+
+archive_folder = '/home/{your jhed}/scr4_mshiel10/{your usename}/AIS_Archive/'
+
+
+def archive_path(url):
+    # The archived day is named after the daily file, EX: AIS_2020_01_01.parquet
+    return archive_folder + zip_member_name(url)[:-4] + '.parquet'
+
+
+# Time every stage of every file, and write it to the metrics log (see AIS_Metrics.py)
+    # Summarize a run with: python AIS_Metrics.py {data_folder}Metrics/
+use_metrics = True
+
+
+def open_day(url, file_name):
+    # The day's csv inside its zip, with the download and the reads from the zip timed
+    with stage("download"):
+        data_zip_file = open_zip(url)
+
+    member = data_zip_file.getinfo(file_name)
+    count("bytes", member.compress_size)
+    count("csv_bytes", member.file_size)
+
+    return timed_reads(data_zip_file.open(file_name))
+
+
+def download_and_archive(url):
+    """
+    Returns
+    -------
+    url : the url that was archived
+
+    rows : the number of broadcasts archived, or None if the file failed
+    """
+
+    file_name = zip_member_name(url)
+    rows = None
+    error = None
+
+    if use_metrics:
+        begin_file(source_name(url), "ingest")
+
+    try:
+        # The download and the reads from the zip are timed like the filtering's
+        rows = archive_file(open_day(url, file_name), archive_path(url))
+    except Exception as e:
+        print(f"File {file_name} failed to archive, need to re-archive! \n Error: {e}", flush=True)
+        error = e
+
+    # Ingesting writes to the archive, so its records are kept there
+    if use_metrics:
+        end_file(archive_folder + 'Metrics/', error)
+    return url, rows
+
+
+def download_and_filter_bridges(url):
+    """
+    Returns
+    -------
+    url : the url that was filtered, so results can be matched to files as they come back in any order
+
+    results : Dictionary of the form Bridge: Data Frame of crossing points, or None if the file failed
+    """
+    
+    file_name = zip_member_name(url)
+    results = None
+    error = None
+    
+    if use_metrics:
+        begin_file(source_name(url), "bridges")
+    
+    #Apply the filter function to the file
+    try:
+        if run_mode == "archive":
+            # The archived day is read straight from disk, so nothing is downloaded or unzipped
+            count("bytes", os.path.getsize(archive_path(url)))
+            results = filter_bridges(archive_path(url), return_edges=stitch_mode is not None, events=(crossing_records == "events"),
+                                     sweep=sweep_settings)
+        else:
+            results = filter_bridges(open_day(url, file_name), chunksize=stream_chunksize, return_edges=stitch_mode is not None,
+                                     events=(crossing_records == "events"), sweep=sweep_settings)
+        
+        # Save the ends of every boat's track, so the midnights on either side of this day can be stitched
+        if stitch_mode is not None:
+            results, edges = results
+            save_edges(url, edges)
+    except Exception as e:
+        # If there's any error, rockfish will completely halt
+        # Instead, ignore the error for later so the entire job doesn't get wasted
+            # A download that failed part way is resumed from the cache the next time the file is run
+        print(f"File {file_name} failed, need to refilter! \n Error: {e}", flush=True)
+        error = e
+    
+    if use_metrics:
+        end_file(output_folder() + 'Metrics/', error)
+    return url, results
+
+def download_and_filter_ports(url):
+    """
+    Returns
+    -------
+    url : the url that was filtered, so results can be matched to files as they come back in any order
+    
+    results : Dictionary of the form Port: Data Frame of crossing points (or visits), or None if the file failed
+        Like the bridges, the ports are written by the writer, so a process never writes to a port's file itself
+    """
+    
+    file_name = zip_member_name(url)
+    results = None
+    error = None
+    
+    # Either the crossings of each port's edges, or one row per port visit
+    filter_function = filter_port_visits if port_records == "visits" else filter_ports
+    
+    if use_metrics:
+        begin_file(source_name(url), "ports")
+    
+    #Apply the filter function to the file
+    try:
+        if run_mode == "archive":
+            count("bytes", os.path.getsize(archive_path(url)))
+            results = filter_function(archive_path(url), boundaries=port_boxes, min_boat_length=150)
+        else:
+            results = filter_function(open_day(url, file_name), boundaries=port_boxes, min_boat_length=150, chunksize=stream_chunksize)
+    except Exception as e:
+        print(f"File {file_name} failed, need to refilter! \n Error: {e}", flush=True)
+        error = e
+    
+    if use_metrics:
+        end_file(output_folder() + 'Metrics/', error)
+    return url, results
+
+
+def download_and_filter(url):
+    # Filter a day for the boundaries the job runs (see run_target)
+    if run_target == "ports":
+        return download_and_filter_ports(url)
+    return download_and_filter_bridges(url)
+
+
+
+
+############################
+### Scheduling the Files ###
+############################
+
+'''
+Instead of a fixed number of processes, the scheduler (see AIS_Scheduler.py) uses every core on the node, but
+only starts a file while the memory it is expected to need still fits in the node's memory. It learns how much
+memory a file needs from the files that already finished, based on how big each file is.
+
+A pool can only use the cores of the node it was started on. To use several nodes, run one copy of this script
+on each node (EX: srun --ntasks-per-node=1 python Advanced_AIS_Filtering_via_Intersections.py) with
+split_across_nodes set to True. Each node then filters its own block of consecutive days, writing csv files to
+its own Node_{number}/ folder inside data_folder.
+'''
+
+# If True, files are scheduled by memory using every core of the node
+    # If False, a plain pool of num_cores processes runs every file, like before
+use_scheduler = True
+
+# The bytes of memory that running files may use together, or None for most of the node's memory
+scheduler_memory = None
+
+# If True, each node of a multi-node job filters its own block of days (see above)
+split_across_nodes = False
+
+
+def node_subfolder():
+    # Each node of a split job keeps its own files, so nodes never write to the same file
+    if not split_across_nodes:
+        return ''
+    return f"Node_{os.environ.get('SLURM_NODEID', '0')}/"
+
+
+def file_size(url):
+    """
+    Returns
+    -------
+    The bytes in a day's file, which the scheduler uses to guess how much memory the file needs
+        None if it can't be found out
+    """
+
+    try:
+        if run_mode == "archive":
+            return os.path.getsize(archive_path(url))
+
+        # A cached zip's size is already on record
+        if use_download_cache:
+            record = cache_record(url, cache_folder)
+            if record is not None:
+                return record["size"]
+
+        # Otherwise ask NOAA for the size without downloading anything
+        with urlopen(Request(url, method="HEAD"), timeout=60) as response:
+            length = response.headers.get("Content-Length")
+        return int(length) if length is not None and length.isdigit() else None
+    except Exception:
+        return None
+
+
+def run_files(function, files, num_cores):
+    # Run function on every file in parallel, handing back results in whatever order they finish
+    finished_with = None
+
+    # Each file is only handed to a process once it's downloaded, while the next files download
+        # The window is on top of the files the processes are filtering, so every core can be busy while it fills
+    if prefetching():
+        files, finished_with = prefetch(files, cache_folder, running=num_cores)
+
+    if use_scheduler:
+        results = scheduled_imap(function, files, file_size, budget=scheduler_memory, max_workers=num_cores, report=True)
+    else:
+        # Create a pool with max processes = num_cores
+        pool = mlt.Pool(num_cores)
+        # imap_unordered hands a new file to a process the moment it finishes its last one
+            # Results come back in whatever order files finish, so no process waits on the slowest file of a batch
+        results = pool.imap_unordered(function, files)
+
+    try:
+        for result in results:
+            # A finished file makes room for another download
+            if finished_with is not None:
+                finished_with()
+            yield result
+    finally:
+        if not use_scheduler:
+            pool.terminate()
+
+
+
+###############################
+### Work Queue Across Nodes ###
+###############################
+
+'''
+For a job spread over many separate processes, like the tasks of a SLURM array job, the days are shared out
+through the work queue (see AIS_Work_Queue.py) instead of a pool. Running the job takes two steps:
+
+    "work"  : start as many copies of this script as you like, on any nodes that can see queue_folder
+              EX: sbatch --array=0-63 with a script that runs python Advanced_AIS_Filtering_via_Intersections.py
+              Each copy claims a day, filters it, saves the results as {queue folder}/Parts/{daily file}.pkl,
+              and claims the next day, until there are none left
+    "merge" : run one copy once the workers are done. It reads every part back in calendar order and writes it
+              through the writer, exactly like a regular run (run manifest, checkpoints, midnight stitching)
+
+A copy that dies or is cancelled keeps its day claimed until its lease runs out (see lease_seconds), then
+another copy takes the day over. The merge step can be run again at any time, and only adds days the run
+manifest doesn't have yet.
+'''
+
+# If True, the job runs through the work queue instead of a pool
+use_work_queue = False
+
+# Which step of the work queue this copy of the script runs: "work" or "merge"
+queue_step = "work"
+
+# WARNING!!!
+# Like data_folder, adjust this to a scratch folder that every node can see
+# WARNING!!!
+
+queue_folder = '/home/{your jhed}/scr4_mshiel10/{your usename}/Work_Queue/'
+
+
+def part_path(url):
+    # Where a worker saves the results of a day, EX: {queue folder}/Parts/AIS_2020_01_01.pkl
+    return queue_folder + 'Parts/' + source_name(url) + '.pkl'
+
+
+def filter_to_part(url):
+    """
+    Filters one day for a queue worker and saves its results as a part
+
+    Returns
+    -------
+    Dictionary kept in the day's done marker, of the form "rows": Dictionary of the form Bridge: Number of Rows
+
+    Raises
+    ------
+    RuntimeError if the day failed, so the queue records the failure and tries the day again later
+    """
+
+    url, results = download_and_filter(url)
+
+    # download_and_filter already printed what went wrong
+    if results is None:
+        raise RuntimeError(f"{source_name(url)} failed to filter")
+
+    os.makedirs(queue_folder + 'Parts/', exist_ok=True)
+
+    # Written to a temporary file first, so a half written part is never merged
+        # The name includes the process, since a day taken over from a slow worker can be written by two at once
+    path = part_path(url)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        pickle.dump(results, f)
+
+    os.replace(temporary, path)
+
+    return {"rows": {bridge: len(results[bridge]) for bridge in results}}
+
+
+def queued_results(files):
+    """
+    Parameters
+    ----------
+    files : the urls to merge
+
+    Returns
+    -------
+    A generator of (url, results) for every day the workers finished, in calendar order
+        Days that used up every attempt come back as (url, None), so they are recorded as failed
+        Days still being worked on are left out, and can be merged by running the merge step again
+    """
+
+    status = queue_status(queue_folder, files, source_name)
+    print(f"Work queue: {status}", flush=True)
+
+    for url in sorted(files, key=day_of):
+        if os.path.exists(queue_paths(queue_folder, source_name(url))["done"]):
+            with open(part_path(url), 'rb') as f:
+                yield url, pickle.load(f)
+
+        elif (read_json(queue_paths(queue_folder, source_name(url))["failed"]) or {}).get("attempts", 0) >= max_attempts:
+            yield url, None
+
+
+
+########################
+### Running the code ###
+########################
+
+if __name__ == "__main__":
+    
+    print("Script Began")
+    
+    # Each node of a split job only runs its own block of days
+    job_urls = node_share(URLs) if split_across_nodes else URLs
+    
+    files = job_urls
+        # In the case that the script halts prematurely, just run it again
+        # The run manifest records every file that was written, and only the rest are filtered
+    
+    # The number of cores represents the max number of processes running simultaneously
+        # Memory errors can occur if there are very few spare cores in the rockfish allocation
+        # TDL: look into utilizing big mem partition
+    num_cores = 36
+        # This code was ran using a max of 38 cores on 2 nodes of 48 cores each (96 cores total) and took approximately 27 hours
+    
+    # The scheduler keeps files within the node's memory, so every core can be used
+    if use_scheduler:
+        num_cores = node_cores()
+
+    if run_mode == "ingest":
+        # Archiving writes its own files, so there's nothing for a writer to do
+        for url, rows in run_files(download_and_archive, files, num_cores):
+            if rows is not None:
+                print(f"Archived {zip_member_name(url)[:-4]} ({rows} broadcasts)", flush=True)
+
+        # Where the time went while ingesting
+        if use_metrics and os.path.isdir(archive_folder + 'Metrics/' + run_name):
+            summarize(archive_folder + 'Metrics/', run_name)
+    
+    elif use_work_queue and queue_step == "work":
+        # Each copy of the script works through the queue one day at a time, the writer runs in the merge step
+            # Days are claimed in calendar order, so the parts finish roughly in the order they are merged
+        finished = work_loop(filter_to_part, queue_folder, sorted(job_urls, key=day_of), source_name)
+        print(f"Filtered {finished} days", flush=True)
+    
+    else:
+        manifest = None
+        
+        # Midnights are only stitched for bridges, ports are filtered a day at a time
+        stitch = stitch_mode if run_target == "bridges" else None
+        
+        if run_target == "ports":
+            # Visits and pairs are different outputs, so switching between them makes every file stale
+            settings = ["visits"] if port_records == "visits" else []
+        else:
+            # Events and pairs are different outputs, so switching between them makes every file stale
+                # A sweep's crossings have a SweepMask, so changing the sweep does too
+            settings = (["events"] if crossing_records == "events" else []) + ([json.dumps(sweep_settings)] if use_sweep else [])
+        # Cleaning changes which segments are tested, so changing its limits does too
+        settings += [f"cleaned {max_speed_knots} knots {min_jump_miles} miles"] if use_track_cleaning else []
+        signature = boundary_hash(port_geometry if run_target == "ports" else bridge_geometry, min_boat_length, *settings)
+
+        # Say which bit of SweepMask is which variant, next to the crossings
+        if use_sweep and run_target == "bridges":
+            save_sweep_variants(output_folder(), sweep_settings)
+
+        if use_manifest:
+            manifest = load_manifest(manifest_path())
+
+            # Cut off anything a crashed run wrote without finishing its checkpoint
+            if undo_interrupted_checkpoint(manifest, manifest_path()):
+                print("Undid the last unfinished write from a previous run", flush=True)
+
+            # The crossing store replaces a day's old crossings, but csv files can only be appended to
+            files, stale = files_to_run(manifest, job_urls, signature, rerun_stale=(default_format() == "parquet"))
+
+            if stale and default_format() != "parquet":
+                print(f"{len(stale)} files were filtered with different boundaries or settings. Their crossings can't be"
+                      " replaced in the csv files, so write to a new data_folder (or the crossing store) to filter them again", flush=True)
+
+            print(f"{len(files)} of {len(job_urls)} files need to be filtered", flush=True)
+
+        # A single writer thread handles every bridge (or port) for the whole job
+        write_queue = Queue(maxsize=writer_queue_size)
+        writer_thread = Thread(target=writer, args=[write_queue], kwargs={"manifest": manifest, "signature": signature})
+        writer_thread.start()
+        
+        # Every day of the job by date, to find the days on either side of a midnight
+        day_urls = {day_of(url): url for url in job_urls}
+        
+        # Midnights handed to the writer during this run
+        midnights = set()
+        
+        def stitch_around(url):
+            # Stitch the midnight before this day, and the one after it
+            after = day_urls.get(day_of(url) + timedelta(days=1))
+            
+            for day in [url] + ([after] if after is not None else []):
+                key, stitched = stitch_midnight(day, day_urls, manifest=manifest, signature=signature, rerun_stale=(default_format() == "parquet"))
+                if stitched is not None and key not in midnights:
+                    midnights.add(key)
+                    write_queue.put((key, stitched))
+        
+        if stitch is not None:
+            # Finish any midnight whose days are both done, but which was never written (EX: the job died in between)
+            running = set(files)
+            for url in job_urls:
+                if url not in running and os.path.exists(edges_path(url)):
+                    stitch_around(url)
+        
+        if use_work_queue:
+            # The merge step: the workers already filtered the days, so read their parts back in
+            for url, results in queued_results(files):
+                write_queue.put((url, results))
+                
+                if results is not None and stitch is not None:
+                    stitch_around(url)
+        
+        elif stitch_mode == "sequential":
+            # One day at a time in calendar order, so only one day is ever in memory
+            days = sorted(files, key=day_of)
+            finished_with = None
+            
+            # The next days download while this one is filtered
+            if prefetching():
+                days, finished_with = prefetch(days, cache_folder, running=1, ordered=True)
+            
+            for url in days:
+                url, results = download_and_filter(url)
+                write_queue.put((url, results))
+                
+                if finished_with is not None:
+                    finished_with()
+                
+                if results is not None and stitch is not None:
+                    stitch_around(url)
+        
+        else:
+            # A new file is handed to a process as soon as there's a core (and memory) for it
+            for url, results in run_files(download_and_filter, files, num_cores):
+            
+                # Failed files go to the writer too, so they are recorded in the manifest
+                write_queue.put((url, results))
+                
+                # Each midnight is stitched as soon as the days on both sides of it are done
+                if results is not None and stitch is not None:
+                    stitch_around(url)
+        
+        # Every file is finished, so tell the writer to write what it's holding and stop
+        write_queue.put(None)
+        writer_thread.join()
+        
+        # Bring the query index up to date with everything the writer wrote
+            # A port job's crossings (or visits) are indexed in port_folder the same way
+        if use_query_index and os.path.isdir(output_folder()):
+            build_index(output_folder(), store=(default_format() == "parquet"))
+        
+        # Where the time went, and which files were the slowest
+            # The merge step of the work queue doesn't filter anything itself, the workers' logs are summarized on their own
+        if use_metrics and os.path.isdir(output_folder() + 'Metrics/' + run_name):
+            summarize(output_folder() + 'Metrics/', run_name)
+            
+
+'''
+Notes on multiprocessing:
+    
+The writer thread runs for the whole job, while new files are smoothly handed to processes as older ones
+finish, rather than working in batches. The writer knows when to stop because the main process puts None
+on its queue after the last file comes back, including files that failed, so it never has to check whether
+the queue is empty.
+
+The original reason for handling files in batches was memory. Files are now streamed a chunk of rows at a
+time, so each process only ever holds one chunk plus the important broadcasts it has found. The following
+link goes into a deep dive on memory usage while working in pandas and multiprocessing: https://stackoverflow.com/questions/49429368/how-to-solve-memory-issues-while-multiprocessing-using-pool-map 
+NOTE: Running the original batched script with 36 cores on one node with 48 total cores lead to no memory issues.
+However, running it with 72 cores on two nodes with 96 cores total DOES lead to a memory error.
+The scheduler now decides how many files run at once from the memory they actually use (see Scheduling the Files),
+and a job across several nodes runs one pool per node instead of one pool stretched across them.
 '''
-Potential improvement for multiprocessing:
-    
-In an ideal world, each thread for writing is constantly running, while new processes are smoothly 
-started as older ones finish, rather than working in chunks. To make this happen, you would
-need to adjust the writer function to run continuously and somehow maintain a counter for the
-number of files you've written, including any potential errors that stop a file from being written,
-otherwise each thread would never halt. However, constantly checking if a queue is empty is 
-very slow, as it requires obtaining the mutex for each queue on each check. The solution in this 
-file works, so I've opted to leave improving it to someone else who hopefully has more experience
-with multiprocessing. 
-
-The purpose of handling all files in batches is due to memory issues. If there were sufficient
-memory, all files could be handled simultaneously, and everything could be written at the very end. 
-However, I have no idea how to ensure memory is non-binding, especially because failing to save work
-progressively could mean it's all lost in case of an error. The following link goes into a deep dive
-on memory usage while working in pandas and multiprocessing: https://stackoverflow.com/questions/49429368/how-to-solve-memory-issues-while-multiprocessing-using-pool-map 
-NOTE: Running this script with 36 cores on one node with 48 total cores lead to no memory issues.
-However, running this script with 72 cores on two nodes with 96 cores total DOES lead to a memory error.
-'''
-    
\ No newline at end of file